@@ -0,0 +1,86 @@
+"""
+Measures how long the controller's modules take to import and fails when they exceed their
+budget or import a heavy dependency eagerly.
+Each module is imported in a fresh interpreter several times and the median is compared to
+its budget, so that the measurement does not depend on what is already cached in-process.
+
+Usage:
+    python benchmarks/import_time.py [--runs N] [--budget MODULE=MS ...]
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Import budgets in milliseconds, measured on a developer laptop with generous headroom
+BUDGETS = {
+    'ctcontroller': 50,
+    'ctcontroller.ct_main': 150,
+    'ctcontroller.api': 1000,
+}
+
+# Dependencies that must only be imported when a provisioner or runner actually needs them
+LAZY = {
+    'ctcontroller': ['paramiko', 'validators', 'openstack', 'fastapi'],
+    'ctcontroller.ct_main': ['paramiko', 'validators', 'openstack'],
+    'ctcontroller.api': ['paramiko', 'validators', 'openstack'],
+}
+
+PROBE = """
+import sys, time, json, subprocess
+spawned = []
+_popen = subprocess.Popen.__init__
+def popen(self, *args, **kwargs):
+    spawned.append(str(args[0] if args else kwargs.get('args')))
+    return _popen(self, *args, **kwargs)
+subprocess.Popen.__init__ = popen
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{'elapsed': elapsed, 'modules': sorted(sys.modules), 'spawned': spawned}}))
+"""
+
+def measure(module: str) -> dict:
+    """Imports module in a fresh interpreter and returns the time taken and what was loaded."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], env=env, cwd=root,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Check the import time of the controller modules')
+    parser.add_argument('--runs', type=int, default=int(os.environ.get('CT_CONTROLLER_IMPORT_RUNS', 5)),
+                        help='number of fresh interpreters per module')
+    parser.add_argument('--budget', action='append', default=[], metavar='MODULE=MS',
+                        help='override the budget of a module')
+    args = parser.parse_args(argv)
+
+    budgets = dict(BUDGETS)
+    for override in args.budget:
+        module, budget = override.split('=')
+        budgets[module] = float(budget)
+
+    failures = []
+    for module, budget in budgets.items():
+        results = [measure(module) for _ in range(args.runs)]
+        median = statistics.median(result['elapsed'] for result in results)
+        eager = [dep for dep in LAZY.get(module, []) if dep in results[0]['modules']]
+        spawned = results[0]['spawned']
+        print(f'{module:<24} {median:8.1f} ms (budget {budget:.0f} ms)')
+        if median > budget:
+            failures.append(f'{module} took {median:.1f} ms, over its budget of {budget:.0f} ms')
+        if eager:
+            failures.append(f'{module} imported {", ".join(eager)} eagerly')
+        if spawned:
+            failures.append(f'{module} ran commands at import time: {", ".join(spawned)}')
+
+    for failure in failures:
+        print(f'FAIL: {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Measures the latency of full job cycles, from provisioning the hardware to shutting it down,
+against local stand-ins instead of Chameleon, TACC and docker, so that changes to the
+provisioning and application workflow can be compared offline.
+Each cycle runs either the CLI workflow (ct_main.setup, run and shutdown) or the API workflow
+(startup, configure, run and shutdown requests to the FastAPI app). The nodes are in-process
+SSH servers on loopback addresses, the Chameleon site is an in-memory fake with realistic
+latencies and the docker commands emulate the installer and the application. The time
+resources take to become ready, the durations of the tools and the wait policies of the
+Chameleon provisioner are multiplied by --scale; request and command latencies are not.
+The percentiles of each workflow step and of each span recorded by the tracer are reported.
+
+Usage:
+    python benchmarks/provisioning.py [--target chameleon|tacc|local] [--interface cli|api]
+                                      [--cycles N] [--nodes N] [--scale F] [--json PATH]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+
+# the controller is imported from the repository rather than an installed copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from standins import FakeChameleonClient, Latencies, SSHNode, install_tools
+
+SITES = {'chameleon': 'CHI@TACC', 'tacc': 'TACC', 'local': 'local'}
+NODE_TYPES = {'chameleon': 'compute_bench', 'tacc': 'x86', 'local': 'x86'}
+PERCENTILES = [50, 90, 99]
+
+def percentile(values: list, pct: float) -> float:
+    """Returns the nearest-rank percentile of values."""
+    ordered = sorted(values)
+    rank = max(int(-(-pct * len(ordered) // 100)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+def summarize(samples: dict) -> list:
+    """Returns the count, percentiles and maximum in milliseconds of each list of durations."""
+    rows = []
+    for name, values in samples.items():
+        row = {'name': name, 'count': len(values)}
+        for pct in PERCENTILES:
+            row[f'p{pct}'] = round(percentile(values, pct) * 1000, 1)
+        row['max'] = round(max(values) * 1000, 1)
+        rows.append(row)
+    return rows
+
+def print_table(title: str, rows: list):
+    print(f'\n{title}')
+    print(f'{"":<40} {"n":>5} ' + ' '.join(f'{f"p{pct}":>10}' for pct in PERCENTILES) + f' {"max":>10}  (ms)')
+    for row in rows:
+        print(f'{row["name"][:40]:<40} {row["count"]:>5} '
+              + ' '.join(f'{row[f"p{pct}"]:>10.1f}' for pct in PERCENTILES) + f' {row["max"]:>10.1f}')
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def span_key(span: dict) -> str:
+    action = (span.get('attributes') or {}).get('action')
+    return f'{span["name"]} {action}' if action else span['name']
+
+def prepare(args, workdir: str) -> tuple:
+    """
+    Sets up the environment of the controller and starts the stand-in nodes. Must run before
+    the controller is imported, as it reads some settings at import time.
+
+        Returns:
+            tuple: the stand-in nodes and the addresses of the Chameleon floating IPs
+    """
+
+    bin_dir = install_tools(os.path.join(workdir, 'bin'))
+    durations = {'BENCH_PULL_SECONDS': str(args.pull_seconds * args.scale),
+                 'BENCH_INSTALL_SECONDS': str(args.install_seconds * args.scale),
+                 'BENCH_APP_SECONDS': str(args.app_seconds * args.scale)}
+    port = free_port()
+    # only warnings reach the console, set CT_CONTROLLER_LOG_LEVEL to see more
+    os.environ.setdefault('CT_CONTROLLER_LOG_LEVEL', 'WARN')
+    os.environ.update(durations)
+    os.environ.update({
+        'PATH': f'{bin_dir}{os.pathsep}{os.environ["PATH"]}',
+        'BENCH_DOCKER_STATE': os.path.join(workdir, 'local-docker.json'),
+        'CT_CONTROLLER_OUTPUT_DIR': os.path.join(workdir, 'output'),
+        'CT_CONTROLLER_STATE_DB': os.path.join(workdir, 'output', 'ctcontroller.db'),
+        'CT_CONTROLLER_CATALOG_DIR': os.path.join(workdir, 'catalog'),
+        'CT_CONTROLLER_TRACE_FILE': os.path.join(workdir, 'output', 'traces.jsonl'),
+        'CT_CONTROLLER_SSH_PORT': str(port),
+        'CT_CONTROLLER_CONFIG_PATH': os.path.join(workdir, 'config.yml'),
+        'CT_CONTROLLER_TARGET_SITE': SITES[args.target],
+        'CT_CONTROLLER_NODE_TYPE': NODE_TYPES[args.target],
+        'CT_CONTROLLER_NUM_NODES': str(args.nodes if args.target == 'tacc' else 1),
+        'CT_CONTROLLER_GPU': 'False',
+        'CT_CONTROLLER_CT_VERSION': 'bench',
+    })
+    if args.target == 'local':
+        os.makedirs(os.path.join(workdir, 'local'))
+        os.environ['CT_CONTROLLER_RUN_DIR'] = os.path.join(workdir, 'local', 'ct_run')
+        return [], []
+
+    import paramiko  # pylint: disable=import-outside-toplevel
+    key_path = os.path.join(workdir, 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+    host_key = paramiko.RSAKey.generate(2048)
+    count = args.nodes if args.target == 'tacc' else 1
+    nodes = []
+    for index in range(count):
+        address = f'127.0.0.{index + 2}'
+        home = os.path.join(workdir, 'nodes', address)
+        env = dict(durations, PATH=os.environ['PATH'], BENCH_NODE_ID=f'bench-{index}',
+                   BENCH_HOSTNAME=f'bench-node-{index}',
+                   BENCH_DOCKER_STATE=os.path.join(home, '.docker.json'))
+        nodes.append(SSHNode(address, port, home, env, args.ssh_latency, host_key).start())
+    hosts = [{'IP': node.address, 'Username': 'cc'} for node in nodes]
+    config = (f'TACC:\n  Name: bench\n  Path: {key_path}\n  Hosts:\n    x86:\n'
+              + ''.join(f'      - IP: {host["IP"]}\n        Username: {host["Username"]}\n' for host in hosts)
+              + f'CHI@TACC:\n  Name: bench\n  Path: {key_path}\n  ID: bench\n  Secret: bench\n'
+              + 'Settings:\n  AuthenticateUsers: False\n')
+    with open(os.environ['CT_CONTROLLER_CONFIG_PATH'], 'w', encoding='utf-8') as fil:
+        fil.write(config)
+    return nodes, [node.address for node in nodes]
+
+def use_fake_site(args, addresses: list) -> FakeChameleonClient:
+    """Makes the Chameleon provisioner use a fake site, with its wait policies scaled."""
+    # pylint: disable=import-outside-toplevel
+    from ctcontroller import chameleon_provisioner
+    from ctcontroller.waits import WaitPolicy
+
+    def scaled(policy: WaitPolicy) -> WaitPolicy:
+        return WaitPolicy(policy.default * args.scale, policy.deadline,
+                          {state: interval * args.scale for state, interval in policy.intervals.items()},
+                          policy.expected * args.scale if policy.expected is not None else None,
+                          policy.minimum * args.scale)
+
+    latencies = Latencies().scaled(args.scale)
+    latencies.request = args.request_latency
+    client = FakeChameleonClient(SITES['chameleon'], addresses, NODE_TYPES['chameleon'], latencies)
+    chameleon_provisioner.get_client = lambda site, auth_url, credential: client
+    for name in ['LEASE_WAIT', 'SERVER_WAIT', 'ADDRESS_WAIT']:
+        setattr(chameleon_provisioner, name, scaled(getattr(chameleon_provisioner, name)))
+    return client
+
+def cli_cycle(job_id: str) -> dict:
+    """Runs a job through ct_main and returns the duration of each step."""
+    from ctcontroller import ct_main  # pylint: disable=import-outside-toplevel
+    steps = {}
+    start = time.perf_counter()
+    _, provisioner, manager = ct_main.setup({'job_id': job_id})
+    steps['setup'] = time.perf_counter() - start
+    mark = time.perf_counter()
+    ct_main.run(provisioner, manager)
+    steps['run'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    ct_main.shutdown(provisioner, manager)
+    steps['shutdown'] = time.perf_counter() - mark
+    steps['cycle'] = time.perf_counter() - start
+    return steps
+
+def wait_operation(client, response) -> dict:
+    operation_id = response.json()['operation_id']
+    while True:
+        operation = client.get(f'/operations/{operation_id}').json()
+        if operation['status'] not in ['PENDING', 'RUNNING']:
+            if operation['status'] != 'SUCCEEDED':
+                raise RuntimeError(f'{operation["kind"]} failed: {operation["error"]}')
+            return operation
+        time.sleep(0.05)
+
+def api_cycle(client, job_id: str) -> dict:
+    """Runs a job through the API endpoints and returns the duration of each request."""
+    steps = {}
+    start = time.perf_counter()
+    wait_operation(client, client.post(f'/jobs/{job_id}/startup',
+                                       json={'job_id': job_id, 'node_type': os.environ['CT_CONTROLLER_NODE_TYPE']}))
+    steps['startup'] = time.perf_counter() - start
+    mark = time.perf_counter()
+    client.post(f'/jobs/{job_id}/configure', json={'ct_version': 'bench'})
+    steps['configure'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    wait_operation(client, client.post(f'/jobs/{job_id}/run'))
+    steps['run'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    client.post(f'/jobs/{job_id}/shutdown')
+    steps['shutdown'] = time.perf_counter() - mark
+    steps['cycle'] = time.perf_counter() - start
+    return steps
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark full provisioning cycles against local stand-ins')
+    parser.add_argument('--target', choices=list(SITES), default='chameleon', help='site to provision on')
+    parser.add_argument('--interface', choices=['cli', 'api'], default='cli', help='workflow to drive')
+    parser.add_argument('--cycles', type=int, default=5, help='number of jobs to run')
+    parser.add_argument('--nodes', type=int, default=1, help='number of TACC nodes per job')
+    parser.add_argument('--scale', type=float, default=0.01,
+                        help='factor applied to resource, tool and wait durations')
+    parser.add_argument('--request-latency', type=float, default=0.2, help='seconds each Chameleon request takes')
+    parser.add_argument('--ssh-latency', type=float, default=0.05, help='seconds added to each remote command')
+    parser.add_argument('--pull-seconds', type=float, default=30, help='duration of an image pull')
+    parser.add_argument('--install-seconds', type=float, default=60, help='duration of the installer')
+    parser.add_argument('--app-seconds', type=float, default=300, help='duration of the application')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to a JSON file')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='ct-bench-')
+    nodes, addresses = prepare(args, workdir)
+    # pylint: disable=import-outside-toplevel
+    from ctcontroller.tracing import TRACER
+    fake = use_fake_site(args, addresses) if args.target == 'chameleon' else None
+
+    steps, spans = {}, {}
+    try:
+        if args.interface == 'api':
+            from fastapi.testclient import TestClient
+            from ctcontroller import api
+            with TestClient(api.app) as client:
+                results = [(job_id, api_cycle(client, job_id))
+                           for job_id in [f'bench-{index}' for index in range(args.cycles)]]
+        else:
+            results = [(job_id, cli_cycle(job_id))
+                       for job_id in [f'bench-{index}' for index in range(args.cycles)]]
+        for job_id, durations in results:
+            for name, duration in durations.items():
+                steps.setdefault(name, []).append(duration)
+            for span in TRACER.timings(job_id, detail=True)['spans']:
+                if span['duration'] is not None:
+                    spans.setdefault(span_key(span), []).append(span['duration'])
+    finally:
+        for node in nodes:
+            node.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {'target': args.target, 'interface': args.interface, 'cycles': args.cycles,
+               'scale': args.scale, 'steps': summarize(steps),
+               'spans': sorted(summarize(spans), key=lambda row: -row['p50'] * row['count'])}
+    if fake is not None:
+        results['chameleon_requests'] = fake.requests
+    if nodes:
+        results['remote_commands'] = sum(node.commands for node in nodes)
+    print_table(f'{args.interface} workflow on {args.target}, {args.cycles} cycles, scale {args.scale}',
+                results['steps'])
+    print_table('spans', results['spans'])
+    for key in ['chameleon_requests', 'remote_commands']:
+        if key in results:
+            print(f'\n{key.replace("_", " ")} per cycle: {results[key] / args.cycles:.1f}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fil:
+            json.dump(results, fil, indent=1)
+    if args.keep:
+        print(f'\nworking directory: {workdir}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
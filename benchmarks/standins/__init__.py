@@ -0,0 +1,15 @@
+"""
+Local stand-ins for the services the controller talks to, used to benchmark provisioning
+without a Chameleon allocation, TACC nodes or docker:
+
+- FakeChameleonClient replaces the client of a Chameleon site, with configurable request
+  latencies and leases, servers and floating IPs that go through their usual states;
+- SSHNode is an in-process SSH and SFTP server standing in for a node, running commands in
+  its own home directory;
+- install_tools writes the docker, curl, jq and hostname commands the nodes run, which
+  emulate the installer and the application with configurable durations.
+"""
+
+from .chameleon import FakeChameleonClient, Latencies
+from .ssh import SSHNode
+from .tools import install_tools
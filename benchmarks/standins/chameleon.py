@@ -0,0 +1,228 @@
+"""
+Contains FakeChameleonClient, a stand-in for the client of a Chameleon site. It keeps the
+hosts, leases, servers and floating IPs of the site in memory and answers every request
+after a configurable latency. Leases go from PENDING through STARTING to ACTIVE and servers
+from BUILD to ACTIVE after configurable durations, and a floating IP shows up in the
+addresses of its server some time after being associated, as on the real site.
+"""
+
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from ctcontroller.tracing import span
+from ctcontroller.util import ProvisionException
+from ctcontroller.waits import StatusPoller
+
+class Latencies():
+    """
+    How long the fake site takes to answer requests and to get resources ready.
+
+    Attributes:
+        request (float): time in seconds each API request takes
+        lease (float): time in seconds until a lease starting now is ACTIVE
+        boot (float): time in seconds until a server is ACTIVE
+        associate (float): time in seconds until a floating IP is associated with its server
+    """
+
+    def __init__(self, request: float=0.2, lease: float=60, boot: float=600, associate: float=5):
+        self.request = request
+        self.lease = lease
+        self.boot = boot
+        self.associate = associate
+
+    def scaled(self, factor: float) -> 'Latencies':
+        """Returns the latencies multiplied by factor."""
+        return Latencies(self.request * factor, self.lease * factor, self.boot * factor,
+                         self.associate * factor)
+
+class FakeChameleonClient():
+    """
+    An in-memory Chameleon site with the same methods as ChameleonClient.
+
+    Attributes:
+        site (str): the site, e.g. CHI@TACC
+        latencies (Latencies): how long requests and resources take
+        hosts (list): the reservable hosts, one for each node address
+        addresses (list): the floating IP addresses of the site, those of the SSH stand-ins
+        leases (dict): maps a lease id to the lease
+        servers (dict): maps a server id to the server
+        floating_ips (dict): maps an allocated floating IP address to its server id, if any
+        requests (int): number of requests answered
+        poller (StatusPoller): lists the leases and servers once for all waits
+    """
+
+    def __init__(self, site: str, addresses: list, node_type: str='compute_bench',
+                 latencies: Latencies=None):
+        self.site = site
+        self.latencies = latencies or Latencies()
+        self.addresses = list(addresses)
+        self.hosts = [{'id': str(index), 'hypervisor_hostname': f'bench-{index}',
+                       'node_name': f'bench-node-{index}', 'node_type': node_type,
+                       'architecture.platform_type': 'x86', 'cpu_arch': 'x86_64', 'gpu.gpu': False,
+                       'gpu.gpu_model': None, 'processor.other_description': 'stand-in',
+                       'reservable': True}
+                      for index in range(len(self.addresses))]
+        self.images = [{'id': 'bench-image', 'name': 'CC-Ubuntu-bench', 'status': 'active',
+                        'tags': ['ct_edge', 'x86']}]
+        self.leases = {}
+        self.servers = {}
+        self.floating_ips = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.poller = StatusPoller({'lease': self.list_leases, 'server': self.list_servers})
+
+    @contextmanager
+    def request(self, action: str):
+        """Times a request as a span, like the real client, including its latency."""
+        with self.lock:
+            self.requests += 1
+        with span('openstack', site=self.site, action=action):
+            time.sleep(self.latencies.request)
+            yield
+
+    def _lease_status(self, lease: dict) -> str:
+        elapsed = time.monotonic() - lease['created']
+        if elapsed < self.latencies.lease / 2:
+            return 'PENDING'
+        if elapsed < self.latencies.lease:
+            return 'STARTING'
+        return 'ACTIVE'
+
+    def _lease(self, lease: dict) -> dict:
+        return dict(lease['public'], status=self._lease_status(lease))
+
+    def _server(self, server: dict) -> dict:
+        elapsed = time.monotonic() - server['created']
+        status = 'ACTIVE' if elapsed >= self.latencies.boot else 'BUILD'
+        addresses = [{'addr': f'10.52.0.{server["host"]}', 'OS-EXT-IPS:type': 'fixed'}]
+        associated = server.get('associated')
+        if associated is not None and time.monotonic() - associated >= self.latencies.associate:
+            addresses.append({'addr': server['floating_ip'], 'OS-EXT-IPS:type': 'floating'})
+        return {'id': server['id'], 'name': server['name'], 'status': status,
+                'addresses': {'sharednet1': addresses}}
+
+    def find_network_id(self, name: str) -> str:
+        with self.request('find network'):
+            return f'{name}-id'
+
+    def list_hosts(self) -> list:
+        with self.request('list hosts'):
+            return [dict(host) for host in self.hosts]
+
+    def find_host(self, name_or_id: str) -> dict:
+        for host in self.list_hosts():
+            if name_or_id in [str(host.get('id')), host.get('hypervisor_hostname')]:
+                return host
+        raise ProvisionException(f'Host {name_or_id} not found on {self.site}')
+
+    def list_host_allocations(self) -> list:
+        with self.request('list host allocations'), self.lock:
+            allocations = {}
+            for lease in self.leases.values():
+                for host in lease['hosts']:
+                    allocations.setdefault(host, []).append(
+                        {'id': lease['public']['id'], 'start_date': lease['public']['start_date'],
+                         'end_date': lease['public']['end_date']})
+            return [{'resource_id': host, 'reservations': reservations}
+                    for host, reservations in allocations.items()]
+
+    def create_lease(self, name: str, reservations: list, end: str, start: str='now') -> dict:
+        with self.request('create lease'), self.lock:
+            reservation = reservations[0]
+            hosts = []
+            if reservation['resource_type'] == 'physical:host':
+                held = {host for lease in self.leases.values() for host in lease['hosts']}
+                free = [host['id'] for host in self.hosts if host['id'] not in held]
+                if len(free) < int(reservation['min']):
+                    raise ProvisionException('Chameleon request to create lease failed: '
+                                             'Not enough resources available')
+                hosts = free[:int(reservation['min'])]
+            start_date = (datetime.now(UTC) if start == 'now'
+                          else datetime.strptime(start, '%Y-%m-%d %H:%M').replace(tzinfo=UTC))
+            lease_id = str(uuid.uuid4())
+            public = {'id': lease_id, 'name': name, 'start_date': start_date.isoformat(),
+                      'end_date': datetime.strptime(end, '%Y-%m-%d %H:%M').replace(tzinfo=UTC).isoformat(),
+                      'reservations': [dict(reservation, id=str(uuid.uuid4()))]}
+            self.leases[lease_id] = {'public': public, 'hosts': hosts, 'created': time.monotonic()}
+            return self._lease(self.leases[lease_id])
+
+    def get_lease(self, lease_id: str) -> dict:
+        with self.request('show lease'), self.lock:
+            if lease_id not in self.leases:
+                raise ProvisionException(f'Chameleon request to show lease failed: {lease_id} not found')
+            return self._lease(self.leases[lease_id])
+
+    def update_lease(self, lease_id: str, end: str) -> dict:
+        with self.request('update lease'), self.lock:
+            lease = self.leases[lease_id]
+            lease['public']['end_date'] = datetime.strptime(end, '%Y-%m-%d %H:%M').replace(tzinfo=UTC).isoformat()
+            return self._lease(lease)
+
+    def delete_lease(self, lease_id: str):
+        with self.request('delete lease'), self.lock:
+            self.leases.pop(lease_id, None)
+
+    def list_leases(self) -> list:
+        with self.request('list leases'), self.lock:
+            return [self._lease(lease) for lease in self.leases.values()]
+
+    def list_images(self, tags: list=None) -> list:
+        with self.request('list images'):
+            return [dict(image) for image in self.images if set(tags or []) <= set(image['tags'])]
+
+    def create_server(self, name: str, image: str, network_id: str, flavor: str,
+                      key_name: str, reservation_id: str) -> str:
+        with self.request('create server'), self.lock:
+            lease = next(lease for lease in self.leases.values()
+                         if lease['public']['reservations'][0]['id'] == reservation_id)
+            server_id = str(uuid.uuid4())
+            self.servers[server_id] = {'id': server_id, 'name': name, 'host': lease['hosts'][0],
+                                       'created': time.monotonic()}
+            return server_id
+
+    def get_server(self, server_id: str):
+        with self.request('show server'), self.lock:
+            server = self.servers.get(server_id)
+            return self._server(server) if server is not None else None
+
+    def delete_server(self, server_id: str):
+        with self.request('delete server'), self.lock:
+            server = self.servers.pop(server_id, None)
+            if server is not None and server.get('floating_ip') in self.floating_ips:
+                self.floating_ips[server['floating_ip']] = None
+
+    def list_servers(self) -> list:
+        with self.request('list servers'), self.lock:
+            return [self._server(server) for server in self.servers.values()]
+
+    def create_floating_ip(self, network_id: str) -> str:
+        with self.request('create floating ip'), self.lock:
+            free = [address for address in self.addresses if address not in self.floating_ips]
+            if not free:
+                raise ProvisionException('Chameleon request to create floating ip failed: '
+                                         'no more floating IPs')
+            self.floating_ips[free[0]] = None
+            return free[0]
+
+    def find_floating_ips(self, tags: list) -> list:
+        with self.request('list floating ips'), self.lock:
+            return list(self.floating_ips)
+
+    def delete_floating_ip(self, address: str):
+        with self.request('delete floating ip'), self.lock:
+            self.floating_ips.pop(address, None)
+
+    def list_floating_ips(self) -> list:
+        with self.request('list floating ips'), self.lock:
+            return [{'id': address, 'floating_ip_address': address,
+                     'status': 'ACTIVE' if server else 'DOWN'}
+                    for address, server in self.floating_ips.items()]
+
+    def add_floating_ip(self, server_id: str, address: str):
+        with self.request('associate floating ip'), self.lock:
+            server = self.servers[server_id]
+            server['floating_ip'] = address
+            server['associated'] = time.monotonic()
+            self.floating_ips[address] = server_id
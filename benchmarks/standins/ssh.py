@@ -0,0 +1,257 @@
+"""
+Contains SSHNode, an in-process SSH and SFTP server standing in for a node. Each node listens
+on its own loopback address, accepts any key and runs the commands it receives with bash in
+its home directory, with the stand-in tools first on the PATH. SFTP paths relative to the
+home directory resolve against it, so nodes sharing the machine do not see each other's
+lock files or run directories.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+import subprocess
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.sftp import SFTP_FAILURE, SFTP_OK
+
+LOGGER = logging.getLogger("CT Controller")
+# the server side of the connections logs every client disconnecting
+logging.getLogger('standins.ssh').addHandler(logging.NullHandler())
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+class _SFTP(SFTPServerInterface):
+    """Serves the files of the node, resolving relative paths against its home directory."""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = server.node.home
+
+    def _path(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.home, path))
+
+    def canonicalize(self, path):
+        return self._path(path)
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            mode = getattr(attr, 'st_mode', None) or 0o644
+            fd = os.open(path, flags, mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_APPEND:
+            fmode = 'ab'
+        elif flags & os.O_RDWR:
+            fmode = 'r+b'
+        elif flags & os.O_WRONLY:
+            fmode = 'wb'
+        else:
+            fmode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        # like OpenSSH, a plain rename does not replace an existing file
+        if os.path.exists(self._path(newpath)):
+            return SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(self._path(path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+class _Server(paramiko.ServerInterface):
+    """Accepts any public key and runs exec requests on the node."""
+
+    def __init__(self, node: 'SSHNode'):
+        self.node = node
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.node.execute, args=(channel, command.decode('utf-8')),
+                         daemon=True).start()
+        return True
+
+class SSHNode():
+    """
+    An SSH and SFTP server standing in for a node.
+
+    Attributes:
+        address (str): the loopback address the node listens on, e.g. 127.0.0.2
+        port (int): the port the node listens on
+        home (str): the home directory of the node, where commands run
+        env (dict): environment variables of the commands, e.g. the durations of the tools
+        latency (float): time in seconds added to each command, as a network round trip
+        host_key (paramiko.PKey): the host key of the node
+        commands (int): number of commands run
+
+    Methods:
+        start():
+            Starts accepting connections.
+        stop():
+            Closes the connections and stops accepting new ones.
+        execute(channel, command):
+            Runs a command and streams its output to the channel.
+    """
+
+    def __init__(self, address: str, port: int, home: str, env: dict=None, latency: float=0,
+                 host_key: paramiko.PKey=None):
+        self.address = address
+        self.port = port
+        self.home = home
+        self.env = dict(env or {})
+        self.latency = latency
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.commands = 0
+        self.transports = []
+        self.socket = None
+        self.thread = None
+        os.makedirs(home, exist_ok=True)
+
+    def start(self) -> 'SSHNode':
+        """Starts accepting connections in a background thread."""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.address, self.port))
+        self.port = self.socket.getsockname()[1]
+        self.socket.listen(64)
+        self.socket.settimeout(0.2)
+        self.thread = threading.Thread(target=self._accept, name=f'ssh-{self.address}', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Closes the connections and stops accepting new ones."""
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            sock.close()
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def _accept(self):
+        while self.socket is not None:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            transport = paramiko.Transport(conn)
+            transport.set_log_channel('standins.ssh')
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _SFTP)
+            try:
+                transport.start_server(server=_Server(self))
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                LOGGER.debug(f'stand-in {self.address} rejected a connection: {e}')
+                continue
+            self.transports = [t for t in self.transports if t.is_active()] + [transport]
+
+    def execute(self, channel, command: str):
+        """Runs a command with bash in the home directory and streams its output to the channel."""
+        self.commands += 1
+        time.sleep(self.latency)
+        env = dict(os.environ, HOME=self.home, **self.env)
+        try:
+            proc = subprocess.Popen(['bash', '-c', command], cwd=self.home, env=env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            err = threading.Thread(target=self._pump, args=(proc.stderr, channel.sendall_stderr))
+            err.start()
+            self._pump(proc.stdout, channel.sendall)
+            err.join()
+            channel.send_exit_status(proc.wait())
+        except OSError as e:
+            LOGGER.debug(f'stand-in {self.address} lost a channel: {e}')
+        finally:
+            channel.close()
+
+    @staticmethod
+    def _pump(stream, send):
+        for line in iter(stream.readline, b''):
+            try:
+                send(line)
+            except OSError:
+                break
+        stream.close()
@@ -0,0 +1,162 @@
+"""
+Contains the stand-ins of the commands the controller runs on a node, or locally, and
+install_tools, which puts them on a PATH.
+
+- docker emulates the camera traps installer, which writes a docker-compose.yml into the
+  install directory, and the application, which prints a line per second while running.
+  Pulls, installs and runs take BENCH_PULL_SECONDS, BENCH_INSTALL_SECONDS and
+  BENCH_APP_SECONDS. The running containers are recorded in BENCH_DOCKER_STATE so that
+  `docker ps` reports them;
+- curl answers the GitHub tags request and the Chameleon vendor data request, whose node id
+  is BENCH_NODE_ID;
+- jq supports the `.a.b` filters the controller uses;
+- hostname prints BENCH_HOSTNAME.
+
+Usage:
+    python benchmarks/standins/tools.py TOOL [ARGS ...]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import fcntl
+
+TOOLS = ['docker', 'curl', 'jq', 'hostname']
+
+def install_tools(bin_dir: str) -> str:
+    """
+    Writes a script for each stand-in tool into bin_dir.
+
+        Parameters:
+            bin_dir (str): the directory to write the scripts to
+
+        Returns:
+            str: bin_dir, to be put first on the PATH
+    """
+
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w', encoding='utf-8') as fil:
+            fil.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {tool} "$@"\n')
+        os.chmod(path, 0o755)
+    return bin_dir
+
+def _seconds(name: str) -> float:
+    return float(os.environ.get(name, 0))
+
+class _State():
+    """The running compose projects, shared by the docker commands of a node."""
+
+    def __init__(self):
+        self.path = os.environ.get('BENCH_DOCKER_STATE', os.path.expanduser('~/.bench-docker.json'))
+
+    def __enter__(self) -> dict:
+        self.fil = open(self.path, 'a+', encoding='utf-8')
+        fcntl.flock(self.fil, fcntl.LOCK_EX)
+        self.fil.seek(0)
+        content = self.fil.read()
+        self.data = json.loads(content) if content else {}
+        return self.data
+
+    def __exit__(self, *exc):
+        self.fil.seek(0)
+        self.fil.truncate()
+        json.dump(self.data, self.fil)
+        self.fil.close()
+
+def _compose_images(directory: str) -> list:
+    path = os.path.join(directory, 'docker-compose.yml')
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as fil:
+        return [line.split('image:', 1)[1].strip() for line in fil if 'image:' in line]
+
+def _install(args: list):
+    env = dict(arg.split('=', 1) for prev, arg in zip(args, args[1:]) if prev == '-e' and '=' in arg)
+    host_path = env.get('INSTALL_HOST_PATH', '.')
+    settings = {}
+    with open(os.path.join(host_path, env.get('INPUT_FILE', 'ct_controller.yml')), 'r', encoding='utf-8') as fil:
+        for line in fil:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                settings[key.strip()] = value.strip()
+    time.sleep(_seconds('BENCH_INSTALL_SECONDS'))
+    run_dir = os.path.join(host_path, settings.get('install_dir', 'ct_run'))
+    os.makedirs(os.path.join(run_dir, 'output'), exist_ok=True)
+    version = settings.get('ct_version', 'latest')
+    with open(os.path.join(run_dir, 'docker-compose.yml'), 'w', encoding='utf-8') as fil:
+        fil.write('services:\n')
+        for service in ['engine', 'image_generating_plugin', 'image_scoring_plugin']:
+            fil.write(f'  {service}:\n    image: tapis/camera_traps_{service}:{version}\n')
+    print(f'Installed camera traps {version} into {run_dir}')
+
+def _compose(args: list):
+    project = os.getcwd()
+    if args[:1] == ['pull']:
+        time.sleep(_seconds('BENCH_PULL_SECONDS'))
+    elif args[:1] == ['config']:
+        print('\n'.join(_compose_images(project)))
+    elif args[:1] == ['up']:
+        images = _compose_images(project)
+        with _State() as state:
+            state[project] = images
+        try:
+            end = time.monotonic() + _seconds('BENCH_APP_SECONDS')
+            count = 0
+            while time.monotonic() < end:
+                count += 1
+                print(f'engine | scored image {count}', flush=True)
+                time.sleep(min(1, max(end - time.monotonic(), 0)))
+            with open(os.path.join(project, 'output', 'scores.txt'), 'w', encoding='utf-8') as fil:
+                fil.write(f'{count} images scored\n')
+        finally:
+            with _State() as state:
+                state.pop(project, None)
+    elif args[:1] == ['down']:
+        with _State() as state:
+            state.pop(project, None)
+
+def docker(args: list):
+    """Emulates the docker commands run by the controller."""
+    if args[:1] == ['compose']:
+        _compose(args[1:])
+    elif args[:1] == ['pull']:
+        time.sleep(_seconds('BENCH_PULL_SECONDS'))
+        print(f'Status: Image is up to date for {args[-1]}')
+    elif args[:1] == ['run']:
+        _install(args[1:])
+    elif args[:1] == ['ps']:
+        with _State() as state:
+            images = [image for project in state.values() for image in project]
+        if 'status=exited' in args:
+            images = []
+        if '{{.ID}} {{.Image}}' in args:
+            images = [f'{index:012x} {image}' for index, image in enumerate(images)]
+        print('\n'.join(images))
+    elif args[-1:] == ['-f'] and 'prune' in args:
+        print('Total reclaimed space: 0B')
+
+def curl(args: list):
+    """Answers the requests the controller makes with curl."""
+    url = args[-1]
+    if 'api.github.com' in url:
+        print(json.dumps([{'name': 'bench'}]))
+    elif '169.254.169.254' in url:
+        print(json.dumps({'chameleon': {'node': os.environ.get('BENCH_NODE_ID', '')}}))
+
+def jq(args: list):
+    """Applies a .a.b filter to the JSON read from stdin."""
+    value = json.load(sys.stdin)
+    path = next(arg for arg in args if arg.startswith('.'))
+    for key in filter(None, path.split('.')):
+        value = value.get(key) if isinstance(value, dict) else None
+    print(json.dumps(value))
+
+def hostname(_args: list):
+    print(os.environ.get('BENCH_HOSTNAME', socket.gethostname()))
+
+if __name__ == '__main__':
+    globals()[sys.argv[1]](sys.argv[2:])
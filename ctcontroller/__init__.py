@@ -5,11 +5,11 @@ This package exposes:
 (2) VERSION: the version of the ctcontroller package
 """
 
-from .ct_main import main
-
 VERSION = "0.3"
 
 def run():
     """Calls the ctcontroller main function"""
 
+    # imported here so that importing the package stays cheap
+    from .ct_main import main  # pylint: disable=import-outside-toplevel
     main()
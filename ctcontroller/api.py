@@ -1,29 +1,50 @@
 import json
+import time
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, create_model, field_validator, model_validator
 from datetime import datetime, timedelta
 from typing import Dict, Optional
 from os import environ
-from .local import LocalRunner
+from .local import local_cpu_arch
 from .util import ApplicationException, ProvisionException, Status
-from .ct_main import setup, shutdown
+from .operations import MAX_RUNS, Operation, OperationRegistry, phase
+from .log_responses import MAX_READ, log_download, log_read
+from .log_stream import format_sse, format_text
+from .log_hub import LogHub
+from .jobs import HEALTH_INTERVAL, Job, JobRegistry
+from .state_store import get_store
+from .tracing import TRACER, job_context
+from .warm_pool import get_pool
+from .ct_main import fail_setup, release, release_hardware, setup, shutdown
 
 LOGGER = logging.getLogger("CT Controller")
 
-app = FastAPI()
+# Longest time in seconds a /health request can wait for a status change
+MAX_HEALTH_WAIT = 300
 
-localrunner = LocalRunner()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    restore_jobs()
+    pool = get_pool()
+    if pool.enabled:
+        pool.start()
+    yield
+    pool.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 class ControllerOptions(BaseModel):
-    node_type: Optional[str] = localrunner.cpu_arch
+    node_type: Optional[str] = local_cpu_arch()
     gpu: Optional[bool] = False
     ssh_key: Optional[str] = None
     key_name: Optional[str] = None
     target_user: Optional[str] = None
     job_id: Optional[str] = None
+    priority: Optional[int] = None
 
 class AppOptions(BaseModel):
     model: Optional[str] = None
@@ -43,59 +64,47 @@ class AppOptions(BaseModel):
         return values
 
 
-class CTControllerState:
-    def __init__(self):
-        self.controller = None
-        self.provisioner = None
-        self.appmanager = None
-
-    def get_status(self):
-        if self.controller == None:
-            return {'hardware': Status.PENDING.name, 'app': Status.PENDING.name}
-        return {'hardware': self.provisioner.get_status().name, 'app': self.appmanager.get_status().name}
-
-state = CTControllerState()
-
-async def stream_app_files(fnames):
-    pos = [0] * len(fnames)
-    done = [False] * len(fnames)
-    
-    while not all(done):
-        for i, fname in enumerate(fnames):
-            if done[i]:
-                continue
-            with open(filename, "rb") as f:
-                f.seek(pos[i])
-                chunk = f.read(1024)
-                if chunk:
-                    yield chunk
-                    pos[i] += len(chunk)
-                await asyncio.sleep(loop_interval)
-
-                last_check += loop_interval
-                if last_check >= poll_interval:
-                    last_check = 0.0
-                    if state.appmanager.status != Status.RUNNING:
-                        break
-
-
-@app.post('/run', summary='Run the application')
-async def run_api():
-    """
-    After the application has been configured, this endpoint launches the application.
-    """
-    if state.get_status()['hardware'] != Status.READY.name:
-        return {'message': 'ctcontroller has not been started up properly'}
-    elif state.get_status() == {'hardware': Status.READY.name, 'app': Status.READY.name}:
-        asyncio.create_task(run_task())
-        return {'message': 'started application'}
-    elif state.get_status() == {'hardware': Status.READY.name, 'app': Status.RUNNING.name}:
-        return {'message': 'application already running'}
-    else:
-        return {'message': f'application not ready, currently {state.get_status()["app"]}. Run stop/configure to resolve the issue.'}
+jobs = JobRegistry()
+
+operations = OperationRegistry(pools={'run': MAX_RUNS})
+
+def default_job() -> Job:
+    """Returns the job managed by the endpoints that are not scoped to a job."""
+    return jobs.default
 
-async def run_task():
-    await asyncio.to_thread(run, state.provisioner, state.appmanager)
+def scoped_job(job_id: str) -> Job:
+    """Returns the job named in the path, or responds 404 if it does not exist."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} not found')
+    return job
+
+def new_scoped_job(job_id: str) -> Job:
+    """
+    Returns the job named in the path, creating it if it does not exist.
+    Only /startup creates jobs; the other endpoints respond 404 for an unknown job.
+    """
+    return jobs.get_or_create(job_id)
+
+async def stream_app_files(hub: LogHub, fmt, policy: str='skip'):
+    """
+    Subscribes to the application log hub until the application leaves RUNNING,
+    formatting each batch of lines with fmt.
+    """
+    sub = hub.subscribe(policy)
+    try:
+        async for tag, data in sub:
+            yield fmt(tag, data)
+        if sub.dropped:
+            yield fmt('dropped', b'client too slow\n')
+    finally:
+        hub.unsubscribe(sub)
+
+async def stream_app_events(job: Job, policy: str='skip'):
+    """Streams the application logs as Server-Sent Events, ending with an `end` event."""
+    async for chunk in stream_app_files(job.log_hub(), format_sse, policy):
+        yield chunk
+    yield f'event: end\ndata: {job.appmanager.status.name}\n\n'.encode()
 
 def run(provisioner, appmanager):
     try:
@@ -106,44 +115,77 @@ def run(provisioner, appmanager):
         appmanager.shutdown_job()
         provisioner.shutdown_instance()
         raise
-   
-# Provisions the hardware and prepares the app for deployment
-@app.post('/startup', summary='Starts up ctcontroller')
-def startup(options: ControllerOptions=ControllerOptions()):
-    """
-    Starts up the ctcontroller.
-    Provisions the hardware and cleans up any previous jobs, preparing the run directory for a new job.
-    """
-    state.controller, state.provisioner, state.appmanager = setup_api(options.model_dump())
-    return {'message': 'ctcontroller is ready'}
 
-def setup_api(options: dict=None):
-    controller, provisioner, appmanager = setup(options=options, job_local_log=True)
+def startup_task(job: Job, options: dict, operation: Operation):
+    try:
+        controller, provisioner, appmanager = setup_api(options, operation)
+    except Exception:
+        # a job that failed or was cancelled while starting up is forgotten, its startup
+        # operation keeps the error
+        with job.lock:
+            if job.controller is None:
+                jobs.release(job)
+        raise
+    finally:
+        # the job leaves SETTINGUP whether or not the startup succeeded
+        job.status_changed()
+    with job.lock:
+        job.job_id = controller.provisioner_config['job_id']
+        job.attach(controller, provisioner, appmanager)
+    get_store().set_scope(job.job_id, 'default' if job is jobs.default else 'job')
+
+def setup_api(options: dict=None, operation: Operation=None):
+    controller, provisioner, appmanager = setup(options=options, job_local_log=True, operation=operation)
     try:
         #appmanager.setup_app()
-        appmanager.cleanup_environment()
-    except ApplicationException as e:
-        LOGGER.exception(e.msg)
-        appmanager.shutdown_job()
-        provisioner.shutdown_instance()
+        if getattr(appmanager, 'restored', False) and appmanager.status in [Status.READY, Status.RUNNING]:
+            # reattached to a configured application, keep its run directory
+            LOGGER.info(f'Reattached to application in status {appmanager.status.name}')
+        else:
+            with phase(operation, 'cleanup_environment'):
+                appmanager.cleanup_environment()
+    except Exception as e:
+        LOGGER.exception(getattr(e, 'msg', e))
+        try:
+            appmanager.shutdown_job()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            LOGGER.exception(f'Could not shut down the application of the failed job: {getattr(err, "msg", err)}')
+        fail_setup(provisioner)
         raise
     return controller, provisioner, appmanager
 
-
-@app.post('/stop', summary='Stops the app.')
-def stop():
+def restore_jobs():
     """
-    Shuts down the app and copies over any logs to the log directory
+    Picks up the jobs recorded in the state store by a previous run of the server.
+    Jobs whose hardware was provisioned are started up again, reattaching to their
+    resources, and jobs that were being shut down are released.
     """
+    for record in get_store().active():
+        job_id = record['job_id']
+        options = dict(record['options'] or {}, job_id=job_id)
+        if record['hardware_status'] == Status.SHUTTINGDOWN.name:
+            operations.submit(Operation('release', job_id=job_id), release, options)
+            continue
+        if record['scope'] == 'default' and jobs.default.job_id is None:
+            job = jobs.default
+            job.job_id = job_id
+        else:
+            job = jobs.get_or_create(job_id)
+        LOGGER.info(f'Restoring job {job_id}')
+        operation = Operation('restore', job_id=job_id)
+        job.operation = operations.submit(operation, startup_task, job, options, operation)
+        job.status_changed()
+
+def stop_app(job: Job) -> dict:
     msg = ''
     try:
-        state.appmanager.stop_app()
+        job.appmanager.stop_app()
     except ApplicationException as e:
         msg = f'Error while stopping app: {e}. '
     else:
         msg += 'stopped app. '
     try:
-        state.appmanager.copy_results()
+        job.appmanager.copy_results()
     except ApplicationException as e:
         msg += f'Error while copying results: {e}. '
     else:
@@ -151,87 +193,315 @@ def stop():
 
     return {'message': msg}
 
-@app.post('/configure', summary='Configures the app')
-def configure(options: AppOptions=AppOptions()):
-    """
-    Uses the submitted configurations to generate a config yaml and generate
-    the run directory.
-    """
-    if state.controller is None:
-        return {'message': 'ctcontroller needs to be started first'}
-    state.controller.update_application_config(options.model_dump())
-    if state.appmanager.update_config(state.controller.application_config):
-        state.appmanager.configure_app()
-        return {'message': 'app configured'}
-    else:
-        return {'message': 'app configuration did not change'}
+def require_app(job: Job):
+    """Responds 409 if the job has not been started up yet."""
+    if job.appmanager is None:
+        raise HTTPException(status_code=409, detail='ctcontroller needs to be started first')
 
-@app.get('/health', summary='Gets the status.')
-def health():
-    """
-    Gets the status of the hardware and app.
+def job_routes(get_job, get_startup_job) -> APIRouter:
     """
-    return {'status': state.get_status()}
+    Creates the endpoints controlling one job.
+    They are mounted once for the default job and once under `/jobs/{job_id}`.
 
-@app.get('/dl_config', summary='Get config.yaml')
-def config():
-    """
-    Downloads the latest configuration file used to build the run directory
-    """
-    return FileResponse(path=f'{state.appmanager.log_dir}/ct_controller.yml', media_type='application/x-yaml', filename='config.yaml')
+        Parameters:
+            get_job (callable): dependency returning the job the request is about
+            get_startup_job (callable): dependency returning the job to start up, which may
+                                        be created by the request
 
-@app.get('/controller_logs/download', summary='Get controller logs')
-def dl_controller_logs():
-    """
-    Downloads the logs of the controller.
-    Note: This does not include application logs.
+        Returns:
+            APIRouter: the job endpoints
     """
-    return FileResponse(path=f'{state.controller.log_directory}/run.log', media_type='text/plain', filename='controller.log')
 
-@app.get('/app_logs/download/stdout', summary='Get application stdout')
-def dl_app_out_logs():
+    router = APIRouter()
+
+    @router.post('/run', summary='Run the application')
+    def run_api(job: Job = Depends(get_job)):
+        """
+        After the application has been configured, this endpoint launches the application.
+        The application runs in the background; the returned operation id can be followed at
+        `/operations/{operation_id}`.
+        """
+        with job.lock:
+            status = job.refresh_status()
+            if status['hardware'] != Status.READY.name:
+                return {'message': 'ctcontroller has not been started up properly'}
+            elif status['app'] == Status.RUNNING.name or job.running():
+                return {'message': 'application already running'}
+            elif status['app'] == Status.READY.name:
+                operation = Operation('run', job_id=job.job_id)
+                job.run_operation = operations.submit(operation, run, job.provisioner, job.appmanager)
+                return {'message': 'started application', 'operation_id': operation.id}
+            else:
+                return {'message': f'application not ready, currently {status["app"]}. Run stop/configure to resolve the issue.'}
+
+    # Provisions the hardware and prepares the app for deployment
+    @router.post('/startup', summary='Starts up ctcontroller', status_code=202)
+    def startup(options: ControllerOptions=ControllerOptions(), job: Job = Depends(get_startup_job)):
+        """
+        Starts up the ctcontroller in the background.
+        Provisions the hardware and cleans up any previous jobs, preparing the run directory for a new job.
+        Returns immediately with the id of the startup operation, whose progress can be followed at
+        `/operations/{operation_id}` and which can be cancelled at `/operations/{operation_id}/cancel`.
+        """
+        with job.lock:
+            if job.controller is not None:
+                return {'message': 'ctcontroller is already started'}
+            if job.starting():
+                return {'message': 'ctcontroller is already starting up', 'operation_id': job.operation.id}
+            if job.job_id is not None:
+                options.job_id = job.job_id
+            operation = Operation('startup', job_id=options.job_id)
+            job.operation = operations.submit(operation, startup_task, job, options.model_dump(), operation)
+            job.status_changed()
+            return {'message': 'ctcontroller is starting up', 'operation_id': operation.id}
+
+    @router.post('/stop', summary='Stops the app.')
+    def stop(job: Job = Depends(get_job)):
+        """
+        Shuts down the app and copies over any logs to the log directory
+        """
+        require_app(job)
+        with job.lock, job_context(job.job_id):
+            return stop_app(job)
+
+    @router.post('/configure', summary='Configures the app')
+    def configure(options: AppOptions=AppOptions(), job: Job = Depends(get_job)):
+        """
+        Uses the submitted configurations to generate a config yaml and generate
+        the run directory.
+        """
+        with job.lock, job_context(job.job_id):
+            if job.controller is None:
+                return {'message': 'ctcontroller needs to be started first'}
+            job.controller.update_application_config(options.model_dump())
+            if job.appmanager.update_config(job.controller.application_config):
+                job.appmanager.configure_app()
+                return {'message': 'app configured'}
+            else:
+                return {'message': 'app configuration did not change'}
+
+    @router.get('/health', summary='Gets the status.')
+    async def health(request: Request,
+                     wait: Optional[float] = Query(None, ge=0, le=MAX_HEALTH_WAIT,
+                                                   description='seconds to wait for the status to change'),
+                     job: Job = Depends(get_job)):
+        """
+        Gets the status of the hardware and app.
+        The response carries an ETag that changes with the status. A request with a matching
+        If-None-Match header gets 304 Not Modified. With `wait`, the request blocks until the
+        status differs from the one in If-None-Match (or from the current one) or `wait`
+        seconds have passed, so clients can long-poll for changes.
+        """
+        version = job.versions.version
+        status = await asyncio.to_thread(job.refresh_status)
+        etag = job.etag()
+        seen = request.headers.get('if-none-match')
+        if wait:
+            baseline = seen or etag
+            deadline = time.monotonic() + wait
+            while etag == baseline:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # a watched run publishes its status changes; otherwise wake up periodically to
+                # check the application health on the node
+                await job.versions.wait(version, remaining if job.watched() else min(remaining, HEALTH_INTERVAL))
+                version = job.versions.version
+                status = await asyncio.to_thread(job.refresh_status)
+                etag = job.etag()
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if seen == etag:
+            return Response(status_code=304, headers=headers)
+        return JSONResponse({'status': status}, headers=headers)
+
+    @router.get('/timings', summary='Get the time spent in each phase')
+    def timings(detail: bool = False, job: Job = Depends(get_job)):
+        """
+        Summarizes where the time of the job went: for each phase of the workflow (provisioning
+        steps, commands run on the node, file transfers and application phases) the number of
+        times it ran, how many failed, and its total, mean, maximum and latest duration in
+        seconds. With `detail=true` the most recent spans are included.
+        """
+        if job.job_id is None:
+            raise HTTPException(status_code=409, detail='ctcontroller needs to be started first')
+        return TRACER.timings(job.job_id, detail=detail)
+
+    @router.get('/history', summary='Get the status transitions')
+    def history(job: Job = Depends(get_job)):
+        """
+        Lists the latest changes of status of the hardware and the application, oldest first,
+        each with the previous and new status, when it happened, and whether it was an allowed
+        transition.
+        """
+        return job.history()
+
+    @router.get('/dl_config', summary='Get config.yaml')
+    def config(job: Job = Depends(get_job)):
+        """
+        Downloads the latest configuration file used to build the run directory
+        """
+        require_app(job)
+        return FileResponse(path=f'{job.appmanager.log_dir}/ct_controller.yml', media_type='application/x-yaml', filename='config.yaml')
+
+    @router.get('/controller_logs/download', summary='Get controller logs')
+    def dl_controller_logs(request: Request, job: Job = Depends(get_job)):
+        """
+        Downloads the logs of the controller.
+        Supports HTTP Range requests and gzip transfer encoding.
+        Note: This does not include application logs.
+        """
+        if job.controller is None:
+            raise HTTPException(status_code=409, detail='ctcontroller needs to be started first')
+        return log_download(request, f'{job.controller.log_directory}/run.log', 'controller.log')
+
+    @router.get('/app_logs/download/stdout', summary='Get application stdout')
+    def dl_app_out_logs(request: Request, job: Job = Depends(get_job)):
+        """
+        Downloads the application logs.
+        Supports HTTP Range requests and gzip transfer encoding.
+        """
+        require_app(job)
+        return log_download(request, job.app_log_paths()['stdout'], 'ct_out.log')
+
+    @router.get('/app_logs/download/stderr', summary='Get application stderr')
+    def dl_app_err_logs(request: Request, job: Job = Depends(get_job)):
+        """
+        Downloads the application logs.
+        Supports HTTP Range requests and gzip transfer encoding.
+        """
+        require_app(job)
+        return log_download(request, job.app_log_paths()['stderr'], 'ct_err.log')
+
+    @router.get('/app_logs', summary='Read part of the application logs')
+    def read_app_logs(request: Request,
+                      stream: str = Query('stdout', pattern='^(stdout|stderr)$'),
+                      offset: Optional[int] = Query(None, ge=0, description='logical offset of the first byte'),
+                      limit: int = Query(1048576, gt=0, le=MAX_READ, description='maximum number of bytes'),
+                      tail: Optional[int] = Query(None, gt=0, description='number of lines from the end'),
+                      job: Job = Depends(get_job)):
+        """
+        Returns part of the application stdout or stderr: either the last `tail` lines or up to
+        `limit` bytes starting at `offset`. The X-Log-Next-Offset header can be passed back as
+        `offset` to continue reading.
+        """
+        require_app(job)
+        return log_read(request, job.app_log_paths()[stream], offset=offset, limit=limit, tail=tail)
+
+    @router.get('/app_logs/stream', summary='Stream application output')
+    async def stream_app_out(slow: str = Query('skip', pattern='^(skip|drop)$'), job: Job = Depends(get_job)):
+        """
+        Streams application stdout and stderr as a StreamingResponse until the application
+        stops running. Each line is prefixed with the stream it came from, e.g. `[stdout] `.
+        New viewers first receive the most recent output. Viewers that fall behind are skipped
+        ahead (`slow=skip`) or disconnected (`slow=drop`).
+        """
+        require_app(job)
+        return StreamingResponse(stream_app_files(job.log_hub(), format_text, slow), media_type="text/plain")
+
+    @router.get('/app_logs/events', summary='Stream application output as Server-Sent Events')
+    async def stream_app_sse(slow: str = Query('skip', pattern='^(skip|drop)$'), job: Job = Depends(get_job)):
+        """
+        Streams application stdout and stderr as Server-Sent Events until the application
+        stops running. The event type is the stream (`stdout` or `stderr`), `skipped` when
+        output was discarded for a slow viewer, and a final `end` event carries the
+        application status.
+        """
+        require_app(job)
+        return StreamingResponse(stream_app_events(job, slow), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @router.websocket('/app_logs/ws')
+    async def stream_app_ws(websocket: WebSocket, slow: str = 'drop', job: Job = Depends(get_job)):
+        """
+        Streams application stdout and stderr over a WebSocket as JSON messages of the form
+        `{"stream": "stdout", "data": "..."}`. Viewers that fall behind are disconnected with
+        code 1013 (`slow=drop`) or skipped ahead (`slow=skip`).
+        """
+        await websocket.accept()
+        if job.appmanager is None or slow not in ['skip', 'drop']:
+            await websocket.close(code=1008)
+            return
+        hub = job.log_hub()
+        sub = hub.subscribe(slow)
+        try:
+            async for tag, data in sub:
+                await websocket.send_json({'stream': tag, 'data': data.decode('utf-8', errors='replace')})
+            if sub.dropped:
+                await websocket.close(code=1013, reason='client too slow')
+            else:
+                await websocket.close()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            hub.unsubscribe(sub)
+
+    @router.post('/shutdown', summary='Shuts down controller')
+    def shutdown_endpoint(job: Job = Depends(get_job)):
+        """
+        Performs a full shut down the application.
+        This includes:
+          - stopping the application
+          - copying output directory to log directory,
+          - deleting run directory
+          - deprovisioning hardware, or keeping it in the warm pool for the next job
+        """
+        with job.lock, job_context(job.job_id):
+            hardware_status = job.refresh_status()['hardware']
+            if hardware_status == Status.READY.name:
+                msg = stop_app(job)
+                job.appmanager.remove_app()
+                release_hardware(job.provisioner)
+                jobs.release(job)
+                msg['message'] += 'shutdown complete'
+                return msg
+            elif hardware_status == Status.PENDING.name:
+                return {'message': 'hardware and app not yet started'}
+            else:
+                return {'message': 'already shutdown'}
+
+    return router
+
+@app.get('/jobs', summary='List jobs')
+def list_jobs():
     """
-    Downloads the application logs.
+    Lists the jobs managed by this server and their status.
+    Each job is controlled through the endpoints under `/jobs/{job_id}`, e.g.
+    `/jobs/{job_id}/startup`, `/jobs/{job_id}/run` or `/jobs/{job_id}/health`.
     """
-    return FileResponse(path=f'{state.appmanager.log_dir}/ct_out.log', media_type='text/plain', filename='ct_out.log')
+    return {'jobs': [job.to_dict() for job in jobs.list()]}
 
-@app.get('/app_logs/download/stderr', summary='Get application stderr')
-def dl_app_err_logs():
+@app.get('/operations', summary='List background operations')
+def list_operations(job_id: Optional[str] = None):
     """
-    Downloads the application logs.
+    Lists the background operations, such as startups and runs, and their progress,
+    optionally only those of one job.
     """
-    return FileResponse(path=f'{state.appmanager.log_dir}/ct_err.log', media_type='text/plain', filename='ct_err.log')
+    return {'operations': [op.to_dict() for op in operations.list(job_id)]}
 
-@app.get('/app_logs/stream', summary='Stream application output')
-def stream_app_out():
+@app.get('/operations/{operation_id}', summary='Get the progress of an operation')
+def get_operation(operation_id: str):
     """
-    Streams application output as a StreamingResponse
+    Gets the status of a background operation, the phase it is in, the time spent in each
+    phase and any error.
     """
-    return StreamingResponse(stream_app_files([f'{state.appmanager.log_dir}/ct_out.log', f'{state.appmanager.log_dir}/ct_err.log']), media_type="text/plain")
+    operation = operations.get(operation_id)
+    if operation is None:
+        raise HTTPException(status_code=404, detail=f'Operation {operation_id} not found')
+    return operation.to_dict()
 
-@app.post('/shutdown', summary='Shuts down controller')
-def shutdown_endpoint():
+@app.post('/operations/{operation_id}/cancel', summary='Cancel an operation')
+def cancel_operation(operation_id: str):
     """
-    Performs a full shut down the application.
-    This includes:
-      - stopping the application
-      - copying output directory to log directory,
-      - deleting run directory
-      - deprovisioning hardware
+    Cancels a background operation. The operation stops at the next phase or polling step and
+    releases any hardware it had already provisioned.
     """
-    global state
-    hardware_status = state.get_status()['hardware']
-    if hardware_status == Status.READY.name:
-        msg = stop()
-        state.appmanager.remove_app()
-        state.provisioner.shutdown_instance()
-        state.provisioner = None
-        state.appmanager = None
-        state.controller = None
-        msg['message'] += 'shutdown complete'
-        return msg
-    elif hardware_status == Status.PENDING.name:
-        return {'message': 'hardware and app not yet started'}
-    else:
-        return {'message': 'already shutdown'}
+    operation = operations.get(operation_id)
+    if operation is None:
+        raise HTTPException(status_code=404, detail=f'Operation {operation_id} not found')
+    if not operation.cancel():
+        raise HTTPException(status_code=409, detail=f'Operation {operation_id} has already finished')
+    return {'message': 'cancelling operation', 'operation_id': operation.id}
 
+# The unscoped endpoints control the default job, the scoped ones any job by id
+app.include_router(job_routes(default_job, default_job))
+app.include_router(job_routes(scoped_job, new_scoped_job), prefix='/jobs/{job_id}', tags=['jobs'])
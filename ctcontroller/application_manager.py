@@ -3,17 +3,24 @@ Contains the ApplicationManager class is a base class that defines basic functio
 managing an application on a remote server.
 """
 
-from .remote import RemoteRunner
-from .local import LocalRunner
+from typing import TYPE_CHECKING
 from .util import Status
+from .state_store import Persistent
 from os import makedirs
 
-class ApplicationManager():
+if TYPE_CHECKING:
+    from .remote import RemoteRunner
+    from .local import LocalRunner
+
+class ApplicationManager(Persistent):
     """
     A base class to manage the running of an application on a remote server.
     """
 
-    def __init__(self, runner: RemoteRunner | LocalRunner, log_dir: str, cfg, allow_attaching: bool):
+    STATE_COMPONENT = 'application'
+    STATE_ATTRIBUTES = ['status', 'run_dir']
+
+    def __init__(self, runner: 'RemoteRunner | LocalRunner', log_dir: str, cfg, allow_attaching: bool):
         makedirs(log_dir, exist_ok=True)
         self.runner = runner
         self.log_dir = log_dir
@@ -0,0 +1,384 @@
+"""
+Contains the benchmark sweep mode of ctcontroller.
+A benchmark takes a matrix of application and hardware settings, runs every combination
+through the provision-configure-run-collect workflow and writes a report comparing the
+throughput and energy usage of each combination.
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import logging
+import itertools
+from datetime import datetime
+from pathlib import Path
+import yaml
+from .camera_traps import CameraTrapsManager as AppManager
+from .util import ApplicationException, ControllerException, ProvisionException
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Axes that can be swept in a benchmark matrix
+MATRIX_KEYS = ['model', 'node_type', 'gpu', 'ct_version', 'advanced_app_vars']
+# Axes that require different hardware. Cells sharing these values reuse the same node.
+HARDWARE_KEYS = ['node_type', 'gpu']
+# Default regex used to count processed images in the application stdout
+DEFAULT_THROUGHPUT_PATTERN = r'(?i)scored image|image scored|scoring image'
+
+REPORT_FIELDS = ['cell', 'status', 'error'] + MATRIX_KEYS + \
+    ['duration', 'images', 'throughput', 'energy', 'avg_power', 'images_per_joule',
+     'throughput_vs_best', 'efficiency_vs_best']
+
+def load_matrix(path: str) -> dict:
+    """
+    Loads a benchmark description from a YAML file.
+    The file contains a `matrix` mapping each swept key to a list of values, optional
+    `settings` shared by every cell, and optional `metrics` options.
+
+        Parameters:
+            path (str): path to the benchmark description
+
+        Returns:
+            dict: the benchmark description
+    """
+
+    if not os.path.exists(path):
+        raise ControllerException(f'Benchmark file {path} not found')
+    with open(path, 'r', encoding='utf-8') as fil:
+        spec = yaml.safe_load(fil) or {}
+    matrix = spec.get('matrix')
+    if not isinstance(matrix, dict) or not matrix:
+        raise ControllerException(f'Benchmark file {path} does not define a matrix')
+    for key, values in matrix.items():
+        if key not in MATRIX_KEYS:
+            raise ControllerException(f'{key} cannot be swept in a benchmark. '
+                                      f'Valid keys are {", ".join(MATRIX_KEYS)}.')
+        if not isinstance(values, list):
+            matrix[key] = [values]
+    spec.setdefault('settings', {})
+    spec.setdefault('metrics', {})
+    return spec
+
+def expand_matrix(matrix: dict) -> list:
+    """
+    Expands a matrix into the list of cells to run.
+    The cells are ordered so that cells using the same hardware are adjacent.
+
+        Parameters:
+            matrix (dict): maps each swept key to a list of values
+
+        Returns:
+            list: one dictionary of settings per cell
+    """
+
+    keys = list(matrix.keys())
+    cells = [dict(zip(keys, values)) for values in itertools.product(*matrix.values())]
+    cells.sort(key=lambda cell: tuple(str(cell.get(key)) for key in HARDWARE_KEYS))
+    for i, cell in enumerate(cells):
+        cell['cell'] = i
+    return cells
+
+def hardware_key(cell: dict) -> tuple:
+    """Returns the hardware settings of a cell, used to group cells on one node."""
+
+    return tuple(cell.get(key) for key in HARDWARE_KEYS)
+
+def count_images(logfile: str, pattern: str) -> int:
+    """
+    Counts the lines of the application log that match pattern.
+
+        Parameters:
+            logfile (str): path to the application stdout log
+            pattern (str): regex matching a processed image
+
+        Returns:
+            int: number of processed images
+    """
+
+    regex = re.compile(pattern)
+    count = 0
+    if not os.path.exists(logfile):
+        return count
+    with open(logfile, 'r', encoding='utf-8', errors='replace') as fil:
+        for line in fil:
+            if regex.search(line):
+                count += 1
+    return count
+
+def _parse_time(val: str):
+    try:
+        return datetime.fromisoformat(val.strip()).timestamp()
+    except ValueError:
+        pass
+    try:
+        return float(val)
+    except ValueError:
+        return None
+
+def _to_float(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return 0.0
+
+def power_file_energy(path: str) -> float:
+    """
+    Integrates the power samples in a power monitor CSV file.
+    A `Total Power` column is used if present, otherwise every column whose name
+    contains "power" is summed. Timestamps are taken from the first column whose name
+    contains "date" or "time"; without one, samples are assumed to be one second apart.
+
+        Parameters:
+            path (str): path to the CSV output of the power monitor
+
+        Returns:
+            float: energy in joules
+    """
+
+    with open(path, 'r', encoding='utf-8', errors='replace') as fil:
+        reader = csv.DictReader(fil)
+        if not reader.fieldnames:
+            return 0.0
+        fields = [f.strip() for f in reader.fieldnames]
+        reader.fieldnames = fields
+        total = [f for f in fields if f.lower() == 'total power']
+        power_cols = total or [f for f in fields if 'power' in f.lower()]
+        time_col = next((f for f in fields if 'date' in f.lower() or 'time' in f.lower()), None)
+        energy = 0.0
+        last = None
+        for i, row in enumerate(reader):
+            power = sum(_to_float(row.get(col)) for col in power_cols)
+            stamp = _parse_time(row[time_col]) if time_col and row.get(time_col) else None
+            if stamp is None:
+                stamp = float(i)
+            if last is not None:
+                # trapezoidal integration of power over the sample interval
+                energy += (stamp - last[0]) * (power + last[1]) / 2
+            last = (stamp, power)
+    return energy
+
+def collect_energy(results_dir: str) -> float:
+    """
+    Sums the energy recorded by every power monitor output file in the copied run directory.
+
+        Parameters:
+            results_dir (str): local copy of the run directory
+
+        Returns:
+            float or None: energy in joules or None if no power monitor output was found
+    """
+
+    files = [p for p in Path(results_dir).rglob('*.csv') if 'power' in str(p).lower()]
+    if not files:
+        return None
+    return sum(power_file_energy(str(f)) for f in files)
+
+def compare(results: list) -> None:
+    """
+    Adds the throughput and efficiency of each successful cell relative to the best cell.
+
+        Parameters:
+            results (list): the results of every cell
+    """
+
+    done = [res for res in results if res['status'] == 'COMPLETE']
+    best_throughput = max((res['throughput'] or 0 for res in done), default=0)
+    best_efficiency = max((res['images_per_joule'] or 0 for res in done), default=0)
+    for res in done:
+        if best_throughput:
+            res['throughput_vs_best'] = round((res['throughput'] or 0) / best_throughput, 4)
+        if best_efficiency and res['images_per_joule'] is not None:
+            res['efficiency_vs_best'] = round(res['images_per_joule'] / best_efficiency, 4)
+
+def write_report(results: list, report_dir: str) -> tuple:
+    """
+    Writes the benchmark results as CSV and JSON.
+
+        Parameters:
+            results (list): the results of every cell
+            report_dir (str): directory where the report is written
+
+        Returns:
+            tuple: paths to the CSV and JSON reports
+    """
+
+    os.makedirs(report_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    csv_path = os.path.join(report_dir, f'benchmark-{stamp}.csv')
+    json_path = os.path.join(report_dir, f'benchmark-{stamp}.json')
+    with open(csv_path, 'w', encoding='utf-8', newline='') as fil:
+        writer = csv.DictWriter(fil, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for res in results:
+            row = dict(res)
+            if isinstance(row.get('advanced_app_vars'), dict):
+                row['advanced_app_vars'] = json.dumps(row['advanced_app_vars'])
+            writer.writerow(row)
+    done = [res for res in results if res['status'] == 'COMPLETE']
+    summary = {
+        'cells': results,
+        'best_throughput': max(done, key=lambda res: res['throughput'] or 0)['cell'] if done else None,
+        'best_efficiency': max(done, key=lambda res: res['images_per_joule'] or 0)['cell'] if done else None,
+    }
+    with open(json_path, 'w', encoding='utf-8') as fil:
+        json.dump(summary, fil, indent=2, default=str)
+    LOGGER.info(f'Benchmark report written to {csv_path} and {json_path}')
+    return csv_path, json_path
+
+class BenchmarkRunner():
+    """
+    Runs every cell of a benchmark matrix and collects the results.
+    Cells that share the same hardware are run one after another on a single provisioned
+    node, which is only released once all of them have completed.
+
+    Attributes:
+        spec (dict): the benchmark description
+        cells (list): the cells of the expanded matrix
+        results (list): the results of the cells that have been run
+
+    Methods:
+        run():
+            Runs all cells and writes the report.
+        run_group(cells):
+            Provisions hardware for a group of cells and runs them.
+        run_cell(cell, controller, runner, allow_attaching):
+            Configures, runs and collects the results of a single cell.
+    """
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.cells = expand_matrix(spec['matrix'])
+        self.pattern = spec['metrics'].get('throughput_pattern', DEFAULT_THROUGHPUT_PATTERN)
+        self.results = []
+
+    def run(self):
+        """Runs all cells, grouped by hardware, and writes the report."""
+
+        for _, group in itertools.groupby(self.cells, key=hardware_key):
+            self.run_group(list(group))
+        compare(self.results)
+        report_dir = (self.spec['settings'].get('output_dir')
+                      or os.environ.get('CT_CONTROLLER_OUTPUT_DIR', './output'))
+        return write_report(self.results, report_dir)
+
+    def _failed(self, cell, error):
+        res = self._result(cell)
+        res['status'] = 'FAILED'
+        res['error'] = str(error)
+        return res
+
+    def _clean(self, ctmanager):
+        for step in [lambda: ctmanager.stop_app(ignore_failure=True), ctmanager.remove_app]:
+            try:
+                step()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.warning(f'Could not clean up after the cell: {getattr(e, "msg", e)}')
+
+    def _result(self, cell):
+        res = {key: cell.get(key) for key in ['cell'] + MATRIX_KEYS}
+        res.update({'status': None, 'error': None, 'duration': None, 'images': None,
+                    'throughput': None, 'energy': None, 'avg_power': None,
+                    'images_per_joule': None, 'throughput_vs_best': None,
+                    'efficiency_vs_best': None})
+        return res
+
+    def run_group(self, cells: list):
+        """
+        Provisions the hardware shared by a group of cells, runs each cell on it and
+        releases the hardware.
+
+            Parameters:
+                cells (list): cells sharing the same hardware settings
+        """
+
+        from .ct_main import setup  # pylint: disable=import-outside-toplevel
+
+        options = dict(self.spec['settings'])
+        options.update({key: cells[0][key] for key in HARDWARE_KEYS if key in cells[0]})
+        LOGGER.info(f'Provisioning hardware for benchmark cells {[c["cell"] for c in cells]}')
+        try:
+            controller, provisioner, ctmanager = setup(options=options, job_local_log=True)
+        except (ProvisionException, ApplicationException, ControllerException) as e:
+            self.results.extend(self._failed(cell, e.msg) for cell in cells)
+            return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # e.g. an SSH error or OSError while provisioning, the other groups are still run
+            LOGGER.exception(f'Provisioning failed: {e}')
+            self.results.extend(self._failed(cell, e) for cell in cells)
+            return
+        try:
+            for cell in cells:
+                self.results.append(self.run_cell(cell, controller, ctmanager.runner,
+                                                  provisioner.allow_attaching))
+        finally:
+            try:
+                provisioner.shutdown_instance()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.exception(f'Could not release the hardware of cells {[c["cell"] for c in cells]}: '
+                                 f'{getattr(e, "msg", e)}')
+
+    def run_cell(self, cell: dict, controller, runner, allow_attaching: bool) -> dict:
+        """
+        Configures and runs the application for a single cell, then copies its results
+        and measures the throughput and energy.
+
+            Parameters:
+                cell (dict): the settings of the cell
+                controller (Controller): the controller of the hardware group
+                runner (RemoteRunner|LocalRunner): runner attached to the provisioned node
+                allow_attaching (bool): whether the provisioner allows attaching to a
+                                        running application
+
+            Returns:
+                dict: the results of the cell
+        """
+
+        res = self._result(cell)
+        cfg = dict(controller.application_config)
+        cfg.update({key: cell[key] for key in MATRIX_KEYS if key in cell})
+        log_dir = f'{controller.log_directory}/{cfg["job_id"]}/cell-{cell["cell"]}'
+        LOGGER.info(f'Running benchmark cell {cell["cell"]}: {cfg}')
+        ctmanager = None
+        try:
+            ctmanager = AppManager(runner, log_dir=log_dir, cfg=cfg, allow_attaching=allow_attaching)
+            # the images are pulled during setup, so that only the run itself is timed
+            ctmanager.setup_app()
+            start = time.monotonic()
+            ctmanager.run_app(pull=False)
+            duration = time.monotonic() - start
+            ctmanager.copy_results()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # a failing cell, whatever the error, is reported and the sweep goes on
+            LOGGER.exception(getattr(e, 'msg', e))
+            return self._failed(cell, getattr(e, 'msg', e))
+        finally:
+            # the next cell runs on the same node, so none of this cell's containers or
+            # files are left behind
+            if ctmanager is not None:
+                self._clean(ctmanager)
+        images = count_images(f'{log_dir}/ct_out.log', self.pattern)
+        energy = collect_energy(log_dir)
+        res['status'] = 'COMPLETE'
+        res['duration'] = round(duration, 3)
+        res['images'] = images
+        res['throughput'] = round(images / duration, 4) if duration > 0 else None
+        if energy:
+            res['energy'] = round(energy, 3)
+            res['avg_power'] = round(energy / duration, 3) if duration > 0 else None
+            res['images_per_joule'] = round(images / energy, 6)
+        return res
+
+def run_benchmark(path: str):
+    """
+    Runs the benchmark described in the YAML file at path.
+
+        Parameters:
+            path (str): path to the benchmark description
+
+        Returns:
+            tuple: paths to the CSV and JSON reports
+    """
+
+    return BenchmarkRunner(load_matrix(path)).run()
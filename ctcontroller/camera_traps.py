@@ -12,14 +12,22 @@ import filecmp
 import tempfile
 from textwrap import dedent
 from pathlib import Path
-import validators
+from typing import TYPE_CHECKING
 from .application_manager import ApplicationManager
-from .remote import RemoteRunner
-from .local import LocalRunner
-from .util import ApplicationException, capture_shell, Status
+from .util import ApplicationException, ControllerException, capture_shell, Status
+from .logfiles import rotation_settings
+from .tracing import traced
+
+if TYPE_CHECKING:
+    from .remote import RemoteRunner
+    from .local import LocalRunner
 
 LOGGER = logging.getLogger("CT Controller")
 
+def app_attributes(manager, *args, **kwargs) -> dict:
+    """Span attributes of the application phases."""
+    return {'host': manager.runner.ip_address, 'version': manager.version, 'mode': manager.mode}
+
 
 # Class to manage the camera traps application on a remote node
 class CameraTrapsManager(ApplicationManager):
@@ -39,6 +47,7 @@ class CameraTrapsManager(ApplicationManager):
         input (str): 
         allow_attaching (bool): whether to allow attaching to an existing run of camera traps
         advanced (dict): a key-pair of advanced runtime options for camera traps
+        tracking (bool): whether run_app is following a run of camera traps in this process
 
     Methods:
         generate_cfg_file(rmt_path): 
@@ -59,10 +68,10 @@ class CameraTrapsManager(ApplicationManager):
         get_running_images():
         stop_running_containers():
         get_application_health():
-        get_status(): Updates the status of the jb
+        get_status(): Updates the status of the job from the health of the application
     """
 
-    def __init__(self, runner: RemoteRunner | LocalRunner, log_dir: str, cfg, allow_attaching: bool):
+    def __init__(self, runner: 'RemoteRunner | LocalRunner', log_dir: str, cfg, allow_attaching: bool):
         """
         Constructions all necessary attributes for a CameraTrapsManager object
             
@@ -77,6 +86,7 @@ class CameraTrapsManager(ApplicationManager):
 
         self.update_config(cfg)
         self.keywords = ['tapis', 'icicle', 'iud2i']
+        self.tracking = False
 
     def parse_model(self, model):
         if '.pt' in model:
@@ -114,6 +124,7 @@ class CameraTrapsManager(ApplicationManager):
             else:
                 cfg_str += f'model_id: {self.model}\n'
         if self.input:
+            import validators  # pylint: disable=import-outside-toplevel
             if validators.url(self.input):
                 if self.input_dataset_type == 'image':
                     cfg_str += 'use_image_url: true\n'
@@ -210,9 +221,13 @@ class CameraTrapsManager(ApplicationManager):
         changed = super().update_config(cfg)
 
 
-        out, _ = capture_shell("curl -s https://api.github.com/repos/tapis-project/camera-traps/tags")
+        # the latest version is only a default, so GitHub is not waited on for long
         try:
+            out, _ = capture_shell("curl -s https://api.github.com/repos/tapis-project/camera-traps/tags", timeout=30)
             latest = json.loads(out)[0]['name']
+        except ControllerException as e:
+            LOGGER.warning(f'Could not look up the latest camera traps release: {e.msg}')
+            latest = 'latest'
         except json.decoder.JSONDecodeError:
             latest = 'latest'
 
@@ -265,6 +280,7 @@ class CameraTrapsManager(ApplicationManager):
             changed = True
         return changed
 
+    @traced('app.cleanup_environment', app_attributes)
     def cleanup_environment(self):
         if self.allow_attaching and self.get_application_health() != Status.PENDING:
             # There is already a healthy job running, no need to delete it and
@@ -291,6 +307,7 @@ class CameraTrapsManager(ApplicationManager):
         self.remove_app()
         self.status = Status.SETTINGUP
 
+    @traced('app.setup_environment', app_attributes)
     def setup_environment(self):
         # Prune images/containers and pull the latest images
         self.status = Status.SETTINGUP
@@ -303,6 +320,7 @@ class CameraTrapsManager(ApplicationManager):
         self.runner.run(pull_cmd)
         self.status = Status.READY
 
+    @traced('app.configure_app', app_attributes)
     def configure_app(self):
         # Generate config file
         changed = self.generate_cfg_file()
@@ -343,10 +361,15 @@ class CameraTrapsManager(ApplicationManager):
         out = self.runner.run(cmd)
         LOGGER.info(out)
 
-    def run_app(self):
+    @traced('app.run_app', app_attributes)
+    def run_app(self, pull: bool=True):
         """
         Run docker compose up in the remote run directory and capture output in the
         local log directory.
+
+            Parameters:
+                pull (bool): whether to pull the images first, which setup_environment
+                             has already done
         """
 
         # restart jtop service if running on a Jetson
@@ -356,14 +379,20 @@ class CameraTrapsManager(ApplicationManager):
         cmd = dedent(f"""
         cd {self.run_dir}
         export DOCKER_CLIENT_TIMEOUT=30
-        docker compose pull
+        {'docker compose pull' if pull else ''}
         docker compose up
         """)
 
         outlog = f'{self.log_dir}/ct_out.log'
         errlog = f'{self.log_dir}/ct_err.log'
         self.status = Status.RUNNING
-        self.runner.tracked_run(cmd, outlog, errlog)
+        # while this process follows the run, e.g. through the image pull before any container
+        # is up, the run ending is seen here rather than inferred from the containers
+        self.tracking = True
+        try:
+            self.runner.tracked_run(cmd, outlog, errlog, rotation=rotation_settings(self.mode))
+        finally:
+            self.tracking = False
         self.status = Status.COMPLETE
 
     def stop_app(self, ignore_failure=False):
@@ -382,6 +411,7 @@ class CameraTrapsManager(ApplicationManager):
         self.status = Status.COMPLETE
 
 
+    @traced('app.copy_results', app_attributes)
     def copy_results(self):
         self.status = Status.SAVING
         try:
@@ -452,8 +482,12 @@ class CameraTrapsManager(ApplicationManager):
         # if we can verify all containers are up, set status to running
         elif running:
             return Status.RUNNING
-        # if the status was set to running or failed, but we cannot verify it, set back to pending
-        elif self.status == Status.FAILED or self.status == Status.RUNNING:
+        # if the app was running but its containers are gone, the run has ended, unless this
+        # process is still following it
+        elif self.status == Status.RUNNING:
+            return Status.RUNNING if self.tracking else Status.COMPLETE
+        # if the status was set to failed, but we cannot verify it, set back to pending
+        elif self.status == Status.FAILED:
             return Status.PENDING
         # otherwise, just return the currently set status
         else:
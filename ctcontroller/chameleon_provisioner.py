@@ -1,23 +1,66 @@
 """Contains the ChameleonProvisioner for provisioning hardware on Chameleon Cloud."""
 
-from re import search
 import os
-import time
+import json
 import yaml
 import logging
-import openstackclient.shell as shell
 from datetime import datetime, timedelta, UTC
 from .provisioner import Provisioner
-from .util import ProvisionException, capture_shell, Status
+from .openstack_client import AppCredential, get_client
+from .site_catalog import get_catalog
+from .step_graph import StepGraph
+from .waits import WaitPolicy, wait_until
+from .util import ProvisionException, Status
 
 LOGGER = logging.getLogger("CT Controller")
-subcommand_map = {
-    'lease': ['reservation', 'lease'],
-    'server': ['server'],
-    'ip': ['floating', 'ip'],
-    'image': ['image']
+
+# How long the hardware is leased for
+LEASE_DURATION = timedelta(hours=6)
+
+# Leases that start now are usually active within a minute; a PENDING lease waits for its
+# start date, so it is checked rarely
+LEASE_WAIT = WaitPolicy(default=10, minimum=3, expected=60, intervals={'PENDING': 30},
+                        deadline=float(os.environ.get('CT_CONTROLLER_LEASE_TIMEOUT', 3600)))
+# Bare-metal servers take about ten minutes to boot, so they are checked most often around then
+SERVER_WAIT = WaitPolicy(default=30, minimum=5, expected=600,
+                         deadline=float(os.environ.get('CT_CONTROLLER_SERVER_TIMEOUT', 1800)))
+# Associating a floating IP with a server takes a few seconds
+ADDRESS_WAIT = WaitPolicy(default=3, deadline=300)
+
+# columns printed by run_check for each type of resource
+check_columns = {
+    'lease': ['id', 'name', 'status'],
+    'server': ['id', 'name', 'status'],
+    'ip': ['id', 'floating_ip_address', 'status'],
+    'image': ['id', 'name', 'status']
 }
 
+def host_free_at(reservations: list, now: datetime) -> datetime:
+    """
+    Returns the start of the first gap of LEASE_DURATION between the reservations of a host.
+
+        Parameters:
+            reservations (list): the reservations of the host, with start_date and end_date
+            now (datetime): the current time
+
+        Returns:
+            datetime: when the host is free
+    """
+
+    free = now
+    periods = sorted((_parse_date(res['start_date']), _parse_date(res['end_date'])) for res in reservations)
+    for start, end in periods:
+        if end <= free:
+            continue
+        if start - free >= LEASE_DURATION:
+            break
+        free = max(free, end)
+    return free
+
+def _parse_date(value: str) -> datetime:
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo is not None else date.replace(tzinfo=UTC)
+
 class ChameleonProvisioner(Provisioner):
     """
     A subclass of the Provisioner class to handle the provisioning and deprovisioning
@@ -34,6 +77,11 @@ class ChameleonProvisioner(Provisioner):
         ip_lease_id (str): 
         reservation_id (str): 
         ip_reservation_id (str): 
+        auth_url (str): the Keystone endpoint of the site
+        app_credential (AppCredential): the application credential used on the site
+        lease_start (datetime): when the lease starts, if the hardware is not available now
+        client (ChameleonClient): the client shared by all requests to the site
+        catalog (SiteCatalog): the cached node types, images and networks of the site
         image (str): 
         server_id (str): 
         remote_id (str): 
@@ -46,8 +94,13 @@ class ChameleonProvisioner(Provisioner):
         run_check(check_type):
         available_hosts(): 
         reserve_lease():
-        check_lease_ready(lease_name, lease_id): 
-        check_server_ready(server_name): 
+        lease_status(lease_id):
+        server_status(server_id):
+        earliest_start():
+        check_lease_ready(lease_name, lease_id, status):
+        check_server_ready(server_name, status):
+        wait_for_lease(lease_name, lease_id):
+        wait_for_server():
         reserve_ip():
         get_reservation_id():
         select_image():
@@ -59,27 +112,46 @@ class ChameleonProvisioner(Provisioner):
         associate_ip():
         provision_instance():
         shutdown_instance():
+        teardown_server():
+        teardown_lease():
+        teardown_ip():
+        verify():
+        reservation_end():
+        extend_reservation():
     
     """
 
+    STATE_ATTRIBUTES = Provisioner.STATE_ATTRIBUTES + ['lease_id', 'reservation_id', 'image', 'server_id']
+    POOLABLE = True
+    # attribute set by each provisioning step, used to skip the step when reattaching
+    STEP_RESULTS = {'select_image': 'image', 'reserve_lease': 'lease_id', 'allocate_ip': 'ip_addresses',
+                    'create_instance': 'server_id', 'set_device_id': 'device_id'}
+    # steps each provisioning step depends on; steps without a dependency between them run
+    # concurrently
+    STEP_REQUIRES = {'select_image': [], 'reserve_lease': [], 'allocate_ip': [],
+                     'create_instance': ['select_image', 'reserve_lease', 'allocate_ip'],
+                     'associate_ip': ['create_instance'],
+                     'set_device_id': ['associate_ip']}
+
     def __init__(self, cfg):
         cfg['user_name_required'] = False
         super().__init__(cfg)
+        self.num_nodes = int(self.num_nodes)
 
         subsite = self.site.split('@')[1].lower()
 
-        # set Chameleon-specific environment variables
-        os.environ['OS_AUTH_TYPE'] = 'v3applicationcredential'
-        os.environ['OS_AUTH_URL'] = f'https://chi.{subsite}.chameleoncloud.org:5000/v3'
-        os.environ['OS_IDENTITY_API_VERSION'] = '3'
-        os.environ['OS_REGION_NAME'] = self.site
-        os.environ['OS_INTERFACE'] = 'public'
+        self.auth_url = f'https://chi.{subsite}.chameleoncloud.org:5000/v3'
 
-        # ensure that app credentials are already defined in the environment
-        if (os.environ.get('OS_APPLICATION_CREDENTIAL_ID') is None or
-            os.environ.get('OS_APPLICATION_CREDENTIAL_SECRET') is None):
-            self.status = Status.FAILED
-            raise ProvisionException('Chameleon Application credentials must be specified in the environment')
+        # use the app credentials of the service account, or else those of the environment
+        if self.get('app_credential') is None:
+            if (os.environ.get('OS_APPLICATION_CREDENTIAL_ID') is None or
+                os.environ.get('OS_APPLICATION_CREDENTIAL_SECRET') is None):
+                self.status = Status.FAILED
+                raise ProvisionException('Chameleon Application credentials must be specified in the environment')
+            self.app_credential = AppCredential(os.environ['OS_APPLICATION_CREDENTIAL_ID'],
+                                                os.environ['OS_APPLICATION_CREDENTIAL_SECRET'])
+        # one authenticated session per site and credential, reused by every request
+        self.client = get_client(self.site, self.auth_url, self.app_credential)
 
         # Configure lease and instance names
         self.job_id = cfg['job_id']
@@ -87,17 +159,8 @@ class ChameleonProvisioner(Provisioner):
         #self.ip_lease_name = self.job_id + '-ip-lease' # only used with floating IP reservations
         self.server_name = self.job_id + '-server'
 
-        # Set network id
-        cmd = ['openstack', 'network', 'list', '--name', 'sharednet1', '-c', 'ID', '-f', 'value']
-        network_id, _ = capture_shell(cmd)
-        self.network_id = network_id
-
-        # Set public network id
-        cmd = ['openstack', 'network', 'show', 'public', '-c', 'id', '-f', 'value']
-        public_network_id, _ = capture_shell(cmd)
-        self.public_network_id = public_network_id
-
         # Parameters set during provisioning
+        self.lease_start = None
         self.lease_id = None
         #self.ip_lease_id = None # only used with floating IP reservations
         self.reservation_id = None
@@ -105,6 +168,10 @@ class ChameleonProvisioner(Provisioner):
         self.image = None
         self.server_id = None
         self.remote_id = 'cc'
+        # the node types, images and networks of the site, cached on disk
+        self.catalog = get_catalog(self.site, self.client)
+        self.network_id = self.catalog.network_id('sharednet1')
+        self.public_network_id = self.catalog.network_id('public')
         self.cpu_arch = self.get_cpu_arch()
         self.node_info = {'cpu': self.cpu_arch, 'gpu': self.gpu, 'node_type': self.node_type}
 
@@ -131,8 +198,7 @@ class ChameleonProvisioner(Provisioner):
                                      to launch with a service account.')
         self.key_name = auth[self.site]['Name']
         self.private_key = auth[self.site]['Path']
-        os.environ['OS_APPLICATION_CREDENTIAL_ID'] = auth[self.site]['ID']
-        os.environ['OS_APPLICATION_CREDENTIAL_SECRET'] = auth[self.site]['Secret']
+        self.app_credential = AppCredential(auth[self.site]['ID'], auth[self.site]['Secret'])
 
     def get_cpu_arch(self):
         """
@@ -143,21 +209,9 @@ class ChameleonProvisioner(Provisioner):
                 arch (str): the cpu architecture of the 
         """
 
-        cmd = ['openstack', 'reservation', 'host', 'list', '-f',
-               'csv', '-c', 'node_type', '-c', 'architecture.platform_type', '-c', 'cpu_arch']
-        all_nodes, _ = capture_shell(cmd)
-        for node in all_nodes.split('\n'):
-            if f'"{self.node_type}"' in node:
-                break
-        else:
-            node = ''
-        node = node.replace(self.node_type, '')
-        node_info = node.split(',')
-        for i in node_info:
-            arch  = i.strip("\"")
-            if arch != '':
-                break
-        else: #arch == ''
+        host = self.catalog.host(self.node_type) or {}
+        arch = host.get('architecture.platform_type') or host.get('cpu_arch') or ''
+        if arch == '':
             self.status = Status.FAILED
             raise ProvisionException(f'Cannot determine CPU architecture of specified \
                            node type {self.node_type}')
@@ -173,30 +227,27 @@ class ChameleonProvisioner(Provisioner):
                                  If not specified print all.
         """
 
-        cmd = subcommand_map.get(check_type)
-        if cmd is None:
+        listers = {'lease': self.client.list_leases, 'server': self.client.list_servers,
+                   'ip': self.client.list_floating_ips, 'image': self.client.list_images}
+        if check_type not in list(listers) + ['']:
             self.status = Status.FAILED
             raise ProvisionException(f'"{check_type}" is not a valid input to the check \
                            subcommand')
-        cmd.append('list')
-        shell.main(cmd)
+        for resource_type, lister in listers.items():
+            if check_type not in ['', resource_type]:
+                continue
+            columns = check_columns[resource_type]
+            print('\t'.join(columns))
+            for resource in lister():
+                print('\t'.join(str(resource.get(column, '')) for column in columns))
 
     def available_hosts(self):
         """
-        Returns a string containing all hosts available on Chameleon Cloud along with
-        their node_type, GPU, platform type and processor description.
+        Returns the node types available on the site, each as a dict of its capabilities
+        including its node_type, GPU, platform type and processor description.
         """
 
-        cmd = ['openstack', 'reservation', 'host', 'list',
-               '--quote', 'none',
-               '-f', 'csv',
-               '-c', 'node_type',
-               '-c', 'gpu.gpu',
-               '-c', 'gpu.gpu_model',
-               '-c', 'architecture.platform_type',
-               '-c', 'processor.other_description']
-        out, _ = capture_shell(cmd)
-        return out.split('\n')
+        return list(self.catalog.hosts.values())
 
     #def get_node_type(self, cpu, gpu):
     #    pass
@@ -208,22 +259,42 @@ class ChameleonProvisioner(Provisioner):
         """
 
         LOGGER.info('Reserving lease for physical nodes')
-        end_time = datetime.now(UTC) + timedelta(hours=6)
-        resource_properties = f'["==", "$node_type", "{self.node_type}"]'
-        reservation = (f'min={self.num_nodes},max={self.num_nodes},'
-                       f'resource_type=physical:host,resource_properties={resource_properties}')
-        cmd = ['openstack', 'reservation', 'lease'] + \
-            ['create', '--reservation', reservation, self.lease_name, '--end-date',
-             end_time.strftime("%Y-%m-%d %H:%M"), '-f', 'value', '-c', 'id']
-        LOGGER.info(' '.join(cmd))
-        lease_out, err = capture_shell(cmd)
-        if 'ERROR: Not enough resources available' in err:
+        start = 'now'
+        end_time = datetime.now(UTC) + LEASE_DURATION
+        if self.lease_start is not None and self.lease_start > datetime.now(UTC):
+            # the hardware is only available later, the lease waits for it
+            start = self.lease_start.strftime("%Y-%m-%d %H:%M")
+            end_time = self.lease_start + LEASE_DURATION
+        reservation = {'resource_type': 'physical:host', 'min': self.num_nodes, 'max': self.num_nodes,
+                       'resource_properties': json.dumps(['==', '$node_type', self.node_type]),
+                       'hypervisor_properties': ''}
+        LOGGER.info(f'Creating lease {self.lease_name} with reservation {reservation}')
+        try:
+            lease = self.client.create_lease(self.lease_name, [reservation],
+                                             end_time.strftime("%Y-%m-%d %H:%M"), start)
+        except ProvisionException as e:
             self.status = Status.FAILED
-            raise ProvisionException('Not enough resources available. Try rerunning later.')
-        lease_id = lease_out.split('\n')[1]
-        self.lease_id = lease_id
+            if 'Not enough resources available' in e.msg:
+                raise ProvisionException('Not enough resources available. Try rerunning later.') from e
+            raise
+        self.lease_id = lease['id']
+        reservations = lease.get('reservations') or []
+        if reservations:
+            self.reservation_id = reservations[0]['id']
+
+    def lease_status(self, lease_id: str) -> str:
+        """Returns the status of the lease, UNKNOWN if it is not listed yet."""
+
+        lease = self.client.poller.get('lease', lease_id, LEASE_WAIT.minimum)
+        return lease['status'] if lease is not None else 'UNKNOWN'
 
-    def check_lease_ready(self, lease_name, lease_id) -> bool:
+    def server_status(self, server_id: str) -> str:
+        """Returns the status of the server, UNKNOWN if it is not listed yet."""
+
+        server = self.client.poller.get('server', server_id, SERVER_WAIT.minimum)
+        return server.get('status') if server is not None else 'UNKNOWN'
+
+    def check_lease_ready(self, lease_name, lease_id, status=None) -> bool:
         """
         Checks whether the lease is active. If the lease failed to allocate prints an
         error message and exits.
@@ -231,14 +302,15 @@ class ChameleonProvisioner(Provisioner):
             Parameters:
                 lease_name (str): the name of the lease
                 lease_id (str): the id of the lease
+                status (str): the status of the lease, looked up if not given
 
             Returns:
                 bool: true if the lease is active and false if it is not
         """
 
-        cmd = ['openstack', 'reservation', 'lease', 'show', lease_id, '-c', 'status', '-f', 'value']
         ready = False
-        status, _ = capture_shell(cmd)
+        if status is None:
+            status = self.lease_status(lease_id)
         if status == 'ACTIVE':
             ready = True
         elif status == 'ERROR':
@@ -249,31 +321,32 @@ class ChameleonProvisioner(Provisioner):
             raise ProvisionException(f'The lease {lease_name} has been terminated.')
         elif status == 'STARTING':
             ready = False
-        elif status == 'PENDING':
+        elif status in ['PENDING', 'UNKNOWN']:
             ready = False
         else:
             self.status = Status.FAILED
             raise ProvisionException(f'Lease in invalid state: {status}')
         return ready
 
-    def check_server_ready(self, server_name) -> bool:
+    def check_server_ready(self, server_name, status=None) -> bool:
         """
         Checks whether the server is active. If the server failed to initialize prints an
         error message and exits.
 
             Parameters:
-                server_name (str): the name of the server
+                server_name (str): the id of the server
+                status (str): the status of the server, looked up if not given
 
             Returns:
                 bool: true if the server is active and false if it is not
         """
 
-        cmd = ['openstack', 'server', 'show', server_name, '-c', 'status', '-f', 'value']
         ready = False
-        status, _ = capture_shell(cmd)
+        if status is None:
+            status = self.server_status(server_name)
         if status == 'ACTIVE':
             ready = True
-        elif status == 'BUILD':
+        elif status in ['BUILD', 'UNKNOWN']:
             ready = False
         elif status == 'STARTING':
             ready = False
@@ -293,21 +366,20 @@ class ChameleonProvisioner(Provisioner):
         Releases all floating IP addresses that were allocate without a reservation.
         """
 
-        cmd = ['floating', 'ip', 'delete', self.ip_addresses]
         LOGGER.info(f'Releasing floating IP address {self.ip_addresses}')
-        shell.main(cmd)
+        self.client.delete_floating_ip(self.ip_addresses)
 
     def allocate_ip(self):
         """
         Allocates a floating IP address (without a reservation).
         If floating IPs are available, sets the IP address as an object attribute.
         """
-        cmd = ['openstack', 'floating', 'ip', 'create', 'public', '-f', 'value', '-c', 'floating_ip_address']
-        LOGGER.info(f'Allocating a floating ip address\n{cmd}')
-        ip_addresses, err = capture_shell(cmd)
-        if 'ERROR' in err:
+        LOGGER.info('Allocating a floating ip address')
+        try:
+            ip_addresses = self.client.create_floating_ip(self.public_network_id)
+        except ProvisionException as e:
             self.status = Status.FAILED
-            raise ProvisionException('Not enough floating IPs available. Try rerunning later.')
+            raise ProvisionException('Not enough floating IPs available. Try rerunning later.') from e
         self.ip_addresses = ip_addresses
 
     def reserve_ip(self):
@@ -318,17 +390,19 @@ class ChameleonProvisioner(Provisioner):
         If floating IPs are available, sets the lease id as an object attribute.
         """
 
-        res = (f'resource_type=virtual:floatingip,network_id={self.public_network_id},'
-               f'amount={self.num_nodes}')
-        cmd = ['openstack', 'reservation', 'lease'] \
-            + ['create', '--reservation', res, self.ip_lease_name, '-f', 'value', '-c', 'id']
-        LOGGER.info(f'Reserving lease for floating ip addresses\n{cmd}')
-        lease_out, err = capture_shell(cmd)
-        if 'ERROR: Not enough floating IPs available' in err:
+        reservation = {'resource_type': 'virtual:floatingip', 'network_id': self.public_network_id,
+                       'amount': self.num_nodes}
+        LOGGER.info(f'Reserving lease for floating ip addresses\n{reservation}')
+        end_time = datetime.now(UTC) + LEASE_DURATION
+        try:
+            lease = self.client.create_lease(self.ip_lease_name, [reservation],
+                                             end_time.strftime("%Y-%m-%d %H:%M"))
+        except ProvisionException as e:
             self.status = Status.FAILED
-            raise ProvisionException('Not enough floating IPs available. Try rerunning later.')
-        lease_id = lease_out.split('\n')[1]
-        self.ip_lease_id = lease_id
+            if 'Not enough floating IPs available' in e.msg:
+                raise ProvisionException('Not enough floating IPs available. Try rerunning later.') from e
+            raise
+        self.ip_lease_id = lease['id']
 
     def get_reservation_id(self):
         """
@@ -340,12 +414,8 @@ class ChameleonProvisioner(Provisioner):
         """
 
         if self.reservation_id is None:
-            cmd = ['openstack', 'reservation', 'lease', 'show', self.lease_name, '-c', \
-                   'reservations', '-f', 'value']
-            out, _ = capture_shell(cmd)
-            # parse resid
-            match=search(r'"id": "([^"]+)"', out )
-            self.reservation_id = match.groups()[0]
+            lease = self.client.get_lease(self.lease_id)
+            self.reservation_id = lease['reservations'][0]['id']
         return self.reservation_id
 
     def select_image(self):
@@ -357,16 +427,10 @@ class ChameleonProvisioner(Provisioner):
 
         self.set_gpu_arch()
         # get available images
-        cmd = ['openstack', 'image', 'list', '-c', 'Name', '-f', 'value', '--tag', 'ct_edge']
-        if 'cpu' in self.node_info:
-            cmd += ['--tag', self.node_info['cpu']]
-        if 'gpu' in self.node_info and self.node_info['gpu']:
-            cmd += ['--tag', 'gpu']
-            if self.node_info['gpu_arch'] != '':
-                cmd += ['--tag', self.node_info['gpu_arch'].lower()]
-        LOGGER.info(cmd)
-        image, _ = capture_shell(cmd)
-        if image is None or image == '':
+        images = self.catalog.find_images(self.node_info.get('cpu'), self.node_info.get('gpu'),
+                                          self.node_info['gpu_arch'])
+        LOGGER.info(f'Compatible images: {images}')
+        if not images:
             msg = ('Valid image not found for node of type ',
                    f'{self.node_info["cpu"]}',
                    (' with GPU' if self.node_info["gpu"] else ''))
@@ -374,8 +438,7 @@ class ChameleonProvisioner(Provisioner):
             self.status = Status.FAILED
             raise ProvisionException(msg)
         # if multiple images are compatible, select the first one
-        image = image.split('\n')[0]
-        self.image = image
+        self.image = images[0]
 
     def create_instance(self):
         """
@@ -386,21 +449,12 @@ class ChameleonProvisioner(Provisioner):
 
         # wait until reservations are ready
         LOGGER.info('Waiting for reservation leases to start')
-        while (#not self.check_lease_ready(self.ip_lease_name, self.ip_lease_id) or # only used with floating IP reservations
-               not self.check_lease_ready(self.lease_name, self.lease_id)):
-            LOGGER.info('.')
-            time.sleep(3)
+        self.wait_for_lease(self.lease_name, self.lease_id)
+        #self.wait_for_lease(self.ip_lease_name, self.ip_lease_id) # only used with floating IP reservations
         LOGGER.info('Creating instance on the lease')
-        cmd = ['openstack', 'server']  \
-                            + ['create', '--image', self.image,
-                               '--network', self.network_id,
-                               '--flavor', 'baremetal',
-                               '--key-name', self.ssh_key['name'],
-                               '--hint', f'reservation={self.get_reservation_id()}',
-                               '-c', 'id', '-f', 'value',
-                               self.server_name]
-        LOGGER.info(cmd)
-        server_id, _ = capture_shell(cmd)
+        server_id = self.client.create_server(self.server_name, self.image, self.network_id,
+                                              'baremetal', self.ssh_key['name'],
+                                              self.get_reservation_id())
         self.server_id = server_id
         # Set ip address for instance
         self.set_ip_addresses()
@@ -408,17 +462,14 @@ class ChameleonProvisioner(Provisioner):
     def delete_server(self):
         """Deletes the server."""
 
-        cmd = ['server', 'delete', self.server_name]
-        shell.main(cmd)
+        self.client.delete_server(self.server_id)
 
     def delete_leases(self):
         """Deprovision the leases for the physical hardware (and floating IP addresses)."""
 
-        cmd = ['reservation', 'lease', 'delete', self.lease_name]
-        shell.main(cmd)
+        self.client.delete_lease(self.lease_id)
         # Only used when creating reservations for floating IP addresses
-        #cmd = subcommand_map['lease'] + ['delete', self.ip_lease_name]
-        #shell.main(cmd)
+        #self.client.delete_lease(self.ip_lease_id)
 
     def get_ip_reservation_id(self):
         """
@@ -427,12 +478,8 @@ class ChameleonProvisioner(Provisioner):
         Note: This was used when creating a floating IP lease, not in use with ad-hoc allocation of IPs.
         """
 
-        cmd = ['openstack', 'reservation', 'lease'] + \
-            ['show', self.ip_lease_name, '-c', 'reservations', '-f', 'value']
-        out, _ = capture_shell(cmd)
-        match  = search(r'"id": "([^"]+)"', out )
-        resid = match.groups()[0]
-        self.ip_reservation_id = resid
+        lease = self.client.get_lease(self.ip_lease_id)
+        self.ip_reservation_id = lease['reservations'][0]['id']
 
     def set_ip_addresses(self):
         """
@@ -444,12 +491,8 @@ class ChameleonProvisioner(Provisioner):
 
         if self.ip_addresses is None:
             self.get_ip_reservation_id()
-            cmd = ['openstack', 'floating', 'ip'] \
-                + ['list', '--tags', f'blazar,reservation:{self.ip_reservation_id}', '-c', \
-                   'Floating IP Address', '-f', 'value']
-            LOGGER.info(cmd)
-            ip_addresses, _ = capture_shell(cmd)
-            self.ip_addresses = ip_addresses
+            tags = ['blazar', f'reservation:{self.ip_reservation_id}']
+            self.ip_addresses = '\n'.join(self.client.find_floating_ips(tags))
 
     def associate_ip(self):
         """
@@ -458,19 +501,59 @@ class ChameleonProvisioner(Provisioner):
         """
 
         LOGGER.info('Waiting for server to be ready')
-        while not self.check_server_ready(self.server_id):
-            LOGGER.info('.')
-            time.sleep(3)
+        self.wait_for_server()
         LOGGER.info("Associating floating IP address with instance")
-        cmd = ['server', 'add', 'floating', 'ip', self.server_name, \
-                                          self.ip_addresses]
-        shell.main(cmd)
-        check_cmd = ['openstack', 'server', 'show', self.server_name, '-c', 'addresses', '-f', \
-                     'value']
-        address = ''
-        while address == '':
-            time.sleep(3)
-            address, _ = capture_shell(check_cmd)
+        self.client.add_floating_ip(self.server_id, self.ip_addresses)
+        wait_until(lambda: (self.ip_associated(), 'associating'), ADDRESS_WAIT,
+                   f'floating IP {self.ip_addresses}', self.progress, self.check_cancelled)
+
+    def wait_for_lease(self, lease_name: str, lease_id: str):
+        """Waits until the lease is active, failing if it errors or LEASE_WAIT's deadline passes."""
+
+        def ready():
+            status = self.lease_status(lease_id)
+            return self.check_lease_ready(lease_name, lease_id, status), status
+        policy = LEASE_WAIT
+        if self.lease_start is not None:
+            # a lease starting later may be pending until then
+            policy = policy.extended((self.lease_start - datetime.now(UTC)).total_seconds())
+        wait_until(ready, policy, f'lease {lease_name}', self.progress, self.check_cancelled)
+
+    def earliest_start(self) -> datetime:
+        """
+        Estimates when num_nodes hosts of the node type will be free for LEASE_DURATION on
+        this site, from the reservations holding each host.
+
+            Returns:
+                datetime: the earliest start, now if the hosts are free, None if the site does
+                          not have enough reservable hosts of the node type
+        """
+
+        now = datetime.now(UTC)
+        hosts = [str(host.get('id')) for host in self.client.list_hosts()
+                 if host.get('node_type') == self.node_type and host.get('reservable', True)]
+        allocations = {str(alloc.get('resource_id')): alloc.get('reservations') or []
+                       for alloc in self.client.list_host_allocations()}
+        free = sorted(host_free_at(allocations.get(host, []), now) for host in hosts)
+        if len(free) < self.num_nodes:
+            return None
+        return free[self.num_nodes - 1]
+
+    def wait_for_server(self):
+        """Waits until the server is active, failing if it errors or SERVER_WAIT's deadline passes."""
+
+        def ready():
+            status = self.server_status(self.server_id)
+            return self.check_server_ready(self.server_id, status), status
+        wait_until(ready, SERVER_WAIT, f'server {self.server_name}', self.progress, self.check_cancelled)
+
+    def ip_associated(self) -> bool:
+        """Returns True once the floating IP address appears in the addresses of the server."""
+
+        server = self.client.poller.get('server', self.server_id, ADDRESS_WAIT.minimum)
+        addresses = (server.get('addresses') if server is not None else None) or {}
+        return any(address.get('addr') == self.ip_addresses
+                   for network in addresses.values() for address in network)
 
     def set_device_id(self):
         """Sets the device id of the provisioned node as an object attribute."""
@@ -479,22 +562,18 @@ class ChameleonProvisioner(Provisioner):
         runner = self.get_remote_runner()
         node_id = runner.run("curl -s 169.254.169.254/openstack/latest/vendor_data2.json \
                              | jq -M '.chameleon.node'").strip('"')
-        cmd = ['openstack', 'reservation', 'host', 'show', node_id, '-c', 'node_name', '-f', 'value']
-        device_id, _ = capture_shell(cmd)
+        device_id = self.catalog.node_names.get(node_id)
+        if device_id is None:
+            device_id = self.client.find_host(node_id)['node_name']
         self.device_id = device_id
 
     def set_gpu_arch(self):
         self.node_info['gpu_arch'] = ''
         if self.node_info['gpu']:
-            all_hosts = self.available_hosts()
-            model_index = next((i for i, s in enumerate(all_hosts[0].split(','))
-                                if 'gpu.gpu_model' in s), -1)
-            for host_info in all_hosts:
-                if self.node_info['node_type'] in host_info:
-                    gpu_arch = host_info.split(',')[model_index]
-                    self.node_info['gpu_arch'] = gpu_arch
-                    LOGGER.info(f'gpu_arch set to {gpu_arch}')
-                    break
+            host = self.catalog.host(self.node_info['node_type']) or {}
+            gpu_arch = host.get('gpu.gpu_model') or ''
+            self.node_info['gpu_arch'] = gpu_arch
+            LOGGER.info(f'gpu_arch set to {gpu_arch}')
 
     def provision_instance(self):
         """
@@ -502,25 +581,88 @@ class ChameleonProvisioner(Provisioner):
         compatible image, creating an image on the hardware, and associating the IP with it.
         """
 
+        undo = {'reserve_lease': self.teardown_lease, 'allocate_ip': self.teardown_ip,
+                'create_instance': self.teardown_server}
+        graph = StepGraph()
+        for name, requires in self.STEP_REQUIRES.items():
+            # after a restart, skip the steps whose resources already exist
+            done = self.STEP_RESULTS.get(name)
+            skip = done is not None and self.get(done) is not None
+            if skip:
+                LOGGER.info(f'Reusing {done} {self.get(done)}')
+            graph.add(name, getattr(self, name), requires, undo.get(name), skip)
         try:
             self.status = Status.SETTINGUP
-            self.select_image()
-            self.reserve_lease()
-            #self.reserve_ip()
-            self.allocate_ip()
-            self.create_instance()
-            self.associate_ip()
-            self.set_device_id()
+            # independent steps overlap, so the critical path is the lease becoming active
+            # followed by the server booting; a failure undoes the steps that ran
+            graph.run(self.phase)
             self.status = Status.READY
-        except ProvisionException as e:
+        except Exception:
+            # whatever failed, release what was reserved before reporting the failure
             self.status = Status.SHUTTINGDOWN
-            self.shutdown_instance()
+            try:
+                self.shutdown_instance()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.exception(f'Could not release the resources of the failed instance: {getattr(e, "msg", e)}')
             self.status = Status.FAILED
             raise
 
     def shutdown_instance(self):
-        """Shuts down the instance and deprovisions the hardware and IP leases."""
+        """
+        Shuts down the instance and deprovisions the hardware and IP leases.
+        Only the resources that were created are released, so this can tear down a
+        partially provisioned instance.
+        """
+
+        self.status = Status.SHUTTINGDOWN
+        self.teardown_server()
+        self.teardown_lease()
+        self.teardown_ip()
+        self.status = Status.SHUTDOWN
+
+    def teardown_server(self):
+        """Deletes the server, if it was created."""
+
+        if self.server_id is not None:
+            self.delete_server()
+            self.server_id = None
+
+    def teardown_lease(self):
+        """Deletes the lease, if it was reserved."""
+
+        if self.lease_id is not None:
+            self.delete_leases()
+            self.lease_id = None
+            self.reservation_id = None
+
+    def teardown_ip(self):
+        """Releases the floating IP address, if it was allocated."""
+
+        if self.ip_addresses is not None:
+            self.release_ip()
+            self.ip_addresses = None
+
+    def verify(self) -> bool:
+        """Returns True if the lease and the server are both still active."""
+
+        if self.lease_id is None or self.server_id is None:
+            return False
+        try:
+            lease = self.client.get_lease(self.lease_id)
+            server = self.client.get_server(self.server_id)
+        except ProvisionException as e:
+            LOGGER.warning(f'Could not verify the resources of {self.server_name}: {e.msg}')
+            return False
+        return lease.get('status') == 'ACTIVE' and (server or {}).get('status') == 'ACTIVE'
+
+    def reservation_end(self) -> datetime:
+        """Returns the end date of the lease."""
+
+        return _parse_date(self.client.get_lease(self.lease_id)['end_date'])
+
+    def extend_reservation(self):
+        """Extends the lease to end LEASE_DURATION from now."""
 
-        self.delete_server()
-        self.delete_leases()
-        self.release_ip()
+        end_time = datetime.now(UTC) + LEASE_DURATION
+        LOGGER.info(f'Extending lease {self.lease_id} until {end_time.strftime("%Y-%m-%d %H:%M")}')
+        self.client.update_lease(self.lease_id, end_time.strftime("%Y-%m-%d %H:%M"))
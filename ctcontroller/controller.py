@@ -30,6 +30,7 @@ controller_vars = {
     'run_dir':           {'required': False, 'category': ['application'], 'type': str},
     'model_cache':       {'required': False, 'category': ['application'], 'type': str},
     'job_id':            {'required': False, 'category': ['provisioner'], 'type': str},
+    'priority':          {'required': False, 'category': ['provisioner'], 'type': int},
     'advanced_app_vars': {'required': False, 'category': ['application'], 'type': 'json'},
     'mode':              {'required': False, 'category': ['application'], 'type': str},
     'input_dataset_type':{'required': False, 'category': ['application'], 'type': str},
@@ -157,6 +158,8 @@ class Controller():
             job_id = ''.join(random.choices(string.ascii_letters, k=7))
             self.provisioner_config['job_id'] = job_id
             self.application_config['job_id'] = job_id
+        else:
+            self.application_config['job_id'] = self.provisioner_config['job_id']
 
     # Determine the log directory and check that it is writable
     def set_log_dir(self):
@@ -2,27 +2,106 @@
 The main module of the ctcontroller package.
 It contains the main function that runs the entire provision-run-shutdown-deprovision workflow.
 """
+import os
 import logging
-from .camera_traps import CameraTrapsManager as AppManager
 from .controller import Controller
-from .util import ApplicationException, ProvisionException
+from .util import ApplicationException, Status
+from .operations import phase
+from .state_store import get_store
+from .tracing import set_job_id
+from .placement import is_placement, provision_first, rank_sites
+from .warm_pool import get_pool
+from .group_manager import create_manager
 
 LOGGER = logging.getLogger("CT Controller")
 
-def setup(options: dict=None, job_local_log=False):
-    controller = Controller(options)
-    if controller.provisioner_config['target_site'].startswith('CHI'):
+def site_provisioner(target_site: str):
+    """Returns the Provisioner subclass for target_site, CHI@* meaning any Chameleon site."""
+
+    if target_site.startswith('CHI'):
         from .chameleon_provisioner import ChameleonProvisioner as SiteProvisioner  # pylint: disable=import-outside-toplevel
-    elif controller.provisioner_config['target_site'] == 'TACC':
+    elif target_site == 'TACC':
         from .tacc_provisioner import TACCProvisioner as SiteProvisioner # pylint: disable=import-outside-toplevel
-    elif controller.provisioner_config['target_site'] == 'local':
+    elif target_site == 'local':
         from .local_provisioner import LocalProvisioner as SiteProvisioner # pylint: disable=import-outside-toplevel
+    return SiteProvisioner
+
+def provisioner_config(controller: Controller, record: dict) -> dict:
+    """
+    Returns the provisioner configuration of a job. A job placed on any Chameleon site uses
+    the site it was placed on, as recorded in the state store.
+    """
+
+    config = controller.provisioner_config
+    placed = ((record or {}).get('provisioner') or {}).get('site')
+    if is_placement(config['target_site']) and placed is not None:
+        config = dict(config, target_site=placed)
+    return config
+
+def setup(options: dict=None, job_local_log=False, operation=None):
+    """
+    Reads the configuration, provisions the hardware and creates the application manager.
+    The state of the job is recorded in the state store as it changes. If the store shows
+    that the job's hardware was already provisioned by a controller that has since exited,
+    the provisioner and application manager reattach to it instead of provisioning again.
+    Otherwise a matching node of the warm pool is used if there is one.
+
+        Parameters:
+            options (dict): options overriding the environment variables
+            job_local_log (bool): whether to store the application logs in a per-job directory
+            operation (Operation): background operation used to report progress and check for
+                                   cancellation
+
+        Returns:
+            tuple: the controller, provisioner and application manager
+    """
+
+    with phase(operation, 'controller'):
+        controller = Controller(options)
+        job_id = controller.provisioner_config['job_id']
+        set_job_id(job_id)
+    if operation is not None:
+        operation.job_id = job_id
+    store = get_store()
+    record = store.get(job_id)
+    reattach = record is not None and record['hardware_status'] in [Status.SETTINGUP.name, Status.READY.name]
+    config = provisioner_config(controller, record if reattach else None)
+    SiteProvisioner = site_provisioner(config['target_site'])
+    store.save_job(job_id, options)
 
+    pool = get_pool(store)
     try:
-        provisioner = SiteProvisioner(controller.provisioner_config)
-        provisioner.provision_instance()
-    except ProvisionException as e:
-        LOGGER.exception(e.msg)
+        provisioner = None
+        if not reattach and pool.enabled:
+            with phase(operation, 'warm_pool'):
+                provisioner = pool.acquire(config, operation)
+        if provisioner is not None:
+            provisioner.attach_store(store, job_id)
+        elif is_placement(config['target_site']):
+            # choose the Chameleon site that can start the job soonest, falling back to the
+            # next site if provisioning fails
+            with phase(operation, 'placement'):
+                candidates = rank_sites(config, operation)
+            with phase(operation, 'provision'):
+                provisioner = provision_first(candidates, lambda candidate: candidate.attach_store(store, job_id))
+        else:
+            provisioner = SiteProvisioner(config)
+            provisioner.operation = operation
+            if reattach:
+                provisioner.restore_state(record['provisioner'])
+            provisioner.attach_store(store, job_id)
+            if reattach:
+                LOGGER.info(f'Reattaching to the hardware of job {job_id}')
+                with phase(operation, 'reattach'):
+                    provisioner.reattach()
+            else:
+                with phase(operation, 'provision', site=provisioner.site):
+                    provisioner.provision_instance()
+    except Exception as e:
+        LOGGER.exception(getattr(e, 'msg', e))
+        # a provisioner that failed on its own has already released its hardware
+        if provisioner is not None and provisioner.status != Status.FAILED:
+            fail_setup(provisioner)
         raise
 
     try:
@@ -30,17 +109,67 @@ def setup(options: dict=None, job_local_log=False):
             app_log_dir = f'{controller.log_directory}/{controller.application_config["job_id"]}'
         else:
             app_log_dir = controller.log_directory
-        ctmanager = AppManager(provisioner.get_remote_runner(),
-                               log_dir=app_log_dir,
-                               cfg=controller.application_config,
-                               allow_attaching=provisioner.allow_attaching)
-    except ApplicationException as e:
-        LOGGER.exception(e.msg)
-        ctmanager.shutdown_job()
-        provisioner.shutdown_instance()
+        with phase(operation, 'application'):
+            from .camera_traps import CameraTrapsManager as AppManager  # pylint: disable=import-outside-toplevel
+            # a job on several nodes manages the application on all of them as a group
+            ctmanager = create_manager(AppManager, provisioner.get_remote_runners(),
+                                       log_dir=app_log_dir,
+                                       cfg=controller.application_config,
+                                       allow_attaching=provisioner.allow_attaching)
+            # only a configured or running application is worth reattaching to, anything
+            # else is cleaned up and set up again
+            if reattach and record['app_status'] in [Status.READY.name, Status.RUNNING.name]:
+                ctmanager.restore_state(record['application'])
+            ctmanager.attach_store(store, job_id)
+    except Exception as e:
+        LOGGER.exception(getattr(e, 'msg', e))
+        fail_setup(provisioner)
         raise
     return controller, provisioner, ctmanager
 
+def fail_setup(provisioner):
+    """
+    Shuts down the hardware of a job whose setup failed and marks it FAILED.
+    A failure to shut down is logged, so that the error of the setup is the one reported.
+
+        Parameters:
+            provisioner (Provisioner): the provisioner of the job
+    """
+
+    try:
+        provisioner.shutdown_instance()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        LOGGER.exception(f'Could not shut down the hardware of the failed job: {getattr(e, "msg", e)}')
+    provisioner.status = Status.FAILED
+
+def release(options: dict):
+    """
+    Releases the hardware of a job that a controller that has since exited was shutting down.
+
+        Parameters:
+            options (dict): the options the job was started with
+    """
+
+    controller = Controller(options)
+    job_id = controller.provisioner_config['job_id']
+    store = get_store()
+    record = store.get(job_id)
+    config = provisioner_config(controller, record)
+    provisioner = site_provisioner(config['target_site'])(config)
+    provisioner.restore_state(record['provisioner'])
+    provisioner.attach_store(store, job_id)
+    LOGGER.info(f'Releasing the hardware of job {job_id}')
+    provisioner.shutdown_instance()
+
+def release_hardware(provisioner):
+    """
+    Parks the hardware of a job whose application has been shut down in the warm pool, or
+    shuts it down if the pool has no room for it.
+    """
+
+    if not get_pool().park(provisioner):
+        provisioner.shutdown_instance()
+
 def run(provisioner, ctmanager):
     try:
         ctmanager.run_job()
@@ -57,7 +186,7 @@ def shutdown(provisioner, ctmanager):
         provisioner.shutdown_instance()
         raise
     else:
-        provisioner.shutdown_instance()
+        release_hardware(provisioner)
 
 def main():
     """
@@ -68,10 +197,22 @@ def main():
     a runner on the provisioned nodes.
     The runner is passed to the app manager, which uses it to setup, run, shutdown, and cleanup
     the application on the provisioned nodes.
-    Once the application has completed, the provisioner shuts down the instance and the program
-    exits.
+    Once the application has completed, the provisioner shuts down the instance, or parks it in
+    the warm pool for the next job, and the program exits.
+    If CT_CONTROLLER_BENCHMARK points to a benchmark description, the benchmark sweep is run
+    instead.
     """
 
+    if os.environ.get('CT_CONTROLLER_BENCHMARK'):
+        from .benchmark import run_benchmark  # pylint: disable=import-outside-toplevel
+        run_benchmark(os.environ['CT_CONTROLLER_BENCHMARK'])
+        return
+
+    # without the API server, idle warm nodes are released by the next run
+    pool = get_pool()
+    if pool.enabled:
+        pool.maintain()
+
     controller, provisioner, ctmanager = setup()
     run(provisioner, ctmanager)
     shutdown(provisioner, ctmanager)
@@ -0,0 +1,222 @@
+"""
+Contains the Executor, which runs local commands as asyncio subprocesses on a background
+event loop. At most CT_CONTROLLER_MAX_PROCESSES commands run at once, and each command runs
+in its own process group, which is killed, children included, once its timeout has passed.
+Every command returns a ShellResult with its exit code, duration and output. The run and
+run_all methods let synchronous code run one command or several independent ones in
+parallel.
+"""
+
+import os
+import time
+import shlex
+import signal
+import asyncio
+import logging
+import threading
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Time in seconds after which a command is killed, unless its caller gives another timeout
+SHELL_TIMEOUT = float(os.environ.get('CT_CONTROLLER_SHELL_TIMEOUT', 300))
+# Number of commands that may run at the same time
+MAX_PROCESSES = int(os.environ.get('CT_CONTROLLER_MAX_PROCESSES', 8))
+# Time in seconds a command has to exit after SIGTERM before it is sent SIGKILL
+KILL_GRACE = 2
+
+class ShellResult():
+    """
+    The outcome of a command.
+
+    Attributes:
+        command (str): the command
+        returncode (int): the exit code, negative if the command was killed by a signal
+        duration (float): time in seconds the command ran for
+        stdout (str): the standard output, stripped
+        stderr (str): the standard error, stripped
+        timed_out (bool): whether the command was killed because it ran past its timeout
+    """
+
+    def __init__(self, command: str, returncode: int, duration: float, stdout: str,
+                 stderr: str, timed_out: bool=False):
+        self.command = command
+        self.returncode = returncode
+        self.duration = duration
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    @property
+    def ok(self) -> bool:
+        """True if the command exited with status 0 within its timeout."""
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self) -> str:
+        return (f'ShellResult({self.command!r}, returncode={self.returncode}, '
+                f'duration={self.duration:.3f}, timed_out={self.timed_out})')
+
+def command_args(cmd) -> list:
+    """Returns the arguments of a command given as a string, split as a shell would, or a list."""
+    if isinstance(cmd, str):
+        return shlex.split(cmd)
+    return [str(arg) for arg in cmd]
+
+class Executor():
+    """
+    Runs commands as subprocesses on an event loop in a background thread.
+
+    Attributes:
+        max_processes (int): number of commands that may run at the same time
+        loop (asyncio.AbstractEventLoop): the event loop, started with the first command
+
+    Methods:
+        execute(cmd, timeout, shell):
+            Coroutine running a command on the loop.
+        run(cmd, timeout, shell):
+            Runs a command and waits for its result.
+        run_all(cmds, timeout, shell):
+            Runs several commands in parallel and waits for all of their results.
+        close():
+            Stops the event loop.
+    """
+
+    def __init__(self, max_processes: int=MAX_PROCESSES):
+        self.max_processes = max(max_processes, 1)
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def serve():
+                    asyncio.set_event_loop(loop)
+                    self.semaphore = asyncio.Semaphore(self.max_processes)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                self.thread = threading.Thread(target=serve, name='ctcontroller-executor', daemon=True)
+                self.thread.start()
+                ready.wait()
+                self.loop = loop
+            return self.loop
+
+    async def execute(self, cmd, timeout: float=None, shell: bool=False) -> ShellResult:
+        """
+        Runs a command once fewer than max_processes are running, killing its process group
+        if it runs for longer than timeout seconds.
+
+            Parameters:
+                cmd (str or list): the command; a string is split as a shell would unless shell is set
+                timeout (float): time in seconds after which the command is killed, None for no limit
+                shell (bool): whether to run the command string with the shell
+
+            Returns:
+                ShellResult: the outcome of the command
+        """
+
+        command = cmd if isinstance(cmd, str) else ' '.join(str(arg) for arg in cmd)
+        async with self.semaphore:
+            start = time.monotonic()
+            if shell:
+                proc = await asyncio.create_subprocess_shell(
+                    command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True)
+            else:
+                proc = await asyncio.create_subprocess_exec(
+                    *command_args(cmd), stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            out = asyncio.ensure_future(proc.stdout.read())
+            err = asyncio.ensure_future(proc.stderr.read())
+            timed_out = False
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                LOGGER.warning(f'"{command}" did not finish within {timeout}s, killing it')
+                await self._kill(proc)
+            duration = time.monotonic() - start
+            try:
+                # the output of a killed command is what it wrote before being killed
+                stdout, stderr = await asyncio.wait_for(asyncio.gather(out, err), KILL_GRACE)
+            except asyncio.TimeoutError:
+                out.cancel()
+                err.cancel()
+                stdout, stderr = b'', b''
+        return ShellResult(command, proc.returncode, duration,
+                           stdout.decode('utf-8', errors='replace').strip(),
+                           stderr.decode('utf-8', errors='replace').strip(), timed_out)
+
+    @staticmethod
+    async def _kill(proc):
+        # the command runs in its own session, so its process group includes its children
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                await asyncio.wait_for(proc.wait(), KILL_GRACE)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+    def run(self, cmd, timeout: float=SHELL_TIMEOUT, shell: bool=False) -> ShellResult:
+        """
+        Runs a command and waits for its result, see execute().
+
+            Parameters:
+                cmd (str or list): the command
+                timeout (float): time in seconds after which the command is killed
+                shell (bool): whether to run the command string with the shell
+
+            Returns:
+                ShellResult: the outcome of the command
+        """
+
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(self.execute(cmd, timeout, shell), loop).result()
+
+    def run_all(self, cmds: list, timeout: float=SHELL_TIMEOUT, shell: bool=False) -> list:
+        """
+        Runs independent commands in parallel, at most max_processes at a time, and waits for
+        all of them.
+
+            Parameters:
+                cmds (list): the commands
+                timeout (float): time in seconds after which each command is killed
+                shell (bool): whether to run the command strings with the shell
+
+            Returns:
+                list: the ShellResult of each command, in order
+        """
+
+        loop = self._start()
+
+        async def gather():
+            return await asyncio.gather(*[self.execute(cmd, timeout, shell) for cmd in cmds])
+        return asyncio.run_coroutine_threadsafe(gather(), loop).result()
+
+    def close(self):
+        """Stops the event loop; commands still running are left to finish on their own."""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self.thread.join()
+            loop.close()
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def get_executor() -> Executor:
+    """Returns the executor shared by the whole process."""
+    global _EXECUTOR  # pylint: disable=global-statement
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = Executor()
+        return _EXECUTOR
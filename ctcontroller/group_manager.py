@@ -0,0 +1,172 @@
+"""
+Contains the GroupManager class, which manages the application on a group of nodes
+reserved together, e.g. several Raspberry Pis or Jetsons used as one throughput unit.
+Each node has its own application manager; the group runs every operation on all of them
+concurrently and reports a single status. The first node is the primary one, whose logs are
+written to the job's log directory; the logs of the other nodes are written to a
+subdirectory named after their device.
+"""
+
+import os
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from .util import Status
+from .state_store import Persistent
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Statuses of a group whose members differ, most significant first: any failure fails the
+# group, and the group is only as far along as its slowest member
+PRECEDENCE = [Status.FAILED, Status.SETTINGUP, Status.PENDING, Status.READY, Status.SAVING,
+              Status.RUNNING, Status.SHUTTINGDOWN, Status.COMPLETE, Status.SHUTDOWN]
+
+def group_status(statuses: list) -> Status:
+    """Returns the status of a group whose members have the given statuses."""
+    for status in PRECEDENCE:
+        if status in statuses:
+            return status
+    return Status.PENDING
+
+def create_manager(AppManager, runners: list, log_dir: str, cfg: dict, allow_attaching: bool):
+    """
+    Creates the application manager of a job: an AppManager if the job has one node, or a
+    GroupManager of one AppManager per node.
+
+        Parameters:
+            AppManager (type): the application manager class, e.g. CameraTrapsManager
+            runners (list): runners connected to the nodes of the job, the primary one first
+            log_dir (str): the log directory of the job
+            cfg (dict): the application configuration
+            allow_attaching (bool): whether the managers may attach to a running application
+
+        Returns:
+            ApplicationManager: the application manager
+    """
+
+    if len(runners) == 1:
+        return AppManager(runners[0], log_dir=log_dir, cfg=cfg, allow_attaching=allow_attaching)
+    managers = []
+    for index, runner in enumerate(runners):
+        node_log_dir = log_dir if index == 0 else os.path.join(log_dir, str(runner.device_id or index))
+        managers.append(AppManager(runner, log_dir=node_log_dir, cfg=cfg, allow_attaching=allow_attaching))
+    return GroupManager(managers)
+
+class GroupManager(Persistent):
+    """
+    Manages the application on several nodes at once.
+
+    Attributes:
+        managers (list): the application managers of the nodes, the primary node first
+        primary (ApplicationManager): the application manager of the primary node
+        log_dir (str): the log directory of the primary node
+        status (Status): the status of the group
+
+    Methods:
+        each(method, *args):
+            Calls a method of every manager concurrently.
+        The methods of the application manager, e.g. cleanup_environment(), run_app() or
+        shutdown_job(), are run on every node.
+    """
+
+    STATE_COMPONENT = 'application'
+    STATE_ATTRIBUTES = ['status', 'run_dir']
+    # the status of the group follows those of its nodes, whose transitions are validated
+    VALIDATE_STATUS = False
+
+    def __init__(self, managers: list):
+        self.managers = managers
+        self.primary = managers[0]
+        self.log_dir = self.primary.log_dir
+        self.runner = self.primary.runner
+        self.allow_attaching = self.primary.allow_attaching
+        self.run_dir = getattr(self.primary, 'run_dir', None)
+        self.status = Status.PENDING
+        for manager in managers:
+            manager.add_status_listener(self._member_changed)
+
+    def __getattr__(self, name: str):
+        # configuration attributes such as mode or version are the same on every node
+        if name in ['managers', 'primary']:
+            raise AttributeError(name)
+        return getattr(self.primary, name)
+
+    def _member_changed(self, _status):
+        self.status = group_status([manager.status for manager in self.managers])
+
+    def each(self, method: str, *args) -> list:
+        """
+        Calls a method of every manager concurrently and waits for all of them. If any
+        fails, the first error is raised once all have finished.
+
+            Parameters:
+                method (str): name of the method
+                args: arguments passed to the method
+
+            Returns:
+                list: the result of each manager, in order
+        """
+
+        with ThreadPoolExecutor(max_workers=len(self.managers), thread_name_prefix='ctcontroller-node') as pool:
+            futures = [pool.submit(contextvars.copy_context().run, getattr(manager, method), *args)
+                       for manager in self.managers]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        for manager, future in zip(self.managers, futures):
+            if future.exception() is not None:
+                LOGGER.error(f'{method} failed on {manager.runner.ip_address}: '
+                             f'{getattr(future.exception(), "msg", future.exception())}')
+        if errors:
+            raise errors[0]
+        return [future.result() for future in futures]
+
+    def update_config(self, cfg) -> bool:
+        return any(self.each('update_config', cfg))
+
+    def cleanup_environment(self):
+        self.each('cleanup_environment')
+
+    def configure_app(self):
+        self.each('configure_app')
+
+    def setup_environment(self):
+        self.each('setup_environment')
+
+    def setup_app(self):
+        self.each('setup_app')
+
+    def remove_app(self):
+        self.each('remove_app')
+
+    def run_app(self):
+        self.each('run_app')
+
+    def stop_app(self, ignore_failure=False):
+        self.each('stop_app', ignore_failure)
+
+    def copy_results(self):
+        self.each('copy_results')
+
+    def run_job(self):
+        self.each('run_job')
+
+    def shutdown_job(self):
+        self.each('shutdown_job')
+
+    def stop_running_containers(self):
+        self.each('stop_running_containers')
+
+    def get_application_health(self) -> Status:
+        return group_status(self.each('get_application_health'))
+
+    def get_status(self) -> Status:
+        self.status = group_status(self.each('get_status'))
+        return self.status
+
+    def restore_state(self, state: dict):
+        """Sets the state of the group and of every node from a persisted state."""
+        for manager in self.managers:
+            manager.restore_state(state)
+        super().restore_state(state)
+
+    def __repr__(self) -> str:
+        return f'GroupManager({[manager.runner.ip_address for manager in self.managers]})'
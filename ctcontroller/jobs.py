@@ -0,0 +1,296 @@
+"""
+Contains the Job and JobRegistry classes used by the API server to manage several
+deployments at once. Each job has its own controller, provisioner and application manager,
+a lock serializing the requests that change it, the hub publishing its logs and a version
+number bumped on every status change, which clients can wait on.
+"""
+
+import os
+import time
+import asyncio
+import threading
+from .util import Status
+from .log_hub import LogHub
+from .tracing import TRACER
+
+# Minimum time in seconds between two checks of the application health on the node
+HEALTH_INTERVAL = float(os.environ.get('CT_CONTROLLER_HEALTH_INTERVAL', 2))
+
+# Distinguishes the versions of this server process from those of a previous one
+BOOT_ID = format(int(time.time() * 1000), 'x')
+
+class StatusVersion():
+    """
+    A version number bumped whenever the status of a job changes.
+    It is bumped from any thread and waited on from the event loop.
+
+    Attributes:
+        version (int): the current version
+
+    Methods:
+        bump():
+            Increments the version and wakes the waiters.
+        wait(version, timeout):
+            Waits until the version differs from version or timeout seconds have passed.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.lock = threading.Lock()
+        self.waiters = set()
+
+    def bump(self):
+        """Increments the version and wakes every waiter."""
+        with self.lock:
+            self.version += 1
+            waiters = list(self.waiters)
+            self.waiters.clear()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    async def wait(self, version: int, timeout: float) -> int:
+        """
+        Waits until the version differs from version or timeout seconds have passed.
+
+            Parameters:
+                version (int): the version the caller has already seen
+                timeout (float): maximum time to wait in seconds
+
+            Returns:
+                int: the current version
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self.lock:
+            if self.version != version:
+                return self.version
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+        return self.version
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class Job():
+    """
+    The state of one deployment managed by the API server.
+
+    Attributes:
+        job_id (str): id of the job, None for the default job until it is started
+        controller (Controller): the controller of the job
+        provisioner (Provisioner): the provisioner of the job
+        appmanager (ApplicationManager): the application manager of the job
+        operation (Operation): the latest startup operation of the job
+        run_operation (Operation): the latest run of the application
+        lock (threading.RLock): serializes the requests changing the job
+        versions (StatusVersion): bumped whenever the status of the job changes
+
+    Methods:
+        starting():
+            Returns True while a startup operation is in progress.
+        running():
+            Returns True while a run of the application is in progress.
+        attach(controller, provisioner, appmanager):
+            Sets the components of a started job and watches their status.
+        get_status():
+            Returns the status of the hardware and application.
+        refresh_status():
+            Returns the status, checking the application at most every HEALTH_INTERVAL.
+        watched():
+            Returns True while the status changes are all made by this process.
+        history():
+            Returns the status transitions of the hardware and application.
+        etag():
+            Returns an entity tag identifying the current status.
+        app_is_running():
+            Returns True while the application is running.
+        app_log_paths():
+            Returns the paths to the application logs.
+        log_hub():
+            Returns the hub publishing the application logs.
+        reset():
+            Forgets the controller, provisioner and application manager.
+        to_dict():
+            Returns a JSON-serializable summary of the job.
+    """
+
+    def __init__(self, job_id: str=None):
+        self.job_id = job_id
+        self.controller = None
+        self.provisioner = None
+        self.appmanager = None
+        self.operation = None
+        self.run_operation = None
+        self.lock = threading.RLock()
+        self.log_hubs = {}
+        self.versions = StatusVersion()
+        self.refresh_lock = threading.Lock()
+        self.refreshed = 0
+
+    def starting(self) -> bool:
+        """Returns True while a startup operation is in progress."""
+        return self.operation is not None and not self.operation.done()
+
+    def running(self) -> bool:
+        """Returns True while a run of the application is in progress."""
+        return self.run_operation is not None and not self.run_operation.done()
+
+    def status_changed(self, status: Status=None):
+        """Bumps the status version, called whenever a status of the job changes."""
+        self.versions.bump()
+
+    def attach(self, controller, provisioner, appmanager):
+        """Sets the components of a started job and bumps the version on their status changes."""
+        self.controller, self.provisioner, self.appmanager = controller, provisioner, appmanager
+        provisioner.add_status_listener(self.status_changed)
+        appmanager.add_status_listener(self.status_changed)
+        self.refreshed = time.monotonic()
+        self.status_changed()
+
+    def get_status(self) -> dict:
+        """Returns the status of the hardware and the application."""
+        if self.controller is None:
+            hardware = Status.SETTINGUP if self.starting() else Status.PENDING
+            return {'hardware': hardware.name, 'app': Status.PENDING.name}
+        return {'hardware': self.provisioner.get_status().name, 'app': self.appmanager.get_status().name}
+
+    def refresh_status(self, max_age: float=HEALTH_INTERVAL) -> dict:
+        """
+        Returns the status of the hardware and the application. The application health is
+        checked on the node at most every max_age seconds; in between, and while the run of the
+        application is watched by this process, the last known status is returned without
+        touching the node.
+        """
+        if self.controller is None:
+            return self.get_status()
+        with self.refresh_lock:
+            if not self.watched() and time.monotonic() - self.refreshed >= max_age:
+                self.refreshed = time.monotonic()
+                return self.get_status()
+        return {'hardware': self.provisioner.status.name, 'app': self.appmanager.status.name}
+
+    def watched(self) -> bool:
+        """
+        Returns True while a run of the application is in progress in this process, whose
+        status changes are published as they happen and need not be checked on the node.
+        """
+        return self.running()
+
+    def history(self) -> dict:
+        """Returns the latest status transitions of the hardware and the application."""
+        if self.controller is None:
+            return {'hardware': [], 'app': []}
+        return {'hardware': [transition.to_dict() for transition in self.provisioner.status_history()],
+                'app': [transition.to_dict() for transition in self.appmanager.status_history()]}
+
+    def etag(self) -> str:
+        """Returns an entity tag identifying the current version of the status."""
+        return f'"{BOOT_ID}-{self.versions.version}"'
+
+    def app_is_running(self) -> bool:
+        """Returns True while the application is running, without querying the remote node."""
+        return self.appmanager is not None and self.appmanager.status == Status.RUNNING
+
+    def app_log_paths(self) -> dict:
+        """Returns the paths to the application stdout and stderr logs keyed by stream."""
+        return {'stdout': f'{self.appmanager.log_dir}/ct_out.log',
+                'stderr': f'{self.appmanager.log_dir}/ct_err.log'}
+
+    def log_hub(self) -> LogHub:
+        """Returns the hub publishing the logs of the current run, shared by all viewers of the job."""
+        run_id = self.run_operation.id if self.run_operation is not None else None
+        key = (self.appmanager.log_dir, run_id)
+        if key not in self.log_hubs:
+            # a new run starts its logs over, so the hubs of earlier runs are forgotten
+            self.log_hubs = {key: LogHub(self.app_log_paths(), self.app_is_running)}
+        return self.log_hubs[key]
+
+    def reset(self):
+        """Forgets the controller, provisioner and application manager after a shutdown."""
+        self.controller = None
+        self.provisioner = None
+        self.appmanager = None
+        self.status_changed()
+
+    def to_dict(self) -> dict:
+        """Returns a JSON-serializable summary of the job."""
+        summary = {'job_id': self.job_id, 'status': self.refresh_status()}
+        if self.operation is not None:
+            summary['operation_id'] = self.operation.id
+        if self.run_operation is not None:
+            summary['run_operation_id'] = self.run_operation.id
+        return summary
+
+class JobRegistry():
+    """
+    Keeps track of the jobs managed by the API server.
+    The default job backs the endpoints that are not scoped to a job, so that clients
+    managing a single deployment keep working unchanged.
+
+    Attributes:
+        default (Job): the job used by the unscoped endpoints
+        jobs (dict): maps a job id to its job
+
+    Methods:
+        get(job_id):
+            Returns the job with the given id, or None.
+        get_or_create(job_id):
+            Returns the job with the given id, creating it if needed.
+        release(job):
+            Forgets a job once it has been shut down.
+        list():
+            Returns all jobs.
+    """
+
+    def __init__(self):
+        self.default = Job()
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def get(self, job_id: str) -> Job:
+        """Returns the job with the given id, or None."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and job_id is not None and self.default.job_id == job_id:
+            return self.default
+        return job
+
+    def get_or_create(self, job_id: str) -> Job:
+        """Returns the job with the given id, creating an empty one if it does not exist."""
+        if self.default.job_id == job_id:
+            return self.default
+        with self.lock:
+            if job_id not in self.jobs:
+                self.jobs[job_id] = Job(job_id)
+            return self.jobs[job_id]
+
+    def release(self, job: Job):
+        """
+        Forgets a job, and its timings, once it has been shut down.
+        The default job is kept, empty, for the next startup.
+        """
+        TRACER.forget(job.job_id)
+        if job is self.default:
+            job.reset()
+            job.job_id = None
+            return
+        with self.lock:
+            if self.jobs.get(job.job_id) is job:
+                del self.jobs[job.job_id]
+
+    def list(self) -> list:
+        """Returns the default job, if it has been started, and all other jobs."""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        if self.default.job_id is not None and self.default.job_id not in self.jobs:
+            jobs.insert(0, self.default)
+        return jobs
@@ -4,12 +4,26 @@ Contains the LocalRunner class, providing analogous functionality to RemoteRunne
 
 import socket
 import os
+import platform
 import logging
 from shutil import copy, copytree
-from subprocess import run as shell_run
+from threading import Thread
+from subprocess import run as shell_run, Popen, PIPE
+from .logfiles import RotatingLogWriter, CHUNK_SIZE
+from .tracing import command_attributes, transfer_attributes, traced
 
 LOGGER = logging.getLogger("CT Controller")
 
+def local_cpu_arch() -> str:
+    """
+    Returns `arm` if the localhost has an ARM-based architecture and `x86` otherwise,
+    without running any command.
+    """
+    machine = platform.machine().lower()
+    if any(arch in machine for arch in ['arm', 'aarch']):
+        return 'arm'
+    return 'x86'
+
 class LocalRunner():
     """
     A drop-in replacement for RemoteRunner that runs commands on the localhost
@@ -52,12 +66,9 @@ class LocalRunner():
         """
         Determine whether runner is running on an ARM-based on x86-based architecture
         """
-        machine = self.run('uname -m')
-        if any(arch in machine for arch in ['arm', 'aarch']):
-            return 'arm'
-        else:
-            return 'x86'
+        return local_cpu_arch()
 
+    @traced('runner.run', command_attributes)
     def run(self, cmd: str) -> str:
         """
         Run a command on the localhost shell
@@ -73,7 +84,20 @@ class LocalRunner():
         output = shell_run(cmd, capture_output=True, shell=True)
         return output.stdout.decode('utf-8').strip()# + '\n' + output.stderr.decode('utf-8').strip()
 
-    def tracked_run(self, cmd: str, outlog: str, errlog: str):
+    def log_to_file(self, file: RotatingLogWriter, stream):
+        """
+            Copy a binary stream to a log writer
+
+            Parameters:
+                file (RotatingLogWriter): the writer of a local log file
+                stream: the stream that is being logged
+        """
+
+        for chunk in iter(lambda: stream.read1(CHUNK_SIZE), b''):
+            file.write(chunk)
+
+    @traced('runner.tracked_run', command_attributes)
+    def tracked_run(self, cmd: str, outlog: str, errlog: str, rotation: dict=None):
         """
         Runs a shell command, logging the stdout and stderr to local files
         in background threads.
@@ -82,12 +106,21 @@ class LocalRunner():
                 cmd (str): the command to run on the remote server
                 outlog (str): local path the stdout log file
                 errlog (str): local path to the stderr log file
+                rotation (dict): rotation settings passed to RotatingLogWriter
         """
 
         LOGGER.info((f'Running "{cmd}".\n'
               f'Logging stdout=>{outlog} and stderr=>{errlog}'))
-        with open(outlog, "w") as out, open(errlog, "w") as err:
-            shell_run(cmd, stdout=out, stderr=err, shell=True)
+        with RotatingLogWriter(outlog, append=False, **(rotation or {})) as out, \
+             RotatingLogWriter(errlog, append=False, **(rotation or {})) as err:
+            proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+            out_thread = Thread(target=self.log_to_file, args=(out, proc.stdout))
+            err_thread = Thread(target=self.log_to_file, args=(err, proc.stderr))
+            out_thread.start()
+            err_thread.start()
+            out_thread.join()
+            err_thread.join()
+            proc.wait()
 
     def create_file(self, fpath: str):
         """
@@ -126,6 +159,7 @@ class LocalRunner():
         return os.path.exists(fpath)
 
 
+    @traced('runner.copy_file', transfer_attributes)
     def copy_file(self, src: str, target: str):
         """
         Copies a file from source to target path.
@@ -137,6 +171,7 @@ class LocalRunner():
 
         copy(src, target)
 
+    @traced('runner.get', transfer_attributes)
     def get(self, src: str, target: str) -> None:
         """
         Copies a directory from source to target path.
@@ -5,7 +5,6 @@ import time
 import logging
 from .util import ProvisionException, Status
 from .provisioner import Provisioner
-from .remote import AuthenticationException
 
 LOGGER = logging.getLogger("CT Controller")
 
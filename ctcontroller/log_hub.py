@@ -0,0 +1,211 @@
+"""
+Contains the LogHub class, which fans the application logs out to many viewers.
+A single reader per job follows the log files and publishes the new lines to every
+subscriber through a bounded queue, so disk reads do not grow with the number of viewers
+and a slow viewer cannot stall the reader or the other viewers.
+"""
+
+import os
+import asyncio
+import logging
+from collections import deque
+from .logfiles import SegmentedLog
+from .log_stream import follow_logs
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Size in bytes of the recent output replayed to new subscribers
+REPLAY_BYTES = int(os.environ.get('CT_CONTROLLER_LOG_REPLAY_BYTES', 65536))
+# Number of batches of lines that can be queued for a subscriber
+QUEUE_SIZE = int(os.environ.get('CT_CONTROLLER_LOG_QUEUE_SIZE', 256))
+
+# Tag of the marker sent to a subscriber that was skipped ahead
+SKIPPED = 'skipped'
+
+class Subscription():
+    """
+    A viewer of a LogHub.
+    Iterating over a subscription yields (tag, bytes) tuples, starting with the replayed
+    recent output. When the viewer falls behind, it is either dropped (iteration stops) or
+    skipped ahead: its queue is emptied and a ('skipped', count) marker is yielded instead
+    of the discarded batches.
+
+    Attributes:
+        policy (str): what to do when the queue is full, `skip` or `drop`
+        dropped (bool): whether the subscriber was dropped for being too slow
+        skipped (int): number of batches discarded for this subscriber
+    """
+
+    def __init__(self, backlog: list, policy: str='skip', maxsize: int=QUEUE_SIZE):
+        if policy not in ['skip', 'drop']:
+            raise ValueError(f'Invalid slow subscriber policy {policy}')
+        self.backlog = deque(backlog)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.policy = policy
+        self.dropped = False
+        self.skipped = 0
+        self.closed = False
+
+    def offer(self, item) -> bool:
+        """
+        Queues an item without blocking.
+
+            Returns:
+                bool: False if the subscriber has been dropped
+        """
+
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.policy == 'drop':
+            self.dropped = True
+            self.close()
+            return False
+        # skip ahead: discard everything queued and let the viewer know
+        discarded = 0
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            discarded += 1
+        self.skipped += discarded
+        self.queue.put_nowait((SKIPPED, str(discarded).encode()))
+        self.queue.put_nowait(item)
+        return True
+
+    def close(self):
+        """Ends the subscription once the queued items have been consumed."""
+
+        if self.closed:
+            return
+        self.closed = True
+        if self.dropped:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.backlog:
+            return self.backlog.popleft()
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+class LogHub():
+    """
+    Publishes the application logs of one job to any number of subscribers.
+    The reader is started by the first subscriber and runs while the application is running
+    and somebody is watching. The most recent output is kept in a bounded buffer that is
+    replayed to new subscribers.
+
+    Attributes:
+        paths (dict): maps a stream tag to the path of its log file
+        is_running (callable): returns True while the application is running
+        replay_bytes (int): size of the replay buffer in bytes
+        subscribers (set): the current subscriptions
+
+    Methods:
+        subscribe(policy):
+            Adds a subscriber and starts the reader if needed.
+        unsubscribe(sub):
+            Removes a subscriber and stops the reader if nobody is left.
+    """
+
+    def __init__(self, paths: dict, is_running, replay_bytes: int=REPLAY_BYTES, queue_size: int=QUEUE_SIZE):
+        self.paths = paths
+        self.is_running = is_running
+        self.replay_bytes = replay_bytes
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.replay = deque()
+        self.replay_size = 0
+        self.offsets = None
+        self.task = None
+
+    def _start_offsets(self) -> tuple:
+        # start from the replay window rather than the beginning of a possibly huge log, or
+        # from where the previous reader stopped, which is always at the end of a line
+        previous = self.offsets or {}
+        offsets, partial = {}, {}
+        for tag, path in self.paths.items():
+            log = SegmentedLog(path)
+            first, size = log.first_offset(), log.size()
+            start = max(first, size - self.replay_bytes)
+            stopped = previous.get(tag)
+            # a log shorter than where the reader stopped was started over by a new run
+            if stopped is not None and stopped <= size:
+                start = max(start, stopped)
+            offsets[tag] = start
+            # jumping to the replay window may cut a line, whose remainder is not published
+            partial[tag] = start != stopped and start > first and log.read(start - 1, 1) != b'\n'
+        return offsets, partial
+
+    def subscribe(self, policy: str='skip') -> Subscription:
+        """
+        Adds a subscriber, replaying the recent output to it, and starts the reader if the
+        application is running.
+
+            Parameters:
+                policy (str): `skip` or `drop`, what to do when the subscriber falls behind
+
+            Returns:
+                Subscription: the new subscription
+        """
+
+        sub = Subscription(list(self.replay), policy, self.queue_size)
+        self.subscribers.add(sub)
+        if self.task is None or self.task.done():
+            if self.is_running() or self.offsets is None:
+                self.task = asyncio.create_task(self._read())
+            else:
+                sub.close()
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        """Removes a subscriber and stops the reader once nobody is watching."""
+
+        self.subscribers.discard(sub)
+        sub.close()
+        if not self.subscribers and self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def _remember(self, item):
+        self.replay.append(item)
+        self.replay_size += len(item[1])
+        while self.replay_size > self.replay_bytes and len(self.replay) > 1:
+            _, old = self.replay.popleft()
+            self.replay_size -= len(old)
+
+    def _publish(self, item):
+        self._remember(item)
+        for sub in list(self.subscribers):
+            if not sub.offer(item):
+                LOGGER.info('Dropping log subscriber that fell behind')
+                self.subscribers.discard(sub)
+
+    async def _read(self):
+        offsets, partial = await asyncio.to_thread(self._start_offsets)
+        self.offsets = dict(offsets)
+        try:
+            async for tag, data in follow_logs(self.paths, self.is_running, offsets):
+                self.offsets[tag] += len(data)
+                if partial.pop(tag, False):
+                    data = data[data.find(b'\n') + 1:]
+                    if not data:
+                        continue
+                self._publish((tag, data))
+        except asyncio.CancelledError:
+            return
+        for sub in list(self.subscribers):
+            sub.close()
+        self.subscribers.clear()
@@ -0,0 +1,134 @@
+"""
+Contains the logging pipeline of the controller. The thread logging a record only tags it
+with the job, phase and node it concerns and puts it on a queue; a single background thread
+writes the queued records to the console and to run.log, so that request handlers and SSH
+loops never wait on a terminal or a disk. Records are written as text, or as one JSON object
+per line with CT_CONTROLLER_LOG_FORMAT=json. Only the console colors warnings and errors;
+the messages themselves, and so the files, carry no color codes.
+"""
+
+import os
+import re
+import copy
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, UTC
+from .tracing import current_job_id, current_span
+
+# Format of the records written to the console and run.log, text or json
+LOG_FORMAT = os.environ.get('CT_CONTROLLER_LOG_FORMAT', 'text')
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+ANSI_CODES = re.compile(r'\x1b\[[0-9;]*m')
+# Console colors of the levels worth noticing
+LEVEL_COLORS = {logging.WARNING: '\033[93m', logging.ERROR: '\033[91m', logging.CRITICAL: '\033[91m'}
+
+def strip_ansi(text: str) -> str:
+    """Removes the terminal color codes from text."""
+    return ANSI_CODES.sub('', text)
+
+def _context() -> tuple:
+    # pylint: disable=import-outside-toplevel
+    from .operations import current_phase
+    span = current_span()
+    phase = current_phase() or (span.name if span is not None else None)
+    node = None
+    while span is not None and node is None:
+        node = span.attributes.get('host')
+        span = span.parent
+    return current_job_id(), phase, node
+
+class ContextFilter(logging.Filter):
+    """Tags each record with the job_id, phase and node of the context logging it."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id, record.phase, record.node = _context()
+        return True
+
+class PlainFormatter(logging.Formatter):
+    """Formats records as text without terminal color codes."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return strip_ansi(super().format(record))
+
+class ColorFormatter(logging.Formatter):
+    """Formats records as text, colored by level for the console."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        color = LEVEL_COLORS.get(record.levelno)
+        return f'{color}{text}\033[00m' if color else text
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects with their time, level, message and context."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created, UTC).isoformat(),
+                 'level': record.levelname, 'message': strip_ansi(record.getMessage()),
+                 'job_id': getattr(record, 'job_id', None), 'phase': getattr(record, 'phase', None),
+                 'node': getattr(record, 'node', None), 'thread': record.threadName,
+                 'location': f'{record.pathname}:{record.lineno}'}
+        if record.exc_info:
+            entry['exception'] = strip_ansi(self.formatException(record.exc_info))
+        return json.dumps(entry)
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue with their message formatted, keeping their exception so that
+    the handlers of the listener format it as they see fit, e.g. as its own JSON field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class PipelineListener(logging.handlers.QueueListener):
+    """
+    A QueueListener that can be stopped more than once, e.g. explicitly and again at exit.
+    QueueListener.stop fails on its second call on Python 3.11 and earlier.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_lock = threading.Lock()
+
+    def stop(self):
+        with self.stop_lock:
+            if self._thread is not None:
+                super().stop()
+
+def start_pipeline(logger: logging.Logger, console: logging.Handler, logfile: logging.Handler,
+                   fmt: str=LOG_FORMAT) -> logging.handlers.QueueListener:
+    """
+    Routes the records of logger through a queue to the console and log file handlers,
+    written by a background thread that is stopped, after writing the records left, at exit.
+
+        Parameters:
+            logger (logging.Logger): the logger
+            console (logging.Handler): the handler writing to the console
+            logfile (logging.Handler): the handler writing to the log file
+            fmt (str): text or json
+
+        Returns:
+            PipelineListener: the background writer
+    """
+
+    if fmt == 'json':
+        console.setFormatter(JsonFormatter())
+        logfile.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(ColorFormatter(TEXT_FORMAT))
+        logfile.setFormatter(PlainFormatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    handler = ContextQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    listener = PipelineListener(records, console, logfile, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(handler)
+    return listener
@@ -0,0 +1,135 @@
+"""
+Contains helpers to serve log files from the API server.
+Logs can be downloaded whole, by HTTP byte range, by logical offset and limit, or as their
+last lines. Responses are gzip-compressed when the client accepts it and no byte range
+was requested.
+"""
+
+import os
+import re
+import gzip
+import zlib
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from .logfiles import SegmentedLog, is_segmented
+
+# Largest response returned by a single offset/limit read
+MAX_READ = 16 * 1024 * 1024
+# Responses smaller than this are never compressed
+MIN_GZIP = 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def accepts_gzip(request: Request) -> bool:
+    """Returns True if the client accepts gzip-encoded responses."""
+
+    return 'gzip' in request.headers.get('accept-encoding', '').lower()
+
+def parse_range(header: str, size: int):
+    """
+    Parses a single HTTP byte range.
+
+        Parameters:
+            header (str): value of the Range header
+            size (int): size of the representation in bytes
+
+        Returns:
+            tuple: (start, end) with end inclusive, or None if the header should be ignored
+    """
+
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        # multiple or malformed ranges, serve the whole log instead
+        return None
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last != '' else size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail='Requested range not satisfiable',
+                            headers={'Content-Range': f'bytes */{size}'})
+    return start, end
+
+def gzip_chunks(chunks):
+    """Compresses an iterator of bytes into a gzip stream."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+def _check_exists(path: str):
+    if not os.path.exists(path) and not is_segmented(path):
+        raise HTTPException(status_code=404, detail=f'{os.path.basename(path)} does not exist yet')
+
+def log_download(request: Request, path: str, filename: str, media_type: str='text/plain'):
+    """
+    Returns a log file as a download, honouring a single HTTP byte range.
+    Rotated logs are served as one contiguous file starting at the oldest retained byte.
+
+        Parameters:
+            request (Request): the incoming request
+            path (str): path to the (active) log file
+            filename (str): name of the downloaded file
+            media_type (str): media type of the response
+    """
+
+    _check_exists(path)
+    log = SegmentedLog(path)
+    first = log.first_offset()
+    size = log.size() - first
+    headers = {'Accept-Ranges': 'bytes',
+               'Content-Disposition': f'attachment; filename="{filename}"'}
+    byte_range = parse_range(request.headers['range'], size) if 'range' in request.headers else None
+    if byte_range is not None:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(log.iter_chunks(first + start, first + end + 1), status_code=206,
+                                 media_type=media_type, headers=headers)
+    chunks = log.iter_chunks(first, first + size)
+    if accepts_gzip(request) and size >= MIN_GZIP:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+        return StreamingResponse(gzip_chunks(chunks), media_type=media_type, headers=headers)
+    headers['Content-Length'] = str(size)
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+def log_read(request: Request, path: str, offset: int=None, limit: int=MAX_READ, tail: int=None):
+    """
+    Returns part of a log: its last tail lines, or up to limit bytes from a logical offset.
+    The X-Log-Offset, X-Log-Next-Offset, X-Log-First-Offset and X-Log-Size headers give the
+    logical offsets of the returned data, of the next byte to read, of the oldest retained
+    byte and of the end of the log, so clients can page through or poll the log.
+
+        Parameters:
+            request (Request): the incoming request
+            path (str): path to the (active) log file
+            offset (int): logical offset of the first byte to return
+            limit (int): maximum number of bytes to return
+            tail (int): number of lines to return from the end of the log
+    """
+
+    _check_exists(path)
+    log = SegmentedLog(path)
+    first = log.first_offset()
+    if tail is not None:
+        start, data = log.tail(tail)
+    else:
+        start = first if offset is None else max(offset, first)
+        data = log.read(start, min(limit, MAX_READ))
+    headers = {'X-Log-Offset': str(start),
+               'X-Log-Next-Offset': str(start + len(data)),
+               'X-Log-First-Offset': str(first),
+               'X-Log-Size': str(log.size())}
+    if accepts_gzip(request) and len(data) >= MIN_GZIP:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+        data = gzip.compress(data)
+    return Response(content=data, media_type='text/plain', headers=headers)
@@ -0,0 +1,278 @@
+"""
+Contains the asynchronous tail-follow readers used to stream the application logs.
+Log files are read in large chunks from persistent file handles, in a worker thread so that
+a slow disk or the decompression of a rotated segment does not hold up the event loop. On
+Linux, inotify is used to wake the readers when the log directory changes; elsewhere the
+readers fall back to polling.
+"""
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+from .logfiles import SegmentIndex, SegmentedLog, CHUNK_SIZE
+
+LOGGER = logging.getLogger("CT Controller")
+
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+
+# How often the readers check the application status while the logs are idle
+STATUS_INTERVAL = 1.0
+
+_LIBC = None
+
+def _libc():
+    global _LIBC
+    if _LIBC is None:
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True) if name else None
+        _LIBC = libc if libc is not None and hasattr(libc, 'inotify_init1') else False
+    return _LIBC
+
+class DirectoryWatcher():
+    """
+    Wakes asynchronous readers when files in a set of directories change.
+    Uses inotify when it is available and otherwise times out after the poll interval.
+
+    Attributes:
+        fd (int): the inotify file descriptor or None when polling
+
+    Methods:
+        wait(timeout):
+            Waits until a watched directory changes or timeout seconds have passed.
+        close():
+            Stops watching.
+    """
+
+    def __init__(self, directories: list):
+        self.fd = None
+        self.event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        libc = _libc()
+        if not libc:
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            LOGGER.debug(f'inotify unavailable ({os.strerror(ctypes.get_errno())}), polling logs')
+            return
+        for directory in set(directories):
+            if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+                LOGGER.debug(f'Could not watch {directory}: {os.strerror(ctypes.get_errno())}')
+        self.fd = fd
+        self.loop.add_reader(fd, self._on_event)
+
+    def _on_event(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.event.set()
+
+    async def wait(self, timeout: float):
+        """
+        Waits until a watched directory changes or timeout seconds have passed.
+
+            Parameters:
+                timeout (float): maximum time to wait in seconds
+        """
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+    def close(self):
+        """Stops watching and closes the inotify file descriptor."""
+
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+class LogFollower():
+    """
+    Follows a single, possibly rotated, log file.
+    The history is read through the segment index, then the active file is followed from a
+    persistent handle. When the active file is rotated the old handle is drained before the
+    new file is opened.
+
+    Attributes:
+        path (str): path to the active log file
+        tag (str): name of the stream, e.g. stdout or stderr
+        offset (int): logical offset of the next byte to be read
+
+    Methods:
+        read():
+            Returns all bytes that are currently available.
+        lines(final):
+            Returns the complete lines that are currently available.
+        close():
+            Closes the file handle.
+    """
+
+    def __init__(self, path: str, tag: str, offset: int=0, chunk_size: int=CHUNK_SIZE):
+        self.path = path
+        self.tag = tag
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.fil = None
+        self.partial = b''
+
+    def _open_active(self) -> bool:
+        index = SegmentIndex(self.path)
+        with index.lock:
+            try:
+                fil = open(self.path, 'rb')
+            except FileNotFoundError:
+                return False
+            active_start = index.load()['active_start']
+        if self.offset < active_start:
+            # rotated while reading the history, read the rest from the segments
+            fil.close()
+            return False
+        fil.seek(self.offset - active_start)
+        self.fil = fil
+        return True
+
+    def _rotated(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.fil.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def read(self) -> bytes:
+        """Returns all bytes that are currently available, read in large chunks."""
+
+        chunks = []
+        if self.fil is None:
+            log = SegmentedLog(self.path)
+            self.offset = max(self.offset, log.first_offset())
+            active_start = log.parts()[-1][0]
+            if self.offset < active_start:
+                for chunk in log.iter_chunks(self.offset, active_start, self.chunk_size):
+                    chunks.append(chunk)
+                    self.offset += len(chunk)
+            if not self._open_active():
+                return b''.join(chunks)
+        while True:
+            chunk = self.fil.read(self.chunk_size)
+            if chunk:
+                chunks.append(chunk)
+                self.offset += len(chunk)
+                continue
+            if self._rotated():
+                # the old file has been drained, switch to the new active file
+                self.fil.close()
+                self.fil = None
+                if not self._open_active():
+                    break
+                continue
+            break
+        return b''.join(chunks)
+
+    def lines(self, final: bool=False) -> bytes:
+        """
+        Returns the complete lines that are currently available.
+        The trailing partial line is kept until it is completed, or returned if final is set.
+        """
+
+        data = self.partial + self.read()
+        if final:
+            self.partial = b''
+            return data
+        cut = data.rfind(b'\n') + 1
+        self.partial = data[cut:]
+        return data[:cut]
+
+    def close(self):
+        """Closes the file handle."""
+
+        if self.fil is not None:
+            self.fil.close()
+            self.fil = None
+
+def _read_lines(followers: list, final: bool) -> list:
+    return [(follower.tag, follower.lines(final=final)) for follower in followers]
+
+def _close_followers(followers: list, future: asyncio.Future=None):
+    if future is not None and not future.cancelled():
+        # the exception of a read nobody waits for any more is not worth reporting
+        future.exception()
+    for follower in followers:
+        follower.close()
+
+async def follow_logs(paths: dict, is_running, offsets: dict=None, chunk_size: int=CHUNK_SIZE):
+    """
+    Follows several log files and yields their new lines as they are written.
+    Output of the different files is interleaved in the order it is read. Following stops
+    once is_running returns False and the files have been drained.
+
+        Parameters:
+            paths (dict): maps a stream tag to the path of its log file
+            is_running (callable): returns True while the application is running
+            offsets (dict): maps a stream tag to the logical offset to start from
+            chunk_size (int): size of each read
+
+        Yields:
+            tuple: (tag, bytes) with one or more complete lines
+    """
+
+    offsets = offsets or {}
+    followers = [LogFollower(path, tag, offsets.get(tag, 0), chunk_size) for tag, path in paths.items()]
+    watcher = DirectoryWatcher([os.path.dirname(os.path.abspath(p)) for p in paths.values()])
+    loop = asyncio.get_running_loop()
+    reading = None
+    try:
+        while True:
+            running = is_running()
+            idle = True
+            reading = loop.run_in_executor(None, _read_lines, followers, not running)
+            # a cancelled reader leaves the read to finish in its thread before closing the files
+            for tag, data in await asyncio.shield(reading):
+                if data:
+                    idle = False
+                    yield tag, data
+            if not running:
+                break
+            if idle:
+                await watcher.wait(STATUS_INTERVAL)
+    finally:
+        watcher.close()
+        if reading is not None and not reading.done():
+            reading.add_done_callback(lambda future: _close_followers(followers, future))
+        else:
+            _close_followers(followers)
+
+def format_text(tag: str, data: bytes) -> bytes:
+    """Prefixes every line of data with its stream tag."""
+
+    prefix = f'[{tag}] '.encode()
+    lines = data.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    return b''.join(prefix + line + b'\n' for line in lines)
+
+def format_sse(tag: str, data: bytes) -> bytes:
+    """Formats data as a Server-Sent Event whose event type is the stream tag."""
+
+    text = data.decode('utf-8', errors='replace')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    body = ''.join(f'data: {line.rstrip(chr(13))}\n' for line in lines)
+    return f'event: {tag}\n{body}\n'.encode('utf-8')
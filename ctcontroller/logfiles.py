@@ -0,0 +1,469 @@
+"""
+Contains helpers to write and read the application log files.
+Application logs can be rotated by size and age. Rotated segments are compressed in the
+background and recorded in a segment index so that readers can still serve the log as a
+single contiguous stream.
+"""
+
+import os
+import gzip
+import json
+import time
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger("CT Controller")
+
+CHUNK_SIZE = 65536
+
+_COMPRESSOR = None
+_COMPRESSOR_LOCK = threading.Lock()
+_INDEX_LOCKS = {}
+
+def _compressor():
+    global _COMPRESSOR
+    with _COMPRESSOR_LOCK:
+        if _COMPRESSOR is None:
+            _COMPRESSOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-compress')
+        return _COMPRESSOR
+
+def _index_lock(path):
+    with _COMPRESSOR_LOCK:
+        return _INDEX_LOCKS.setdefault(os.path.abspath(path), threading.RLock())
+
+def rotation_settings(mode: str=None) -> dict:
+    """
+    Returns the rotation settings for application logs.
+    Rotation is enabled in demo mode or whenever a maximum size or age is set in the
+    environment through CT_CONTROLLER_APP_LOG_MAX_BYTES or CT_CONTROLLER_APP_LOG_MAX_AGE
+    (in seconds). CT_CONTROLLER_APP_LOG_BACKUP_COUNT sets how many rotated segments are kept.
+
+        Parameters:
+            mode (str): the run mode of the application
+
+        Returns:
+            dict: keyword arguments for RotatingLogWriter
+    """
+
+    max_bytes = int(os.environ.get('CT_CONTROLLER_APP_LOG_MAX_BYTES', 0))
+    max_age = int(os.environ.get('CT_CONTROLLER_APP_LOG_MAX_AGE', 0))
+    backup_count = int(os.environ.get('CT_CONTROLLER_APP_LOG_BACKUP_COUNT', 10))
+    if mode == 'demo' and not max_bytes and not max_age:
+        max_bytes = 50000000
+    return {'max_bytes': max_bytes, 'max_age': max_age, 'backup_count': backup_count}
+
+class SegmentIndex():
+    """
+    The index of the rotated segments of a log file.
+    It is stored as JSON next to the log file and records, for every retained segment,
+    its file name, the logical offset of its first byte, its size and whether it has
+    been compressed.
+
+    Attributes:
+        path (str): path to the active log file
+        index_path (str): path to the index file
+
+    Methods:
+        load():
+            Returns the content of the index.
+        add_segment(size):
+            Records a new rotated segment and returns its entry.
+        mark_compressed(name):
+            Records that a segment has been compressed.
+        drop_oldest(keep):
+            Removes all but the newest keep segments from the index and returns them.
+        reset():
+            Removes the index and all segments.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = f'{path}.index'
+        self.lock = _index_lock(path)
+
+    def exists(self) -> bool:
+        """Returns True if the log has been rotated at least once."""
+
+        return os.path.exists(self.index_path)
+
+    def load(self) -> dict:
+        """Returns the content of the index."""
+
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as fil:
+                return json.load(fil)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'segments': [], 'next_seq': 1, 'active_start': 0}
+
+    def _save(self, index: dict):
+        tmp = f'{self.index_path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fil:
+            json.dump(index, fil)
+        os.replace(tmp, self.index_path)
+
+    def add_segment(self, size: int) -> dict:
+        """
+        Records a new rotated segment of the given size.
+
+            Parameters:
+                size (int): size of the segment in bytes
+
+            Returns:
+                dict: the index entry of the new segment
+        """
+
+        with self.lock:
+            index = self.load()
+            seq = index['next_seq']
+            entry = {'name': f'{os.path.basename(self.path)}.{seq:06d}',
+                     'start': index['active_start'], 'size': size, 'compressed': False}
+            index['segments'].append(entry)
+            index['next_seq'] = seq + 1
+            index['active_start'] += size
+            self._save(index)
+        return entry
+
+    def mark_compressed(self, name: str):
+        """Records that the segment called name has been compressed."""
+
+        with self.lock:
+            index = self.load()
+            for entry in index['segments']:
+                if entry['name'] == name:
+                    entry['compressed'] = True
+            self._save(index)
+
+    def drop_oldest(self, keep: int) -> list:
+        """
+        Removes all but the newest keep segments from the index.
+
+            Parameters:
+                keep (int): number of segments to keep
+
+            Returns:
+                list: the entries that were removed
+        """
+
+        with self.lock:
+            index = self.load()
+            if keep <= 0 or len(index['segments']) <= keep:
+                return []
+            dropped = index['segments'][:-keep]
+            index['segments'] = index['segments'][-keep:]
+            self._save(index)
+        return dropped
+
+    def segment_path(self, entry: dict) -> str:
+        """Returns the path of the file currently holding the segment."""
+
+        base = os.path.join(os.path.dirname(self.path), entry['name'])
+        return f'{base}.gz' if entry['compressed'] else base
+
+    def reset(self):
+        """Removes the index and all rotated segments."""
+
+        with self.lock:
+            for entry in self.load()['segments']:
+                for pth in [self.segment_path(entry), self.segment_path(dict(entry, compressed=not entry['compressed']))]:
+                    if os.path.exists(pth):
+                        os.remove(pth)
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+
+class RotatingLogWriter():
+    """
+    A file-like writer for application logs that rotates the file by size or age.
+    When the active file is rotated it is renamed to the next numbered segment, which is
+    then compressed in the background. Only the newest backup_count segments are kept.
+    With max_bytes and max_age set to 0 it behaves like a plain file.
+
+    Attributes:
+        path (str): path to the active log file
+        max_bytes (int): size in bytes after which the file is rotated (0 to disable)
+        max_age (int): age in seconds after which the file is rotated (0 to disable)
+        backup_count (int): number of rotated segments to keep (0 to keep all)
+        index (SegmentIndex): the index of rotated segments
+
+    Methods:
+        write(data):
+            Writes str or bytes to the log, rotating first if necessary.
+        rotate():
+            Rotates the active file into a new segment.
+        close():
+            Closes the active file.
+    """
+
+    def __init__(self, path: str, max_bytes: int=0, max_age: int=0, backup_count: int=10,
+                 append: bool=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.index = SegmentIndex(path)
+        self.lock = threading.Lock()
+        if not append:
+            self.index.reset()
+        self.fil = open(path, 'ab' if append else 'wb', buffering=0)
+        self.size = os.fstat(self.fil.fileno()).st_size
+        self.opened = time.time()
+
+    def _should_rotate(self, nbytes: int) -> bool:
+        if self.size == 0:
+            return False
+        if self.max_bytes and self.size + nbytes > self.max_bytes:
+            return True
+        return bool(self.max_age and time.time() - self.opened >= self.max_age)
+
+    def write(self, data):
+        """
+        Writes data to the log. Writes are unbuffered so readers can follow the file.
+
+            Parameters:
+                data (str or bytes): the data to be written
+        """
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.lock:
+            if self._should_rotate(len(data)):
+                self._rotate()
+            self.fil.write(data)
+            self.size += len(data)
+
+    def flush(self):
+        """Writes are unbuffered; kept for compatibility with file objects."""
+
+    def rotate(self):
+        """Rotates the active file into a new segment."""
+
+        with self.lock:
+            self._rotate()
+
+    def _rotate(self):
+        # hold the index lock so readers never see the index and active file out of step
+        with self.index.lock:
+            self.fil.close()
+            entry = self.index.add_segment(self.size)
+            segment = os.path.join(os.path.dirname(self.path), entry['name'])
+            os.replace(self.path, segment)
+            self.fil = open(self.path, 'ab', buffering=0)
+        self.size = 0
+        self.opened = time.time()
+        _compressor().submit(compress_segment, self.index, entry, self.backup_count)
+
+    def close(self):
+        """Closes the active file."""
+
+        with self.lock:
+            self.fil.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def compress_segment(index: SegmentIndex, entry: dict, backup_count: int):
+    """
+    Compresses a rotated segment and deletes segments beyond backup_count.
+    Runs on the background compression thread.
+
+        Parameters:
+            index (SegmentIndex): the index of the log
+            entry (dict): the index entry of the segment to compress
+            backup_count (int): number of segments to keep
+    """
+
+    src = index.segment_path(entry)
+    retained = [seg['name'] for seg in index.load()['segments']]
+    if entry['name'] not in retained or not os.path.exists(src):
+        # the segment was dropped before it could be compressed
+        return
+    try:
+        with open(src, 'rb') as fin, gzip.open(f'{src}.gz.tmp', 'wb') as fout:
+            shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+        os.replace(f'{src}.gz.tmp', f'{src}.gz')
+        index.mark_compressed(entry['name'])
+        os.remove(src)
+    except OSError as e:
+        LOGGER.warning(f'Failed to compress log segment {src}: {e}')
+    delete_dropped(index, backup_count)
+
+def delete_dropped(index: SegmentIndex, backup_count: int):
+    """Deletes the segments beyond the newest backup_count from the index and disk."""
+
+    for old in index.drop_oldest(backup_count):
+        for pth in [index.segment_path(old), index.segment_path(dict(old, compressed=not old['compressed']))]:
+            if os.path.exists(pth):
+                os.remove(pth)
+
+class SegmentedLog():
+    """
+    A read-only view of a rotated log file as one contiguous stream.
+    Offsets are logical offsets from the first byte ever written to the log, so they
+    stay valid across rotations. Data in segments that have been deleted is not
+    available and first_offset() returns the oldest offset that can still be read.
+
+    Attributes:
+        path (str): path to the active log file
+        index (SegmentIndex): the index of rotated segments
+
+    Methods:
+        parts():
+            Returns (start, size, path, compressed) for every retained segment and the
+            active file.
+        first_offset():
+            Returns the logical offset of the oldest retained byte.
+        size():
+            Returns the logical offset just past the newest byte.
+        iter_chunks(start, end, chunk_size):
+            Yields the bytes between the logical offsets start and end.
+        read(offset, length):
+            Returns length bytes starting at the logical offset.
+        tail(lines):
+            Returns the last lines of the log and their logical offset.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = SegmentIndex(path)
+
+    def parts(self) -> list:
+        """Returns (start, size, path, compressed) for the segments and active file in order."""
+
+        with self.index.lock:
+            index = self.index.load()
+            try:
+                active = os.stat(self.path).st_size
+            except FileNotFoundError:
+                active = 0
+        parts = [(entry['start'], entry['size'], self.index.segment_path(entry), entry['compressed'])
+                 for entry in index['segments']]
+        parts.append((index['active_start'], active, self.path, False))
+        return parts
+
+    def first_offset(self) -> int:
+        """Returns the logical offset of the oldest byte that can still be read."""
+
+        return self.parts()[0][0]
+
+    def size(self) -> int:
+        """Returns the logical size of the log."""
+
+        start, size, _, _ = self.parts()[-1]
+        return start + size
+
+    def _open(self, path: str, compressed: bool):
+        try:
+            return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+        except FileNotFoundError:
+            # the segment was compressed between loading the index and opening the file
+            if compressed:
+                raise
+            return gzip.open(f'{path}.gz', 'rb')
+
+    def iter_chunks(self, start: int=None, end: int=None, chunk_size: int=CHUNK_SIZE):
+        """
+        Yields the bytes between the logical offsets start and end.
+
+            Parameters:
+                start (int): first logical offset (default: oldest retained byte)
+                end (int): logical offset after the last byte (default: end of the log)
+                chunk_size (int): maximum size of each chunk
+        """
+
+        parts = self.parts()
+        if start is None or start < parts[0][0]:
+            start = parts[0][0]
+        if end is None:
+            end = parts[-1][0] + parts[-1][1]
+        for part_start, part_size, path, compressed in parts:
+            part_end = part_start + part_size
+            if part_end <= start or part_start >= end:
+                continue
+            try:
+                fil = self._open(path, compressed)
+            except FileNotFoundError:
+                # the segment was deleted after the index was loaded
+                continue
+            with fil:
+                pos = max(start, part_start)
+                fil.seek(pos - part_start)
+                stop = min(end, part_end)
+                while pos < stop:
+                    chunk = fil.read(min(chunk_size, stop - pos))
+                    if not chunk:
+                        break
+                    pos += len(chunk)
+                    yield chunk
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Returns up to length bytes starting at the logical offset."""
+
+        return b''.join(self.iter_chunks(offset, offset + length))
+
+    def tail(self, lines: int, block_size: int=CHUNK_SIZE) -> tuple:
+        """
+        Returns the last lines of the log by reading blocks backwards from the end.
+        Compressed segments cannot be read backwards and are decompressed whole, but are
+        only touched if the active file does not hold enough lines.
+
+            Parameters:
+                lines (int): number of lines to return
+                block_size (int): size of each backward read
+
+            Returns:
+                tuple: (offset, data) where offset is the logical offset of data
+        """
+
+        pieces = []
+        newlines = 0
+        trailing = None
+        first = None
+        for part_start, part_size, path, compressed in reversed(self.parts()):
+            if part_size == 0:
+                continue
+            try:
+                fil = self._open(path, compressed)
+            except FileNotFoundError:
+                break
+            with fil:
+                if compressed:
+                    blocks = [(part_start, fil.read())]
+                else:
+                    blocks = self._reverse_blocks(fil, part_start, part_size, block_size)
+                for block_start, block in blocks:
+                    if trailing is None:
+                        trailing = block.endswith(b'\n')
+                    pieces.append(block)
+                    first = block_start
+                    newlines += block.count(b'\n')
+                    if newlines > lines:
+                        break
+            if newlines > lines:
+                break
+        if not pieces:
+            return self.size(), b''
+        data = b''.join(reversed(pieces))
+        pos = len(data) - 1 if trailing else len(data)
+        for _ in range(lines):
+            pos = data.rfind(b'\n', 0, pos)
+            if pos < 0:
+                break
+        cut = pos + 1 if pos >= 0 else 0
+        return first + cut, data[cut:]
+
+    def _reverse_blocks(self, fil, part_start: int, part_size: int, block_size: int):
+        pos = part_size
+        while pos > 0:
+            length = min(block_size, pos)
+            pos -= length
+            fil.seek(pos)
+            yield part_start + pos, fil.read(length)
+
+def is_segmented(path: str) -> bool:
+    """Returns True if the log at path has rotated segments."""
+
+    return SegmentIndex(path).exists()
@@ -0,0 +1,207 @@
+"""
+Contains the NodeLock class, the lock a controller holds on a TACC node while a job uses it.
+The lock is a file on the node created atomically, recording the job and controller holding
+it and when it expires. The holder renews it from a background heartbeat, so a crashed
+controller's lock expires after CT_CONTROLLER_LOCK_TTL seconds and another controller can
+take the node over.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Time in seconds after which a lock that is not renewed expires
+LOCK_TTL = float(os.environ.get('CT_CONTROLLER_LOCK_TTL', 300))
+
+def controller_id() -> str:
+    """Returns an id of this controller process, recorded as the owner of its locks."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+class NodeLock():
+    """
+    A lock on a node, held in a file on the node.
+
+    Attributes:
+        runner (RemoteRunner): runner connected to the node
+        path (str): path of the lock file on the node
+        job_id (str): the job holding the lock
+        token (str): unique id of this holding of the lock, kept across controller restarts
+        ttl (float): time in seconds the lock is valid for after each renewal
+        lost (bool): whether the lock was taken over by another controller
+        on_lost (callable): called with the lock when the heartbeat finds it taken over
+
+    Methods:
+        holder(path):
+            Returns the content of the lock file, if any.
+        held(holder):
+            Returns True if the lock file is this lock.
+        available():
+            Returns True if the node is not locked or its lock has expired.
+        acquire():
+            Locks the node, taking over an expired lock.
+        renew():
+            Extends the lock by ttl seconds.
+        release():
+            Stops the heartbeat and deletes the lock.
+        start_heartbeat(on_lost):
+            Renews the lock periodically in a background thread.
+        stop_heartbeat():
+            Stops the heartbeat.
+    """
+
+    def __init__(self, runner, path: str, job_id: str, token: str=None, ttl: float=LOCK_TTL):
+        self.runner = runner
+        self.path = path
+        self.job_id = job_id
+        self.token = token or uuid.uuid4().hex
+        self.ttl = ttl
+        self.lost = False
+        self.on_lost = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _content(self) -> str:
+        now = time.time()
+        return json.dumps({'owner': controller_id(), 'job_id': self.job_id, 'token': self.token,
+                           'renewed': now, 'expires': now + self.ttl})
+
+    def holder(self, path: str=None) -> dict:
+        """
+        Returns the content of the lock file, by default at the lock's path: the owner,
+        job_id and token of the holder, and when the lock expires. A lock file that cannot be
+        parsed, e.g. an empty one from before locks had content, never expires.
+        """
+
+        content = self.runner.read_file(path or self.path)
+        if content is None:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            return {'owner': None, 'job_id': None, 'token': None, 'expires': float('inf')}
+
+    def held(self, holder: dict=None) -> bool:
+        """Returns True if the lock file is this lock."""
+        holder = holder if holder is not None else self.holder()
+        return holder is not None and holder.get('token') == self.token
+
+    def available(self) -> bool:
+        """Returns True if the node is not locked or its lock has expired."""
+        holder = self.holder()
+        return holder is None or holder.get('expires', 0) < time.time()
+
+    def acquire(self) -> bool:
+        """
+        Locks the node by creating the lock file exclusively. An expired lock is first moved
+        aside by an atomic rename, so that only one of the controllers taking it over
+        succeeds.
+
+            Returns:
+                bool: True if the node was locked, False if another controller holds it
+        """
+
+        if self.runner.write_file(self.path, self._content(), exclusive=True):
+            return True
+        holder = self.holder()
+        if holder is None:
+            # released in the meantime
+            return self.runner.write_file(self.path, self._content(), exclusive=True)
+        if holder.get('expires', 0) >= time.time():
+            return False
+        if not self._take_over(holder):
+            return False
+        LOGGER.warning(f'Took over the expired lock of job {holder.get("job_id")} held by '
+                       f'{holder.get("owner")}')
+        return True
+
+    def _take_over(self, holder: dict) -> bool:
+        # moves the lock file read as holder aside and creates this lock in its place; the
+        # rename is atomic, so of the controllers doing this at the same time only the one
+        # whose rename moved exactly what it read goes on
+        stale = f'{self.path}.{self.token}.stale'
+        if not self.runner.rename(self.path, stale):
+            return False
+        if self.holder(stale) != holder:
+            # the lock was renewed, or taken over by another controller, since it was read
+            # and this rename moved the newer lock aside; put it back
+            self.runner.rename(stale, self.path)
+            return False
+        self.runner.delete_file(stale)
+        return self.runner.write_file(self.path, self._content(), exclusive=True)
+
+    def renew(self) -> bool:
+        """
+        Extends the lock by ttl seconds. A lock with more than a heartbeat left cannot be taken
+        over before it is replaced, so its file is simply replaced atomically; one closer to
+        expiring is renewed the way an expired lock is taken over.
+
+            Returns:
+                bool: True if the lock was renewed, False if it is no longer held
+        """
+
+        holder = self.holder()
+        if holder is None:
+            # the lock file is gone, e.g. after the node was cleaned up; take it again
+            if self.runner.write_file(self.path, self._content(), exclusive=True):
+                return True
+            holder = self.holder()
+        if not self.held(holder):
+            return self._lose(holder)
+        if holder.get('expires', 0) - time.time() < self.ttl / 3:
+            if self._take_over(holder):
+                return True
+            return self._lose(self.holder())
+        tmp = f'{self.path}.{self.token}.tmp'
+        self.runner.write_file(tmp, self._content())
+        self.runner.rename(tmp, self.path)
+        return True
+
+    def _lose(self, holder: dict) -> bool:
+        self.lost = True
+        LOGGER.error(f'The lock on {self.runner.ip_address} was taken over by job '
+                     f'{holder.get("job_id") if holder else None}')
+        return False
+
+    def release(self):
+        """Stops the heartbeat and deletes the lock file if this lock still holds it."""
+        self.stop_heartbeat()
+        if self.held():
+            self.runner.delete_file(self.path)
+
+    def _beat(self):
+        while not self.stopping.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    if self.on_lost is not None:
+                        self.on_lost(self)
+                    return
+            except (IOError, OSError) as e:
+                # a missed renewal is retried on the next beat, before the lock expires
+                LOGGER.warning(f'Could not renew the lock on {self.runner.ip_address}: {e}')
+
+    def start_heartbeat(self, on_lost=None):
+        """
+        Renews the lock every third of its ttl in a background thread, calling on_lost(lock)
+        if it finds the lock taken over.
+        """
+        if on_lost is not None:
+            self.on_lost = on_lost
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._beat, daemon=True, name='ctcontroller-lock')
+        self.thread.start()
+
+    def stop_heartbeat(self):
+        """Stops the heartbeat thread."""
+        self.stopping.set()
+        if self.thread is not None:
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            self.thread = None
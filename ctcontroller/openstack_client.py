@@ -0,0 +1,282 @@
+"""
+Contains the ChameleonClient class, an in-process client for the OpenStack and Blazar APIs
+of a Chameleon site.
+All requests share one keystoneauth session, so the application credential is exchanged
+for a token once, the token is reused until it expires and HTTP connections are pooled,
+instead of starting the openstack CLI and authenticating again for every call.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from .util import ProvisionException
+from .tracing import span
+from .waits import StatusPoller
+
+LOGGER = logging.getLogger("CT Controller")
+
+class AppCredential():
+    """
+    An OpenStack application credential. Its representation hides the secret, so that it can
+    be logged.
+
+    Attributes:
+        credential_id (str): id of the application credential
+        secret (str): secret of the application credential
+    """
+
+    def __init__(self, credential_id: str, secret: str):
+        self.credential_id = credential_id
+        self.secret = secret
+
+    def __repr__(self) -> str:
+        return f'AppCredential({self.credential_id})'
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, AppCredential) and self.credential_id == other.credential_id
+                and self.secret == other.secret)
+
+    def __hash__(self) -> int:
+        return hash((self.credential_id, self.secret))
+
+class ChameleonClient():
+    """
+    A client for the compute, network, image and reservation APIs of a Chameleon site,
+    authenticated with an application credential.
+
+    Attributes:
+        site (str): the site, e.g. CHI@TACC
+        auth_url (str): the Keystone endpoint of the site
+        session (keystoneauth1.session.Session): the authenticated session
+        conn (openstack.connection.Connection): the OpenStack SDK connection
+        blazar (blazarclient.client.Client): the reservation client
+        poller (StatusPoller): lists the leases and servers once for all waits on this site
+
+    Methods:
+        find_network_id(name):
+            Returns the id of a network.
+        list_hosts():
+            Returns the reservable hosts and their capabilities.
+        find_host(name_or_id):
+            Returns a reservable host.
+        list_host_allocations():
+            Returns the reservations of every host.
+        create_lease(name, reservations, end, start):
+            Creates a lease.
+        get_lease(lease_id):
+            Returns a lease.
+        update_lease(lease_id, end):
+            Moves the end date of a lease.
+        delete_lease(lease_id):
+            Deletes a lease.
+        list_leases():
+            Returns the leases of the project.
+        list_images(tags):
+            Returns the images having all tags.
+        create_server(name, image, network_id, flavor, key_name, reservation_id):
+            Creates a server on a reservation.
+        get_server(server_id):
+            Returns a server.
+        delete_server(server_id):
+            Deletes a server.
+        list_servers():
+            Returns the servers of the project.
+        create_floating_ip(network_id):
+            Allocates a floating IP address.
+        find_floating_ips(tags):
+            Returns the floating IP addresses having all tags.
+        delete_floating_ip(address):
+            Releases a floating IP address.
+        list_floating_ips():
+            Returns the floating IPs of the project.
+        add_floating_ip(server_id, address):
+            Associates a floating IP address with a server.
+    """
+
+    def __init__(self, site: str, auth_url: str, credential_id: str, credential_secret: str):
+        # pylint: disable=import-outside-toplevel
+        from keystoneauth1 import exceptions as ks_exceptions
+        from keystoneauth1.identity.v3 import ApplicationCredential
+        from keystoneauth1.session import Session
+        from openstack import connection, exceptions as sdk_exceptions
+        from blazarclient import client as blazar_client, exception as blazar_exceptions
+
+        self.site = site
+        self.auth_url = auth_url
+        auth = ApplicationCredential(auth_url=auth_url, application_credential_id=credential_id,
+                                     application_credential_secret=credential_secret)
+        self.session = Session(auth=auth)
+        self.conn = connection.Connection(session=self.session, region_name=site, interface='public')
+        self.blazar = blazar_client.Client(session=self.session, service_type='reservation',
+                                           interface='public', region_name=site)
+        self.poller = StatusPoller({'lease': self.list_leases, 'server': self.list_servers})
+        self.errors = (ks_exceptions.ClientException, sdk_exceptions.SDKException,
+                       blazar_exceptions.BlazarClientException)
+
+    @contextmanager
+    def request(self, action: str):
+        """Times an API request as a span and raises its errors as ProvisionException."""
+        with span('openstack', site=self.site, action=action):
+            try:
+                yield
+            except self.errors as e:
+                raise ProvisionException(f'Chameleon request to {action} failed: {e}') from e
+
+    def find_network_id(self, name: str) -> str:
+        """Returns the id of the network with the given name."""
+        with self.request('find network'):
+            network = self.conn.network.find_network(name, ignore_missing=False)
+        return network.id
+
+    def list_hosts(self) -> list:
+        """
+        Returns the reservable hosts of the site. Each host is a dict including its
+        capabilities, e.g. node_type, cpu_arch, gpu.gpu or architecture.platform_type.
+        """
+        with self.request('list hosts'):
+            return self.blazar.host.list()
+
+    def find_host(self, name_or_id: str) -> dict:
+        """Returns the reservable host with the given id or hypervisor hostname."""
+        for host in self.list_hosts():
+            if name_or_id in [str(host.get('id')), host.get('hypervisor_hostname')]:
+                return host
+        raise ProvisionException(f'Host {name_or_id} not found on {self.site}')
+
+    def list_host_allocations(self) -> list:
+        """
+        Returns the allocations of the hosts of the site: for each host, its `resource_id`
+        and the `reservations` holding it, with their `start_date` and `end_date`.
+        """
+        with self.request('list host allocations'):
+            return self.blazar.allocation.list('os-hosts')
+
+    def create_lease(self, name: str, reservations: list, end: str, start: str='now') -> dict:
+        """
+        Creates a lease.
+
+            Parameters:
+                name (str): name of the lease
+                reservations (list): the reservations of the lease, as accepted by Blazar
+                end (str): end date of the lease, formatted as YYYY-MM-DD HH:MM
+                start (str): start date of the lease in the same format, or now
+
+            Returns:
+                dict: the lease
+        """
+        with self.request('create lease'):
+            return self.blazar.lease.create(name=name, start=start, end=end,
+                                            reservations=reservations, events=[])
+
+    def get_lease(self, lease_id: str) -> dict:
+        """Returns the lease with the given id or name."""
+        with self.request('show lease'):
+            return self.blazar.lease.get(lease_id)
+
+    def update_lease(self, lease_id: str, end: str) -> dict:
+        """Moves the end date of the lease with the given id, formatted as YYYY-MM-DD HH:MM."""
+        with self.request('update lease'):
+            return self.blazar.lease.update(lease_id, end_date=end)
+
+    def delete_lease(self, lease_id: str):
+        """Deletes the lease with the given id."""
+        with self.request('delete lease'):
+            self.blazar.lease.delete(lease_id)
+
+    def list_leases(self) -> list:
+        """Returns the leases of the project."""
+        with self.request('list leases'):
+            return self.blazar.lease.list()
+
+    def list_images(self, tags: list=None) -> list:
+        """Returns the images of the site, only those having all the given tags if any."""
+        query = {'tag': tags} if tags else {}
+        with self.request('list images'):
+            return list(self.conn.image.images(**query))
+
+    def create_server(self, name: str, image: str, network_id: str, flavor: str,
+                      key_name: str, reservation_id: str) -> str:
+        """
+        Creates a server on the hosts of a reservation.
+
+            Parameters:
+                name (str): name of the server
+                image (str): name of the image
+                network_id (str): id of the network to attach the server to
+                flavor (str): name of the flavor
+                key_name (str): name of the key pair to install on the server
+                reservation_id (str): id of the host reservation
+
+            Returns:
+                str: the id of the server
+        """
+        with self.request('create server'):
+            image_id = self.conn.image.find_image(image, ignore_missing=False).id
+            flavor_id = self.conn.compute.find_flavor(flavor, ignore_missing=False).id
+            server = self.conn.compute.create_server(
+                name=name, image_id=image_id, flavor_id=flavor_id, key_name=key_name,
+                networks=[{'uuid': network_id}], scheduler_hints={'reservation': reservation_id})
+        return server.id
+
+    def get_server(self, server_id: str):
+        """Returns the server with the given id."""
+        with self.request('show server'):
+            return self.conn.compute.get_server(server_id)
+
+    def delete_server(self, server_id: str):
+        """Deletes the server with the given id, if it still exists."""
+        with self.request('delete server'):
+            self.conn.compute.delete_server(server_id, ignore_missing=True)
+
+    def list_servers(self) -> list:
+        """Returns the servers of the project."""
+        with self.request('list servers'):
+            return list(self.conn.compute.servers())
+
+    def create_floating_ip(self, network_id: str) -> str:
+        """Allocates a floating IP address on the given network and returns it."""
+        with self.request('create floating ip'):
+            return self.conn.network.create_ip(floating_network_id=network_id).floating_ip_address
+
+    def find_floating_ips(self, tags: list) -> list:
+        """Returns the floating IP addresses having all the given tags."""
+        with self.request('list floating ips'):
+            return [ip.floating_ip_address for ip in self.conn.network.ips(tags=tags)]
+
+    def delete_floating_ip(self, address: str):
+        """Releases the given floating IP address, if it is still allocated."""
+        with self.request('delete floating ip'):
+            for ip in self.conn.network.ips(floating_ip_address=address):
+                self.conn.network.delete_ip(ip, ignore_missing=True)
+
+    def list_floating_ips(self) -> list:
+        """Returns the floating IPs of the project."""
+        with self.request('list floating ips'):
+            return list(self.conn.network.ips())
+
+    def add_floating_ip(self, server_id: str, address: str):
+        """
+        Associates the floating IP address with the first port of the server through Neutron,
+        as `openstack server add floating ip` does; the addFloatingIp server action is not
+        available at the compute microversions the SDK negotiates.
+        """
+        with self.request('associate floating ip'):
+            port = next(iter(self.conn.network.ports(device_id=server_id)), None)
+            if port is None:
+                raise ProvisionException(f'Server {server_id} has no port to associate {address} with')
+            ip = self.conn.network.find_ip(address, ignore_missing=False)
+            self.conn.network.update_ip(ip, port_id=port.id)
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def get_client(site: str, auth_url: str, credential: AppCredential) -> ChameleonClient:
+    """
+    Returns the client of a site for an application credential, creating it once so that
+    every provisioner using the same credential shares its token and connections.
+    """
+    key = (site, auth_url, credential)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = ChameleonClient(site, auth_url, credential.credential_id, credential.secret)
+        return _CLIENTS[key]
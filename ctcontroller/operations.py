@@ -0,0 +1,289 @@
+"""
+Contains the Operation class used to run long controller tasks in the background.
+An operation runs on a bounded thread pool and records the phases it goes through, how
+long each took and any error, so that API clients can poll its progress or cancel it.
+"""
+
+import os
+import uuid
+import time
+import logging
+import threading
+import contextvars
+from enum import Enum
+from datetime import datetime, UTC
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from .util import CancelledException
+from .tracing import job_context, span
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Maximum number of operations running at the same time
+MAX_WORKERS = int(os.environ.get('CT_CONTROLLER_MAX_WORKERS', 4))
+# Maximum number of applications running at the same time, on a pool of their own so that
+# long runs do not hold up provisioning
+MAX_RUNS = int(os.environ.get('CT_CONTROLLER_MAX_RUNS', 32))
+# Time in seconds a finished operation is kept for its clients to look up
+OPERATION_TTL = float(os.environ.get('CT_CONTROLLER_OPERATION_TTL', 3600))
+# Maximum number of finished operations kept, the oldest are forgotten first
+MAX_OPERATIONS = int(os.environ.get('CT_CONTROLLER_MAX_OPERATIONS', 1000))
+
+# The phase running in the current context, so that phases run concurrently by different
+# threads nest under the phase that started them rather than under each other
+_current_phase = contextvars.ContextVar('ctcontroller_phase', default=None)
+
+def current_phase() -> str:
+    """Returns the name of the operation phase running in the current context, if any."""
+    record = _current_phase.get()
+    return record['name'] if record is not None else None
+
+class OperationStatus(Enum):
+    PENDING=1
+    RUNNING=2
+    SUCCEEDED=3
+    FAILED=4
+    CANCELLING=5
+    CANCELLED=6
+
+def _timestamp(epoch):
+    return datetime.fromtimestamp(epoch, UTC).isoformat() if epoch else None
+
+class Operation():
+    """
+    A long-running controller task such as provisioning hardware.
+
+    Attributes:
+        id (str): unique id of the operation
+        kind (str): what the operation does, e.g. startup
+        job_id (str): the job the operation belongs to
+        status (OperationStatus): the current status of the operation
+        phases (list): the phases the operation has gone through
+        error (str): the error that ended the operation, if any
+        cancel_event (threading.Event): set when cancellation has been requested
+
+    Methods:
+        phase(name):
+            Context manager recording a phase of the operation.
+        progress(detail):
+            Records a progress message for the current phase.
+        check_cancelled():
+            Raises CancelledException if cancellation has been requested.
+        cancel():
+            Requests cancellation of the operation.
+        to_dict():
+            Returns a JSON-serializable description of the operation.
+    """
+
+    def __init__(self, kind: str, job_id: str=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.job_id = job_id
+        self.status = OperationStatus.PENDING
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.phases = []
+        self.stack = []
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Records a phase of the operation, nested in the phase running in the current context.
+        Cancellation is checked when the phase starts.
+
+            Parameters:
+                name (str): name of the phase
+        """
+
+        self.check_cancelled()
+        parent = _current_phase.get()
+        with self.lock:
+            if parent is not None and any(p is parent for p in self.stack):
+                full_name = f"{parent['name']}.{name}"
+            else:
+                full_name = name
+            record = {'name': full_name, 'status': OperationStatus.RUNNING.name,
+                      'started': time.time(), 'elapsed': None, 'detail': None, 'error': None}
+            self.phases.append(record)
+            self.stack.append(record)
+        LOGGER.info(f'{self.kind} {self.id}: starting {full_name}')
+        token = _current_phase.set(record)
+        try:
+            yield record
+        except CancelledException:
+            record['status'] = OperationStatus.CANCELLED.name
+            raise
+        except Exception as e:
+            record['status'] = OperationStatus.FAILED.name
+            record['error'] = getattr(e, 'msg', str(e))
+            raise
+        else:
+            record['status'] = OperationStatus.SUCCEEDED.name
+        finally:
+            _current_phase.reset(token)
+            record['elapsed'] = round(time.time() - record['started'], 3)
+            with self.lock:
+                self.stack.remove(record)
+
+    def progress(self, detail: str):
+        """Records a progress message for the phase currently running."""
+
+        with self.lock:
+            if self.stack:
+                self.stack[-1]['detail'] = detail
+
+    def current_phase(self) -> str:
+        """Returns the name of the innermost phase currently running."""
+
+        with self.lock:
+            return self.stack[-1]['name'] if self.stack else None
+
+    def check_cancelled(self):
+        """Raises CancelledException if cancellation has been requested."""
+
+        if self.cancel_event.is_set():
+            raise CancelledException(f'{self.kind} operation {self.id} was cancelled')
+
+    def cancel(self) -> bool:
+        """
+        Requests cancellation. The operation stops at its next phase boundary or wait loop
+        and tears down anything it had already provisioned.
+
+            Returns:
+                bool: False if the operation has already finished
+        """
+
+        with self.lock:
+            if self.status not in [OperationStatus.PENDING, OperationStatus.RUNNING]:
+                return False
+            self.cancel_event.set()
+            self.status = OperationStatus.CANCELLING
+        return True
+
+    def done(self) -> bool:
+        """Returns True once the operation has finished."""
+
+        return self.status in [OperationStatus.SUCCEEDED, OperationStatus.FAILED,
+                               OperationStatus.CANCELLED]
+
+    def to_dict(self) -> dict:
+        """Returns a JSON-serializable description of the operation."""
+
+        end = self.finished or time.time()
+        phases = [dict(p, started=_timestamp(p['started']),
+                       elapsed=p['elapsed'] if p['elapsed'] is not None
+                       else round(time.time() - p['started'], 3))
+                  for p in list(self.phases)]
+        return {'id': self.id, 'kind': self.kind, 'job_id': self.job_id,
+                'status': self.status.name, 'phase': self.current_phase(),
+                'created': _timestamp(self.created), 'started': _timestamp(self.started),
+                'finished': _timestamp(self.finished),
+                'elapsed': round(end - self.started, 3) if self.started else None,
+                'phases': phases, 'error': self.error}
+
+    def run(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) as the body of the operation, recording the outcome."""
+
+        self.started = time.time()
+        result = None
+        try:
+            with self.lock:
+                # a cancellation requested before the start keeps the operation CANCELLING
+                if self.status == OperationStatus.PENDING:
+                    self.status = OperationStatus.RUNNING
+            self.check_cancelled()
+            with job_context(self.job_id), span(f'operation.{self.kind}', operation_id=self.id):
+                result = func(*args, **kwargs)
+        except CancelledException as e:
+            LOGGER.info(f'{self.kind} {self.id} cancelled')
+            self.status = OperationStatus.CANCELLED
+            self.error = e.msg
+        except Exception as e:
+            LOGGER.exception(f'{self.kind} {self.id} failed')
+            self.status = OperationStatus.FAILED
+            self.error = getattr(e, 'msg', str(e))
+        else:
+            self.status = OperationStatus.SUCCEEDED
+        finally:
+            self.finished = time.time()
+        return result
+
+@contextmanager
+def phase(operation: Operation, name: str, **attributes):
+    """
+    Records a phase as a tracing span and, if there is an operation, as a phase of it.
+
+        Parameters:
+            operation (Operation): the operation the phase belongs to, or None
+            name (str): name of the phase
+            attributes: span attributes describing the phase
+    """
+
+    with span(name, **attributes):
+        with operation.phase(name) if operation is not None else nullcontext() as record:
+            yield record
+
+class OperationRegistry():
+    """
+    Runs operations on bounded thread pools and keeps track of them by id.
+    Operations run on a shared pool unless their kind has a pool of its own. Finished
+    operations are forgotten after ttl seconds, or sooner once more than max_finished of
+    them are kept.
+
+    Methods:
+        submit(operation, func, *args, **kwargs):
+            Runs func as the body of operation in the background.
+        get(op_id):
+            Returns the operation with the given id, or None.
+        list(job_id):
+            Returns all known operations, optionally only those of one job.
+        prune():
+            Forgets the finished operations that expired or exceed max_finished.
+    """
+
+    def __init__(self, max_workers: int=MAX_WORKERS, pools: dict=None, ttl: float=OPERATION_TTL,
+                 max_finished: int=MAX_OPERATIONS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ctcontroller-op')
+        self.executors = {kind: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f'ctcontroller-{kind}')
+                          for kind, size in (pools or {}).items()}
+        self.operations = {}
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+
+    def submit(self, operation: Operation, func, *args, **kwargs) -> Operation:
+        """Runs func(*args, **kwargs) as the body of operation on the pool for its kind."""
+
+        self.prune()
+        with self.lock:
+            self.operations[operation.id] = operation
+        executor = self.executors.get(operation.kind, self.executor)
+        executor.submit(operation.run, func, *args, **kwargs)
+        return operation
+
+    def get(self, op_id: str) -> Operation:
+        """Returns the operation with the given id, or None."""
+
+        return self.operations.get(op_id)
+
+    def list(self, job_id: str=None) -> list:
+        """Returns all known operations, oldest first, optionally only those of one job."""
+
+        self.prune()
+        return [op for op in list(self.operations.values()) if job_id is None or op.job_id == job_id]
+
+    def prune(self):
+        """Forgets the finished operations older than ttl and the oldest beyond max_finished."""
+
+        expiry = time.time() - self.ttl
+        with self.lock:
+            finished = sorted((op for op in self.operations.values() if op.done() and op.finished),
+                              key=lambda op: op.finished)
+            excess = max(len(finished) - self.max_finished, 0)
+            for index, op in enumerate(finished):
+                if index < excess or op.finished < expiry:
+                    del self.operations[op.id]
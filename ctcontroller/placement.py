@@ -0,0 +1,113 @@
+"""
+Contains the placement of jobs whose target site is CHI@*, which may run on any Chameleon
+site of the configuration file.
+The sites are queried concurrently for the hosts of the requested node type and the
+reservations holding them, and ranked by when enough hosts will be free; sites without a
+compatible image or without such hosts are left out. The job is then provisioned at the
+site that can start soonest, falling back to the next one if provisioning fails there.
+"""
+
+import os
+import yaml
+import logging
+import contextvars
+from datetime import datetime, UTC
+from concurrent.futures import ThreadPoolExecutor
+from .util import CancelledException, ProvisionException
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Target site placing the job on whichever Chameleon site can start it soonest
+ANY_CHAMELEON_SITE = 'CHI@*'
+
+def is_placement(target_site: str) -> bool:
+    """Returns True if target_site lets the controller choose the Chameleon site."""
+    return target_site == ANY_CHAMELEON_SITE
+
+def chameleon_sites(config_path: str) -> list:
+    """Returns the Chameleon sites of the configuration file, e.g. CHI@TACC and CHI@UC."""
+    if not os.path.exists(config_path):
+        raise ProvisionException('Config file not found')
+    with open(config_path, 'r', encoding='utf-8') as fil:
+        config = yaml.safe_load(fil)
+    return [site for site in config if site.startswith('CHI@') and site != ANY_CHAMELEON_SITE]
+
+def _candidate(cfg: dict, site: str):
+    # pylint: disable=import-outside-toplevel
+    from .chameleon_provisioner import ChameleonProvisioner
+    provisioner = ChameleonProvisioner(dict(cfg, target_site=site))
+    gpu_arch = (provisioner.catalog.host(provisioner.node_type) or {}).get('gpu.gpu_model')
+    if not provisioner.catalog.find_images(provisioner.cpu_arch, provisioner.gpu, gpu_arch):
+        raise ProvisionException(f'No compatible image on {site}')
+    return provisioner.earliest_start(), provisioner
+
+def rank_sites(cfg: dict, operation=None) -> list:
+    """
+    Queries the Chameleon sites of the configuration file concurrently and ranks them by when
+    they can start the job.
+
+        Parameters:
+            cfg (dict): the provisioner configuration of the job, with target_site CHI@*
+            operation (Operation): the operation the placement is part of, if any
+
+        Returns:
+            list: a provisioner for each site that can run the job, soonest first
+    """
+
+    sites = chameleon_sites(cfg['config_path'])
+    if not sites:
+        raise ProvisionException('No Chameleon site found in the config file')
+    candidates = []
+    with ThreadPoolExecutor(max_workers=len(sites), thread_name_prefix='ctcontroller-placement') as pool:
+        futures = {site: pool.submit(contextvars.copy_context().run, _candidate, cfg, site)
+                   for site in sites}
+        for site, future in futures.items():
+            try:
+                start, provisioner = future.result()
+            except ProvisionException as e:
+                LOGGER.warning(f'Not placing job on {site}: {e.msg}')
+                continue
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # a site that cannot be queried is skipped rather than failing the placement
+                LOGGER.exception(f'Not placing job on {site}: {e}')
+                continue
+            if start is None:
+                LOGGER.warning(f'Not placing job on {site}: not enough {cfg["node_type"]} hosts')
+                continue
+            LOGGER.info(f'{site} can start the job at {start.isoformat()}')
+            provisioner.operation = operation
+            candidates.append((start, provisioner))
+    if not candidates:
+        raise ProvisionException(f'No Chameleon site can run {cfg["num_nodes"]} {cfg["node_type"]} nodes')
+    candidates.sort(key=lambda candidate: candidate[0])
+    now = datetime.now(UTC)
+    for start, provisioner in candidates:
+        provisioner.lease_start = start if start > now else None
+    return [provisioner for _, provisioner in candidates]
+
+def provision_first(provisioners: list, prepare=None):
+    """
+    Provisions the job at the first site that succeeds, in order.
+
+        Parameters:
+            provisioners (list): the provisioners of the candidate sites, best first
+            prepare (callable): called with each provisioner before it provisions, e.g. to
+                                attach it to the state store
+
+        Returns:
+            Provisioner: the provisioner that succeeded
+    """
+
+    error = None
+    for provisioner in provisioners:
+        if prepare is not None:
+            prepare(provisioner)
+        try:
+            provisioner.provision_instance()
+            return provisioner
+        except CancelledException:
+            raise
+        except ProvisionException as e:
+            LOGGER.warning(f'Could not provision on {provisioner.site}, trying the next site: {e.msg}')
+            error = e
+    raise error
@@ -1,15 +1,20 @@
 """Contains the base Provisioner class used to create site-specific provisioners."""
 import os
 import yaml
+import random
 import logging
-from .remote import RemoteRunner
-from .local import LocalRunner
 from .util import ProvisionException, Status
+from .operations import phase
+from .step_graph import check_aborted
+from .state_store import Persistent
 
 CT_ROOT = '.ctcontroller'
 LOGGER = logging.getLogger("CT Controller")
 
-class Provisioner:
+# Fraction of the attribute assignments of a provisioner traced at DEBUG level
+ATTRIBUTE_LOG_RATE = float(os.environ.get('CT_CONTROLLER_ATTRIBUTE_LOG_RATE', 0.1))
+
+class Provisioner(Persistent):
     """
     The base Provisioner class used to create site-specific provisioners.
     Contains basic setup steps and subroutines necessary for any site provisioner.
@@ -32,13 +37,28 @@ class Provisioner:
         get_config(config_path):
         lookup_auth(config_path): 
         get(prop): 
+        phase(name): 
+        check_cancelled(): 
+        progress(detail): 
         get_remote_runner(ip_address, remote_id): 
+        get_remote_runners(): 
+        reattach(): 
+        verify(): 
+        reservation_end(): 
+        extend_reservation(): 
         connect(): 
     """
 
+    STATE_COMPONENT = 'provisioner'
+    # whether provisioned nodes can be kept in the warm pool and handed to the next job
+    POOLABLE = False
+    STATE_ATTRIBUTES = ['status', 'site', 'ip_addresses', 'device_id', 'remote_id',
+                        'jump_ip', 'jump_id', 'jump_key', 'httpproxy']
+
     def __init__(self, cfg):
         self.site = cfg['target_site']
         self.user = cfg['requesting_user']
+        self.config = dict(cfg)
         # If the SSH key and key name were provided, use them.
         # Else try to use a service account.
         self.get_config(cfg['config_path'])
@@ -100,14 +120,36 @@ class Provisioner:
         self.use_service_acct = True
 
     def __setattr__(self, name: str, value) -> None:
-        LOGGER.info(f'setting {name} to {value}')
+        # status changes are worth a line, other assignments are traced sparingly
+        if name == 'status':
+            LOGGER.info(f'setting {name} to {value}')
+        elif LOGGER.isEnabledFor(logging.DEBUG) and random.random() < ATTRIBUTE_LOG_RATE:
+            LOGGER.debug(f'setting {name} to {value}')
         super().__setattr__(name, value)
 
     def get(self, prop: str):
         """Returns the value of prop or None if it is not defined."""
         return getattr(self, prop, None)
 
-    def get_remote_runner(self, ip_address=None, remote_id=None, jump_ip=None, jump_id=None, jump_key=None, httpproxy=None):
+    def phase(self, name: str):
+        """Records a provisioning phase as a span and in the operation driving this provisioner, if any."""
+        return phase(self.get('operation'), name, site=self.site, node_type=self.get('node_type'))
+
+    def check_cancelled(self):
+        """
+        Raises CancelledException if the operation driving this provisioner was cancelled or
+        if a concurrent provisioning step has failed.
+        """
+        if self.get('operation') is not None:
+            self.operation.check_cancelled()
+        check_aborted()
+
+    def progress(self, detail: str):
+        """Reports progress of the current phase to the operation driving this provisioner."""
+        if self.get('operation') is not None:
+            self.operation.progress(detail)
+
+    def get_remote_runner(self, ip_address=None, remote_id=None, jump_ip=None, jump_id=None, jump_key=None, httpproxy=None, num_retries=30, connect_timeout=None, device_id=None):
         """
         Initialize a RemoteRunner connected to the provisioned server at the specified ip_address
         logged in with the specified username id.
@@ -115,14 +157,20 @@ class Provisioner:
             Parameters:
                 ip_address (str): IP address of the server to connect
                 remote_id (str): username on the remote server
+                num_retries (int): number of connection attempts
+                connect_timeout (float): time in seconds each connection attempt may take
+                device_id (str): the device id of the server, looked up if not given
             
             Returns:
                 RemoteRunner:  runner connected to the specified remote server
         """
+        # pylint: disable=import-outside-toplevel
         if ip_address is None:
             ip_address = self.ip_addresses
         if ip_address == 'localhost':
+            from .local import LocalRunner
             return LocalRunner()
+        from .remote import RemoteRunner
         if remote_id is None:
             remote_id = self.get('remote_id')
         if jump_ip is None:
@@ -133,7 +181,31 @@ class Provisioner:
             jump_key = self.get('jump_key')
         if httpproxy is None:
             httpproxy = self.get('httpproxy')
-        return RemoteRunner(ip_address, remote_id, self.ssh_key['path'], device_id=self.device_id, jump_host=jump_ip, jump_pkey_path=jump_key, jump_user=jump_id, httpproxy=httpproxy)
+        if device_id is None and ip_address == self.ip_addresses:
+            device_id = self.device_id
+        return RemoteRunner(ip_address, remote_id, self.ssh_key['path'], device_id=device_id, jump_host=jump_ip, jump_pkey_path=jump_key, jump_user=jump_id, httpproxy=httpproxy, num_retries=num_retries, connect_timeout=connect_timeout)
+
+    def get_remote_runners(self) -> list:
+        """Returns runners connected to all the provisioned servers, the primary one first."""
+        return [self.get_remote_runner()]
+
+    def reattach(self) -> None:
+        """
+        Resumes from a state restored after a restart of the controller, reusing any resources
+        that were already provisioned. By default provisioning is simply run again.
+        """
+        self.provision_instance()
+
+    def verify(self) -> bool:
+        """Returns True if the provisioned resources are still usable, e.g. before reusing them."""
+        return self.status == Status.READY
+
+    def reservation_end(self):
+        """Returns when the reservation of the hardware ends, or None if it does not expire."""
+        return None
+
+    def extend_reservation(self) -> None:
+        """Extends the reservation of the hardware, if it expires."""
 
     def get_status(self):
         return self.status
@@ -11,10 +11,16 @@ from pathlib import Path
 from threading import Thread
 from typing import TextIO
 import paramiko
+from .logfiles import RotatingLogWriter
+from .tracing import command_attributes, transfer_attributes, traced
 
 LOGGER = logging.getLogger("CT Controller")
 
 AuthenticationException = paramiko.ssh_exception.AuthenticationException
+SSHException = paramiko.ssh_exception.SSHException
+
+# Port the SSH servers of the nodes listen on
+SSH_PORT = int(os.environ.get('CT_CONTROLLER_SSH_PORT', 22))
 
 class RemoteRunner():
     """
@@ -28,6 +34,8 @@ class RemoteRunner():
         device_id: a unique device_id for the remote server
 
     Methods:
+        close():
+            Closes the connection to the remote server.
         run(cmd):
             Runs a command on the remote server.
         log_to_file(file, stream): 
@@ -37,6 +45,12 @@ class RemoteRunner():
             the local machine in the background.
         create_file(fpath):
             Creates an empty file on the remote server at the specified path.
+        write_file(fpath, content, exclusive):
+            Writes a file on the remote server, optionally only if it does not exist.
+        read_file(fpath):
+            Returns the content of a file on the remote server.
+        rename(src, target):
+            Atomically renames a file on the remote server.
         delete_file(fpath):
             Deletes the file on the remote server at the specified path.
         file_exists(fpath):
@@ -52,7 +66,7 @@ class RemoteRunner():
             Creates a directory at the specified path on the remote server.
     """
 
-    def __init__(self, ip_address: str, username: str, pkey_path: str, port=22, device_id=None, num_retries=30, jump_host=None, jump_user=None, jump_pkey_path=None, jump_port=22, httpproxy=None):
+    def __init__(self, ip_address: str, username: str, pkey_path: str, port=SSH_PORT, device_id=None, num_retries=30, jump_host=None, jump_user=None, jump_pkey_path=None, jump_port=22, httpproxy=None, connect_timeout=None):
         self.client = None
         self.sftp = None
         self.httpproxy=httpproxy
@@ -62,7 +76,7 @@ class RemoteRunner():
             jump_client = paramiko.SSHClient()
             jump_policy = paramiko.AutoAddPolicy()
             jump_client.set_missing_host_key_policy(jump_policy)
-            jump_client.connect(jump_host, username=jump_user, pkey=jump_pkey)
+            jump_client.connect(jump_host, username=jump_user, pkey=jump_pkey, timeout=connect_timeout)
             transport = jump_client.get_transport()
             dest_addr = (ip_address, port)
             local_addr = (jump_host, jump_port)
@@ -87,11 +101,17 @@ class RemoteRunner():
 
         for _itr in range(num_retries):
             try:
-                client.connect(ip_address, username=username, pkey=pkey, sock=channel)
+                client.connect(ip_address, port=port, username=username, pkey=pkey, sock=channel,
+                               timeout=connect_timeout, banner_timeout=connect_timeout,
+                               auth_timeout=connect_timeout)
                 break
             except OSError:
                 LOGGER.warning(f'os error while trying to connect to {ip_address}')
-                time.sleep(10)
+                if _itr < num_retries - 1:
+                    time.sleep(10)
+        else:
+            client.close()
+            raise TimeoutError(f'Could not connect to {ip_address} after {num_retries} attempts')
         self.ip_address = ip_address
         self.client = client
         self.sftp = self.client.open_sftp()
@@ -105,10 +125,16 @@ class RemoteRunner():
         self.cpu_arch = self.get_cpu_arch()
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """Closes the connection to the remote server."""
         if self.sftp:
             self.sftp.close()
+            self.sftp = None
         if self.client:
             self.client.close()
+            self.client = None
 
     def get_cpu_arch(self) -> str:
         """
@@ -120,6 +146,7 @@ class RemoteRunner():
         else:
             return 'x86'
 
+    @traced('runner.run', command_attributes)
     def run(self, cmd: str) -> str:
         """
         Run a command on the remote server
@@ -140,14 +167,15 @@ class RemoteRunner():
             Log each line of a stream to a local file
 
             Parameters:
-                file (TextIO): the file pointer to a local file
+                file (TextIO|RotatingLogWriter): the file pointer to a local file
                 stream: the stream that is being logged
         """
 
         for line in iter(stream.readline, ''):
             file.write(line)
 
-    def tracked_run(self, cmd: str, outlog: str, errlog: str):
+    @traced('runner.tracked_run', command_attributes)
+    def tracked_run(self, cmd: str, outlog: str, errlog: str, rotation: dict=None):
         """
         Runs a command on the remote server, logging the stdout and stderr to local files
         in background threads.
@@ -157,13 +185,14 @@ class RemoteRunner():
                 cmd (str): the command to run on the remote server
                 outlog (str): local path the stdout log file
                 errlog (str): local path to the stderr log file
+                rotation (dict): rotation settings passed to RotatingLogWriter
         """
 
         LOGGER.info((f'Running "{cmd}" on remote server "{self.ip_address}".\n'
               f'Logging stdout=>{outlog} and stderr=>{errlog}'))
         _, stdout, stderr = self.client.exec_command(cmd, get_pty=True)
-        outf = open(outlog, 'a+', encoding='utf-8')
-        errf = open(errlog, 'a+', encoding='utf-8')
+        outf = RotatingLogWriter(outlog, **(rotation or {}))
+        errf = RotatingLogWriter(errlog, **(rotation or {}))
         out_thread = Thread(target=self.log_to_file, args=(outf, stdout))
         err_thread = Thread(target=self.log_to_file, args=(errf, stderr))
 
@@ -187,6 +216,66 @@ class RemoteRunner():
         fil = self.sftp.open(fpath, 'w')
         fil.close()
 
+    def write_file(self, fpath: str, content: str, exclusive: bool=False) -> bool:
+        """
+        Writes content to a file on the remote server
+
+            Parameters:
+                fpath (str): path on the remote server
+                content (str): the content of the file
+                exclusive (bool): only create the file if it does not exist yet, atomically
+
+            Returns:
+                True if the file was written
+                False if exclusive was set and the file already existed
+        """
+
+        try:
+            with self.sftp.open(fpath, 'wx' if exclusive else 'w') as fil:
+                fil.write(content)
+        except IOError:
+            # SFTP servers report an existing file as a generic failure
+            if exclusive and self.file_exists(fpath):
+                return False
+            raise
+        return True
+
+    def read_file(self, fpath: str) -> str:
+        """
+        Reads a file on the remote server
+
+            Parameters:
+                fpath (str): path on the remote server
+
+            Returns:
+                the content of the file, or None if it does not exist
+        """
+
+        try:
+            with self.sftp.open(fpath, 'r') as fil:
+                return fil.read().decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def rename(self, src: str, target: str) -> bool:
+        """
+        Atomically renames a file on the remote server, replacing target if it exists
+
+            Parameters:
+                src (str): path of the file on the remote server
+                target (str): new path of the file
+
+            Returns:
+                True if the file was renamed
+                False if src did not exist
+        """
+
+        try:
+            self.sftp.posix_rename(src, target)
+        except FileNotFoundError:
+            return False
+        return True
+
     def delete_file(self, fpath: str):
         """
         Deletes a file on the remote server
@@ -216,6 +305,7 @@ class RemoteRunner():
             exists = False
         return exists
 
+    @traced('runner.copy_dir', transfer_attributes)
     def copy_dir(self, src: str, target: str):
         """
         Recursively copies a directory from the local machine to the remote server.
@@ -236,6 +326,7 @@ class RemoteRunner():
                 self.sftp.put(os.path.join(path,file),os.path.join(target,path,file))
         return os.path.join(target, os.path.basename(src))
 
+    @traced('runner.copy_file', transfer_attributes)
     def copy_file(self, src: str, target: str):
         """
         Copies a file from the local machine to the remote server.
@@ -247,6 +338,7 @@ class RemoteRunner():
 
         self.sftp.put(src, target)
 
+    @traced('runner.get', transfer_attributes)
     def get(self, src: str, target: str) -> None:
         """
         Copies a remote file or directory from the remote server to the local machine.
@@ -256,6 +348,10 @@ class RemoteRunner():
                 target (str): path to the target file/directory on the local server
         """
 
+        # only the top-level copy is traced, not every file of a directory
+        self._get(src, target)
+
+    def _get(self, src: str, target: str) -> None:
         # check if src is a file or directory
         targpath = f'{target}/{os.path.basename(src)}'
         st = self.sftp.stat(src)
@@ -263,7 +359,7 @@ class RemoteRunner():
         if stat.S_ISDIR(st.st_mode):
             Path(targpath).mkdir(parents=True, exist_ok=True)
             for fil in self.sftp.listdir(src):
-                self.get(f'{src}/{fil}', targpath)
+                self._get(f'{src}/{fil}', targpath)
         else: # src is a file
            self.sftp.get(src, targpath)
 
@@ -0,0 +1,196 @@
+"""
+Contains the Scheduler, which queues the jobs waiting for a node of a given site and type.
+The queues are kept in the state store, so that they are shared by every controller using
+it. Only the job at the head of a queue probes the nodes, highest priority first and then
+first come, so that busy nodes are not probed by every waiting job at once. Once the head
+has found every node busy, it waits until a node is released, as signalled by the job
+releasing it, rather than probing again on a timer. Waiters report their position in the
+queue and an estimate of their wait based on how long nodes were held recently.
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+from .state_store import StateStore, get_store
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Time in seconds after which the head of a queue probes again without a release, in case
+# a lock expired or a node was freed by something other than a controller
+RETRY_INTERVAL = float(os.environ.get('CT_CONTROLLER_QUEUE_RETRY', 60))
+# Time in seconds between two checks of the store for releases by other controllers
+POLL_INTERVAL = 1
+# Time in seconds after which a waiter that stopped checking its position is dropped
+STALE_AFTER = 60
+
+def queue_name(site: str, node_type: str) -> str:
+    """Returns the name of the queue of the jobs waiting for a node of a site and type."""
+    return f'{site}/{node_type}'
+
+class Ticket():
+    """
+    The place of a job in a queue, removed from the queue when the ticket is closed.
+
+    Attributes:
+        scheduler (Scheduler): the scheduler the ticket belongs to
+        queue (str): name of the queue
+        job_id (str): id of the waiting job
+        priority (int): waiters with a higher priority are served first
+        slots (int): number of nodes the waiters of the queue share
+        id (int): the ticket number in the store
+        generation (int): the last release the waiter has seen
+
+    Methods:
+        position():
+            Returns the number of waiters ahead.
+        estimate(position):
+            Returns the estimated wait in seconds.
+        wait(check_cancelled, progress, retry):
+            Waits until the job is at the head of the queue.
+        close():
+            Leaves the queue.
+    """
+
+    def __init__(self, scheduler: 'Scheduler', queue: str, job_id: str, priority: int=0, slots: int=1):
+        self.scheduler = scheduler
+        self.queue = queue
+        self.job_id = job_id
+        self.priority = priority
+        self.slots = max(slots, 1)
+        store = scheduler.store
+        self.generation = store.generation(queue)
+        self.id = store.enqueue(queue, job_id, priority)
+
+    def __enter__(self) -> 'Ticket':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def position(self) -> int:
+        """Returns the number of live waiters served before this one."""
+        tickets = [waiter['ticket'] for waiter in self.scheduler.store.waiters(self.queue, STALE_AFTER)]
+        return tickets.index(self.id) if self.id in tickets else 0
+
+    def estimate(self, position: int) -> float:
+        """
+        Returns the estimated time in seconds until a node is free for this waiter, from
+        how long the nodes of the queue were held recently, or None if none was released yet.
+        """
+
+        held = self.scheduler.store.hold_times(self.queue)
+        if not held:
+            return None
+        return sum(held) / len(held) * math.ceil((position + 1) / self.slots)
+
+    def wait(self, check_cancelled=None, progress=None, retry: bool=False):
+        """
+        Waits until the job is at the head of the queue. After a probe that found no free
+        node, also waits until a node is released or RETRY_INTERVAL has passed.
+
+            Parameters:
+                check_cancelled (callable): raises to stop waiting
+                progress (callable): called with the position and estimated wait when they change
+                retry (bool): whether the job already probed the nodes and found them all busy
+        """
+
+        start = time.monotonic()
+        store = self.scheduler.store
+        reported = None
+        while True:
+            if check_cancelled is not None:
+                check_cancelled()
+            store.touch(self.id)
+            position = self.position()
+            generation = store.generation(self.queue)
+            released = generation != self.generation
+            if position == 0 and (not retry or released or time.monotonic() - start >= RETRY_INTERVAL):
+                self.generation = generation
+                return
+            if position != reported:
+                estimate = self.estimate(position)
+                wait = f', estimated wait {int(estimate)}s' if estimate is not None else ''
+                message = f'{position} jobs ahead in the {self.queue} queue{wait}'
+                if position == 0:
+                    message = f'All {self.queue} nodes are busy, waiting for one to be released{wait}'
+                LOGGER.info(message)
+                if progress is not None:
+                    progress(message)
+                reported = position
+            self.scheduler.sleep(POLL_INTERVAL)
+
+    def close(self):
+        """Leaves the queue, letting the next waiter probe the nodes."""
+        self.scheduler.store.dequeue(self.id)
+        self.scheduler.notify()
+
+class Scheduler():
+    """
+    The queues of the jobs waiting for nodes, kept in a state store.
+
+    Attributes:
+        store (StateStore): the store holding the queues
+
+    Methods:
+        ticket(job_id, site, node_type, priority, slots):
+            Adds a job to the queue of a site and node type.
+        released(site, node_type, held):
+            Signals the waiters that a node was released.
+        notify():
+            Wakes the waiters of this process.
+        sleep(seconds):
+            Waits for a notification or until seconds have passed.
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self.condition = threading.Condition()
+
+    def ticket(self, job_id: str, site: str, node_type: str, priority: int=0, slots: int=1) -> Ticket:
+        """
+        Adds a job to the queue of the nodes of a site and type.
+
+            Parameters:
+                job_id (str): id of the waiting job
+                site (str): the site of the nodes
+                node_type (str): the type of the nodes
+                priority (int): waiters with a higher priority are served first
+                slots (int): number of nodes of the type
+
+            Returns:
+                Ticket: the place of the job in the queue, to be closed once it has a node
+        """
+
+        return Ticket(self, queue_name(site, node_type), job_id, priority, slots)
+
+    def released(self, site: str, node_type: str, held: float=None):
+        """
+        Signals the waiters for nodes of a site and type, in this process and others using
+        the store, that a node was released after being held for held seconds.
+        """
+
+        self.store.signal(queue_name(site, node_type), held)
+        self.notify()
+
+    def notify(self):
+        """Wakes the waiters of this process so that they check the queue at once."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def sleep(self, seconds: float):
+        """Waits until notified or until seconds have passed."""
+        with self.condition:
+            self.condition.wait(seconds)
+
+_SCHEDULERS = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+def get_scheduler(store: StateStore=None) -> Scheduler:
+    """Returns the scheduler of the queues held in store, by default the default state store."""
+    store = store or get_store()
+    with _SCHEDULERS_LOCK:
+        if store.path not in _SCHEDULERS:
+            _SCHEDULERS[store.path] = Scheduler(store)
+        return _SCHEDULERS[store.path]
@@ -0,0 +1,228 @@
+"""
+Contains the SiteCatalog class, a cache of the resources of a Chameleon site that rarely
+change: the properties of each node type, the images the application can run on and the
+ids of the networks. The catalog is kept on disk for CT_CONTROLLER_CATALOG_TTL seconds and
+shared by all jobs on the site, so that choosing the hardware and image of a job is a
+dictionary lookup rather than several API requests.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from .util import ProvisionException
+from .step_graph import StepGraph
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Time in seconds after which the catalog of a site is refreshed
+CATALOG_TTL = float(os.environ.get('CT_CONTROLLER_CATALOG_TTL', 3600))
+# Networks whose ids are kept in the catalog
+NETWORKS = ['sharednet1', 'public']
+# Tag of the images the application can run on
+IMAGE_TAG = 'ct_edge'
+# Host properties kept for each node type
+HOST_PROPERTIES = ['node_type', 'architecture.platform_type', 'cpu_arch', 'gpu.gpu',
+                   'gpu.gpu_model', 'processor.other_description']
+
+def default_catalog_dir() -> str:
+    """Returns the directory the catalogs are cached in, by default in the output directory."""
+    if os.environ.get('CT_CONTROLLER_CATALOG_DIR'):
+        return os.environ['CT_CONTROLLER_CATALOG_DIR']
+    return os.path.join(os.environ.get('CT_CONTROLLER_OUTPUT_DIR', './output'), 'catalog')
+
+def image_key(cpu: str, gpu: bool, gpu_arch: str) -> str:
+    """Returns the key of the images for a CPU architecture, GPU and GPU architecture."""
+    return f'{cpu}|{"gpu" if gpu else "cpu"}|{(gpu_arch or "").lower() if gpu else ""}'
+
+def image_tags(cpu: str, gpu: bool, gpu_arch: str) -> list:
+    """Returns the tags an image must have to run the application on such a node."""
+    tags = [IMAGE_TAG]
+    if cpu:
+        tags.append(cpu)
+    if gpu:
+        tags.append('gpu')
+        if gpu_arch:
+            tags.append(gpu_arch.lower())
+    return tags
+
+class SiteCatalog():
+    """
+    The node types, images and networks of a Chameleon site.
+
+    Attributes:
+        site (str): the site, e.g. CHI@TACC
+        path (str): the file the catalog is cached in
+        ttl (float): time in seconds after which the catalog is refreshed
+        fetched (float): when the catalog was fetched, in seconds since the epoch
+        hosts (dict): maps a node type to its properties and number of hosts
+        node_names (dict): maps the hypervisor hostname of a host to its node name
+        images (dict): maps a key from image_key() to the names of the compatible images
+        image_list (list): the name and tags of every image tagged ct_edge
+        networks (dict): maps a network name to its id
+
+    Methods:
+        load(client):
+            Loads the catalog from disk, refreshing it if it is missing or expired.
+        refresh(client):
+            Fetches the catalog from the site and writes it to disk.
+        host(node_type):
+            Returns the properties of a node type.
+        find_images(cpu, gpu, gpu_arch):
+            Returns the images compatible with a node.
+        network_id(name):
+            Returns the id of a network.
+    """
+
+    def __init__(self, site: str, path: str, ttl: float=CATALOG_TTL):
+        self.site = site
+        self.path = path
+        self.ttl = ttl
+        self.fetched = None
+        self.hosts = {}
+        self.node_names = {}
+        self.images = {}
+        self.image_list = []
+        self.networks = {}
+        self.lock = threading.Lock()
+
+    def expired(self) -> bool:
+        """Returns True if the catalog has not been fetched or is older than the TTL."""
+        return self.fetched is None or time.time() - self.fetched >= self.ttl
+
+    def load(self, client) -> 'SiteCatalog':
+        """
+        Loads the catalog from disk, refreshing it from the site if the file is missing or
+        older than the TTL. If the site cannot be reached, an expired catalog is still used.
+
+            Parameters:
+                client (ChameleonClient): the client of the site
+
+            Returns:
+                SiteCatalog: the catalog
+        """
+
+        with self.lock:
+            if self.fetched is None:
+                self._read()
+            if not self.expired():
+                return self
+            try:
+                self._refresh(client)
+            except ProvisionException as e:
+                if self.fetched is None:
+                    raise
+                LOGGER.warning(f'Could not refresh the catalog of {self.site}, '
+                               f'using the one from {time.ctime(self.fetched)}: {e.msg}')
+            return self
+
+    def refresh(self, client) -> 'SiteCatalog':
+        """Fetches the catalog from the site and writes it to disk."""
+        with self.lock:
+            self._refresh(client)
+            return self
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fil:
+                data = json.load(fil)
+        except (OSError, ValueError):
+            return
+        for key in ['fetched', 'hosts', 'node_names', 'images', 'image_list', 'networks']:
+            setattr(self, key, data.get(key, getattr(self, key)))
+
+    def _write(self):
+        data = {key: getattr(self, key)
+                for key in ['site', 'fetched', 'hosts', 'node_names', 'images', 'image_list', 'networks']}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fil:
+            json.dump(data, fil, indent=1)
+        os.replace(tmp, self.path)
+
+    def _refresh(self, client):
+        LOGGER.info(f'Refreshing the resource catalog of {self.site}')
+        fetched = {}
+        # the hosts, images and networks are listed concurrently
+        lookups = StepGraph()
+        lookups.add('hosts', lambda: fetched.update(hosts=client.list_hosts()))
+        lookups.add('images', lambda: fetched.update(images=client.list_images([IMAGE_TAG])))
+        for name in NETWORKS:
+            lookups.add(name, lambda name=name: fetched.update({name: client.find_network_id(name)}))
+        lookups.run()
+
+        hosts, node_names = {}, {}
+        for host in fetched['hosts']:
+            node_type = host.get('node_type')
+            if host.get('hypervisor_hostname') and host.get('node_name'):
+                node_names[host['hypervisor_hostname']] = host['node_name']
+            if node_type is None:
+                continue
+            if node_type not in hosts:
+                hosts[node_type] = {key: host.get(key) for key in HOST_PROPERTIES}
+                hosts[node_type]['count'] = 0
+            hosts[node_type]['count'] += 1
+        image_list = [{'name': image.get('name'), 'tags': list(image.get('tags') or [])}
+                      for image in fetched['images']]
+        self.hosts, self.node_names, self.image_list = hosts, node_names, image_list
+        self.networks = {name: fetched[name] for name in NETWORKS}
+        # index the images by the kinds of node the site has
+        self.images = {}
+        for props in hosts.values():
+            cpu = props.get('architecture.platform_type') or props.get('cpu_arch') or ''
+            for gpu in [False, True]:
+                key = image_key(cpu, gpu, props.get('gpu.gpu_model'))
+                self.images[key] = self._match(image_tags(cpu, gpu, props.get('gpu.gpu_model')))
+        self.fetched = time.time()
+        try:
+            self._write()
+        except OSError as e:
+            LOGGER.warning(f'Could not write the catalog of {self.site} to {self.path}: {e}')
+
+    def _match(self, tags: list) -> list:
+        return [image['name'] for image in self.image_list if set(tags) <= set(image['tags'])]
+
+    def host(self, node_type: str) -> dict:
+        """Returns the properties of the given node type, or None if the site has no such node."""
+        return self.hosts.get(node_type)
+
+    def find_images(self, cpu: str, gpu: bool, gpu_arch: str) -> list:
+        """
+        Returns the names of the images the application can run on for a node.
+
+            Parameters:
+                cpu (str): CPU architecture of the node, e.g. x86
+                gpu (bool): whether the application uses the GPU
+                gpu_arch (str): GPU model of the node, if any
+
+            Returns:
+                list: names of the compatible images
+        """
+
+        key = image_key(cpu, gpu, gpu_arch)
+        if key in self.images:
+            return self.images[key]
+        return self._match(image_tags(cpu, gpu, gpu_arch))
+
+    def network_id(self, name: str) -> str:
+        """Returns the id of the network with the given name."""
+        if name not in self.networks:
+            raise ProvisionException(f'Network {name} not found on {self.site}')
+        return self.networks[name]
+
+_CATALOGS = {}
+_CATALOGS_LOCK = threading.Lock()
+
+def get_catalog(site: str, client, directory: str=None) -> SiteCatalog:
+    """
+    Returns the catalog of a site, loaded from disk or refreshed from the site if it has
+    expired. The catalog is shared by all provisioners of the process.
+    """
+    directory = directory or default_catalog_dir()
+    path = os.path.abspath(os.path.join(directory, f'{site.replace("@", "_")}.json'))
+    with _CATALOGS_LOCK:
+        if path not in _CATALOGS:
+            _CATALOGS[path] = SiteCatalog(site, path)
+        catalog = _CATALOGS[path]
+    return catalog.load(client)
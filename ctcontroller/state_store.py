@@ -0,0 +1,431 @@
+"""
+Contains the StateStore class, a durable record of the jobs managed by the controller.
+The state of each job's provisioner and application manager is written to a SQLite
+database in WAL mode whenever their status or provisioned resources change, so that a
+restarted controller can reattach to the hardware it had provisioned instead of leaking or
+reprovisioning it. The store also holds the warm pool, the nodes kept provisioned after
+their job for the next job to use, and the queues of the jobs waiting for a node.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from enum import Enum
+from .util import Status
+from .status_machine import StatusMachine
+
+LOGGER = logging.getLogger("CT Controller")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    scope TEXT,
+    options TEXT,
+    provisioner TEXT,
+    application TEXT,
+    hardware_status TEXT,
+    app_status TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS pool (
+    job_id TEXT PRIMARY KEY,
+    site TEXT,
+    node_type TEXT,
+    gpu INTEGER,
+    config TEXT,
+    provisioner TEXT,
+    parked REAL
+);
+CREATE TABLE IF NOT EXISTS queue (
+    ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT,
+    job_id TEXT,
+    priority INTEGER,
+    enqueued REAL,
+    seen REAL
+);
+CREATE TABLE IF NOT EXISTS releases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT,
+    held REAL,
+    at REAL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT,
+    component TEXT,
+    status TEXT,
+    at REAL
+);
+"""
+
+# Hardware statuses of jobs whose resources may still be held
+ACTIVE = [Status.SETTINGUP.name, Status.READY.name, Status.SHUTTINGDOWN.name]
+
+def default_state_path() -> str:
+    """Returns the path of the state database, by default in the output directory."""
+    if os.environ.get('CT_CONTROLLER_STATE_DB'):
+        return os.environ['CT_CONTROLLER_STATE_DB']
+    return os.path.join(os.environ.get('CT_CONTROLLER_OUTPUT_DIR', './output'), 'ctcontroller.db')
+
+class StateStore():
+    """
+    A SQLite-backed record of the jobs managed by the controller.
+    Each thread uses its own connection; WAL mode lets the API server read the store while
+    provisioning threads write to it.
+
+    Attributes:
+        path (str): path to the database file
+
+    Methods:
+        save_job(job_id, options):
+            Records a job and the options it was started with.
+        set_scope(job_id, scope):
+            Records whether the job is the API server's default job.
+        update(job_id, component, state):
+            Records the state of a job's provisioner or application manager.
+        get(job_id):
+            Returns the record of a job.
+        active():
+            Returns the jobs that may still hold resources.
+        history(job_id):
+            Returns the status transitions of a job.
+        park(job_id, config, state, parked):
+            Moves the hardware of a job to the warm pool.
+        claim(job_id):
+            Removes a node from the warm pool, returning it.
+        pooled():
+            Returns the nodes of the warm pool.
+        enqueue(queue, job_id, priority):
+            Adds a job to the queue of waiters for a kind of node.
+        dequeue(ticket):
+            Removes a waiter from its queue.
+        touch(ticket):
+            Records that a waiter is still waiting.
+        waiters(queue, stale):
+            Returns the live waiters of a queue, in order.
+        signal(queue, held):
+            Records that a node of a queue was released.
+        generation(queue):
+            Returns the number of releases recorded for a queue.
+        hold_times(queue, limit):
+            Returns how long the last released nodes of a queue were held.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def save_job(self, job_id: str, options: dict=None):
+        """
+        Records a job and the options it was started with, keeping any existing state.
+
+            Parameters:
+                job_id (str): id of the job
+                options (dict): the options passed to the controller
+        """
+
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO jobs (job_id, options, created, updated) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(job_id) DO UPDATE SET options=excluded.options, updated=excluded.updated',
+            (job_id, json.dumps(options or {}), now, now))
+
+    def set_scope(self, job_id: str, scope: str):
+        """Records whether the job is the API server's `default` job or a scoped `job`."""
+        self._connection().execute('UPDATE jobs SET scope=? WHERE job_id=?', (scope, job_id))
+
+    def update(self, job_id: str, component: str, state: dict):
+        """
+        Records the state of a job's provisioner or application manager, and the transition
+        if its status changed.
+
+            Parameters:
+                job_id (str): id of the job
+                component (str): `provisioner` or `application`
+                state (dict): JSON-serializable state, including its `status`
+        """
+
+        if component not in ['provisioner', 'application']:
+            raise ValueError(f'Unknown component {component}')
+        status_column = 'hardware_status' if component == 'provisioner' else 'app_status'
+        status = state.get('status')
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(f'SELECT {status_column} FROM jobs WHERE job_id=?', (job_id,)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO jobs (job_id, options, created) VALUES (?, ?, ?)',
+                             (job_id, '{}', now))
+            conn.execute(f'UPDATE jobs SET {component}=?, {status_column}=?, updated=? WHERE job_id=?',
+                         (json.dumps(state), status, now, job_id))
+            if row is None or row[0] != status:
+                conn.execute('INSERT INTO transitions (job_id, component, status, at) VALUES (?, ?, ?, ?)',
+                             (job_id, component, status, now))
+
+    def _record(self, row) -> dict:
+        record = dict(row)
+        for key in ['options', 'provisioner', 'application']:
+            record[key] = json.loads(record[key]) if record[key] else None
+        return record
+
+    def get(self, job_id: str) -> dict:
+        """Returns the record of a job, or None if it is unknown."""
+        row = self._connection().execute('SELECT * FROM jobs WHERE job_id=?', (job_id,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def active(self) -> list:
+        """Returns the records of the jobs whose hardware may still be provisioned."""
+        marks = ','.join('?' * len(ACTIVE))
+        rows = self._connection().execute(
+            f'SELECT * FROM jobs WHERE hardware_status IN ({marks}) ORDER BY created', ACTIVE).fetchall()
+        return [self._record(row) for row in rows]
+
+    def history(self, job_id: str) -> list:
+        """Returns the status transitions of a job, oldest first."""
+        rows = self._connection().execute(
+            'SELECT component, status, at FROM transitions WHERE job_id=? ORDER BY id', (job_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def park(self, job_id: str, config: dict, state: dict, parked: float=None):
+        """
+        Moves the hardware of a job to the warm pool. In the same transaction the job's
+        hardware is recorded as SHUTDOWN, so that it is not reattached to after a restart.
+
+            Parameters:
+                job_id (str): id of the job that provisioned the hardware
+                config (dict): the provisioner configuration of the job
+                state (dict): the state of the provisioner, as returned by to_state()
+                parked (float): when the node was parked, by default now
+        """
+
+        now = time.time()
+        released = dict(state, status=Status.SHUTDOWN.name)
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO pool (job_id, site, node_type, gpu, config, provisioner, parked) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, state.get('site'), config.get('node_type'), int(bool(config.get('gpu'))),
+                          json.dumps(config), json.dumps(state), parked or now))
+            conn.execute('UPDATE jobs SET provisioner=?, hardware_status=?, updated=? WHERE job_id=?',
+                         (json.dumps(released), Status.SHUTDOWN.name, now, job_id))
+            conn.execute('INSERT INTO transitions (job_id, component, status, at) VALUES (?, ?, ?, ?)',
+                         (job_id, 'provisioner', Status.SHUTDOWN.name, now))
+
+    def _pooled(self, row) -> dict:
+        node = dict(row)
+        node['gpu'] = bool(node['gpu'])
+        for key in ['config', 'provisioner']:
+            node[key] = json.loads(node[key])
+        return node
+
+    def claim(self, job_id: str) -> dict:
+        """
+        Removes the node parked by job_id from the warm pool, so that only one caller can
+        use or release it.
+
+            Returns:
+                dict: the node, or None if another caller claimed it first
+        """
+
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT * FROM pool WHERE job_id=?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM pool WHERE job_id=?', (job_id,))
+        return self._pooled(row)
+
+    def pooled(self) -> list:
+        """Returns the nodes of the warm pool, most recently parked first."""
+        rows = self._connection().execute('SELECT * FROM pool ORDER BY parked DESC').fetchall()
+        return [self._pooled(row) for row in rows]
+
+    def enqueue(self, queue: str, job_id: str, priority: int=0) -> int:
+        """
+        Adds a job to the queue of waiters for a kind of node.
+
+            Parameters:
+                queue (str): name of the queue, e.g. TACC/orin
+                job_id (str): id of the waiting job
+                priority (int): waiters with a higher priority are served first
+
+            Returns:
+                int: the ticket of the waiter, increasing in the order of arrival
+        """
+
+        now = time.time()
+        cursor = self._connection().execute(
+            'INSERT INTO queue (queue, job_id, priority, enqueued, seen) VALUES (?, ?, ?, ?, ?)',
+            (queue, job_id, priority, now, now))
+        return cursor.lastrowid
+
+    def dequeue(self, ticket: int):
+        """Removes a waiter from its queue."""
+        self._connection().execute('DELETE FROM queue WHERE ticket=?', (ticket,))
+
+    def touch(self, ticket: int):
+        """Records that a waiter is still waiting, so that it is not taken for a crashed one."""
+        self._connection().execute('UPDATE queue SET seen=? WHERE ticket=?', (time.time(), ticket))
+
+    def waiters(self, queue: str, stale: float) -> list:
+        """
+        Returns the waiters of a queue in the order they are served: highest priority first,
+        then first come. Waiters not seen for stale seconds are removed.
+        """
+
+        conn = self._connection()
+        conn.execute('DELETE FROM queue WHERE queue=? AND seen<?', (queue, time.time() - stale))
+        rows = conn.execute('SELECT * FROM queue WHERE queue=? ORDER BY priority DESC, ticket',
+                            (queue,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def signal(self, queue: str, held: float=None):
+        """Records that a node of a queue was released after being held for held seconds."""
+        self._connection().execute('INSERT INTO releases (queue, held, at) VALUES (?, ?, ?)',
+                                   (queue, held, time.time()))
+
+    def generation(self, queue: str) -> int:
+        """Returns the id of the last release of a node of a queue, 0 if there was none."""
+        row = self._connection().execute('SELECT MAX(id) FROM releases WHERE queue=?', (queue,)).fetchone()
+        return row[0] or 0
+
+    def hold_times(self, queue: str, limit: int=20) -> list:
+        """Returns for how long the last limit released nodes of a queue were held, in seconds."""
+        rows = self._connection().execute(
+            'SELECT held FROM releases WHERE queue=? AND held IS NOT NULL ORDER BY id DESC LIMIT ?',
+            (queue, limit)).fetchall()
+        return [row[0] for row in rows]
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_store(path: str=None) -> StateStore:
+    """Returns the state store at path, by default at default_state_path(), opening it once."""
+    path = os.path.abspath(path or default_state_path())
+    with _STORES_LOCK:
+        if path not in _STORES:
+            _STORES[path] = StateStore(path)
+        return _STORES[path]
+
+class Persistent():
+    """
+    Mixin persisting selected attributes of a provisioner or application manager to a
+    StateStore whenever one of them changes. Status changes go through a StatusMachine,
+    which validates them, keeps their history and notifies its subscribers.
+
+    Attributes:
+        STATE_COMPONENT (str): name of the component in the store
+        STATE_ATTRIBUTES (list): names of the attributes to persist
+        VALIDATE_STATUS (bool): whether status changes are checked against the allowed transitions
+
+    Methods:
+        attach_store(store, job_id):
+            Starts persisting to store under job_id.
+        to_state():
+            Returns the persisted attributes as a JSON-serializable dict.
+        restore_state(state):
+            Sets the attributes from a persisted state.
+        add_status_listener(listener):
+            Calls listener(status) whenever the status changes.
+        subscribe_status(callback):
+            Calls callback(transition) whenever the status changes.
+        status_machine():
+            Returns the StatusMachine guarding the status.
+        status_history():
+            Returns the latest status transitions.
+    """
+
+    STATE_COMPONENT = None
+    STATE_ATTRIBUTES = ['status']
+    VALIDATE_STATUS = True
+
+    def __setattr__(self, name: str, value) -> None:
+        self._set_state(name, value, self.VALIDATE_STATUS)
+
+    def _set_state(self, name: str, value, validate: bool):
+        previous = self.__dict__.get(name)
+        changed = name == 'status' and value != previous
+        valid = True
+        if changed and validate and value is not None:
+            valid = self.status_machine().check(previous, value)
+        super().__setattr__(name, value)
+        if name not in self.STATE_ATTRIBUTES or value == previous:
+            return
+        if self.__dict__.get('state_store') is not None:
+            self.persist()
+        if changed:
+            self.status_machine().record(previous, value, valid)
+
+    def status_machine(self) -> StatusMachine:
+        """Returns the StatusMachine guarding the status, created with the first status."""
+        if 'state_machine' not in self.__dict__:
+            self.__dict__['state_machine'] = StatusMachine(type(self).__name__)
+        return self.__dict__['state_machine']
+
+    def add_status_listener(self, listener):
+        """Calls listener(status) from the thread changing the status whenever it changes."""
+        return self.subscribe_status(lambda transition: listener(transition.status))
+
+    def subscribe_status(self, callback):
+        """
+        Calls callback(transition) from the thread changing the status whenever it changes.
+        Returns a function cancelling the subscription.
+        """
+        return self.status_machine().subscribe(callback)
+
+    def status_history(self) -> list:
+        """Returns the latest status transitions, oldest first."""
+        return self.status_machine().transitions()
+
+    def attach_store(self, store: StateStore, job_id: str):
+        """Starts persisting the state to store under job_id, writing the current state."""
+        self.__dict__['state_job_id'] = job_id
+        self.__dict__['state_store'] = store
+        self.persist()
+
+    def to_state(self) -> dict:
+        """Returns the persisted attributes as a JSON-serializable dict."""
+        state = {}
+        for name in self.STATE_ATTRIBUTES:
+            value = getattr(self, name, None)
+            state[name] = value.name if isinstance(value, Enum) else value
+        return state
+
+    def restore_state(self, state: dict):
+        """Sets the persisted attributes from state, as returned by to_state()."""
+        for name, value in state.items():
+            if name not in self.STATE_ATTRIBUTES:
+                continue
+            if name == 'status' and value is not None:
+                value = Status[value]
+            # a restored status continues a previous run rather than following the current one
+            self._set_state(name, value, validate=False)
+        self.__dict__['restored'] = True
+
+    def persist(self):
+        """Writes the state to the attached store. Failures are logged but not raised."""
+        try:
+            self.state_store.update(self.state_job_id, self.STATE_COMPONENT, self.to_state())
+        except (sqlite3.Error, TypeError) as e:
+            LOGGER.warning(f'Could not persist {self.STATE_COMPONENT} state: {e}')
@@ -0,0 +1,160 @@
+"""
+Contains the StatusMachine, which guards the status of a provisioner or application manager.
+Each change of status is checked against TRANSITIONS, timestamped into a bounded history and
+published to the subscribers of the machine from the thread making the change, so that the
+API, the state store and the log viewers learn about it as it happens rather than by asking
+the node. A change that is not allowed is logged, or refused with StatusException when
+CT_CONTROLLER_STRICT_STATUS is true.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime, UTC
+from .util import Status, StatusException
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Number of transitions kept in the history of each component
+HISTORY_SIZE = int(os.environ.get('CT_CONTROLLER_STATUS_HISTORY', 100))
+# Whether a transition that is not allowed raises StatusException instead of being logged
+STRICT_STATUS = os.environ.get('CT_CONTROLLER_STRICT_STATUS', 'false').lower() == 'true'
+
+# The statuses each status may change to, besides FAILED and SHUTTINGDOWN
+TRANSITIONS = {
+    Status.PENDING: [Status.SETTINGUP, Status.READY, Status.RUNNING, Status.SHUTDOWN],
+    Status.SETTINGUP: [Status.READY, Status.COMPLETE],
+    Status.READY: [Status.SETTINGUP, Status.RUNNING, Status.SAVING, Status.COMPLETE, Status.SHUTDOWN],
+    Status.RUNNING: [Status.SAVING, Status.COMPLETE],
+    Status.SAVING: [Status.COMPLETE],
+    Status.COMPLETE: [Status.PENDING, Status.SETTINGUP, Status.READY, Status.RUNNING, Status.SAVING,
+                      Status.SHUTDOWN],
+    Status.SHUTTINGDOWN: [Status.SAVING, Status.COMPLETE, Status.SHUTDOWN],
+    Status.SHUTDOWN: [Status.PENDING, Status.SETTINGUP],
+    Status.FAILED: [Status.PENDING, Status.SETTINGUP, Status.RUNNING, Status.COMPLETE, Status.SHUTDOWN],
+}
+# A component can fail, or be shut down, whatever its status
+ALWAYS = [Status.FAILED, Status.SHUTTINGDOWN]
+
+def allowed(previous: Status, status: Status) -> bool:
+    """Returns True if the status may change from previous to status."""
+    return (previous is None or previous == status or status in ALWAYS
+            or status in TRANSITIONS.get(previous, []))
+
+class Transition():
+    """
+    A change of status.
+
+    Attributes:
+        component (str): the component whose status changed, e.g. ChameleonProvisioner
+        previous (Status): the status before the change, None for the first status
+        status (Status): the status after the change
+        time (float): when the change happened, in seconds since the epoch
+        valid (bool): whether the change was allowed
+    """
+
+    def __init__(self, component: str, previous: Status, status: Status, valid: bool=True):
+        self.component = component
+        self.previous = previous
+        self.status = status
+        self.time = time.time()
+        self.valid = valid
+
+    def to_dict(self) -> dict:
+        """Returns the transition as a JSON-serializable dict."""
+        return {'component': self.component,
+                'previous': self.previous.name if self.previous is not None else None,
+                'status': self.status.name if self.status is not None else None,
+                'time': datetime.fromtimestamp(self.time, UTC).isoformat(), 'valid': self.valid}
+
+    def __repr__(self) -> str:
+        previous = self.previous.name if self.previous is not None else None
+        status = self.status.name if self.status is not None else None
+        return f'Transition({self.component}, {previous} -> {status})'
+
+class StatusMachine():
+    """
+    Validates, records and publishes the status changes of a component.
+
+    Attributes:
+        component (str): name of the component, used in the log and the history
+        history (collections.deque): the latest transitions, oldest first
+        subscribers (list): the callables notified of every transition
+
+    Methods:
+        check(previous, status):
+            Logs, or raises in strict mode, a change that is not allowed.
+        record(previous, status, valid):
+            Adds a transition to the history and notifies the subscribers.
+        subscribe(callback):
+            Calls callback(transition) on every transition and returns a function cancelling it.
+        transitions():
+            Returns the history as a list.
+    """
+
+    def __init__(self, component: str, size: int=HISTORY_SIZE):
+        self.component = component
+        self.history = deque(maxlen=max(size, 1))
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def check(self, previous: Status, status: Status, strict: bool=STRICT_STATUS) -> bool:
+        """
+        Checks that the status may change from previous to status.
+
+            Parameters:
+                previous (Status): the current status
+                status (Status): the new status
+                strict (bool): whether to raise StatusException if the change is not allowed
+
+            Returns:
+                bool: whether the change is allowed
+        """
+
+        if allowed(previous, status):
+            return True
+        msg = f'{self.component} cannot change from {previous.name} to {status.name}'
+        if strict:
+            raise StatusException(msg)
+        LOGGER.warning(msg)
+        return False
+
+    def record(self, previous: Status, status: Status, valid: bool=True) -> Transition:
+        """Adds the transition to the history and calls the subscribers with it."""
+        transition = Transition(self.component, previous, status, valid)
+        with self.lock:
+            self.history.append(transition)
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(transition)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.warning(f'Subscriber to the status of {self.component} failed: {e}')
+        return transition
+
+    def subscribe(self, callback):
+        """
+        Calls callback(transition) from the thread changing the status on every transition.
+
+            Parameters:
+                callback (callable): called with each Transition
+
+            Returns:
+                callable: cancels the subscription
+        """
+
+        with self.lock:
+            self.subscribers.append(callback)
+
+        def unsubscribe():
+            with self.lock:
+                if callback in self.subscribers:
+                    self.subscribers.remove(callback)
+        return unsubscribe
+
+    def transitions(self) -> list:
+        """Returns the latest transitions, oldest first."""
+        with self.lock:
+            return list(self.history)
@@ -0,0 +1,173 @@
+"""
+Contains the StepGraph class used to run the steps of a provisioning workflow concurrently.
+Each step names the steps it depends on and starts as soon as they have all finished, so
+independent steps such as selecting an image, reserving a lease and allocating a floating
+IP overlap. If a step fails, no further step is started, the steps still running are asked
+to stop, and the undo actions of the steps that ran are called in reverse order.
+"""
+
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .util import CancelledException
+
+LOGGER = logging.getLogger("CT Controller")
+
+_current_graph = contextvars.ContextVar('ctcontroller_step_graph', default=None)
+
+def check_aborted():
+    """
+    Raises CancelledException if the graph running the current step has failed, so that
+    long waits in sibling steps stop early.
+    """
+    graph = _current_graph.get()
+    if graph is not None and graph.aborted.is_set():
+        raise CancelledException(f'Step aborted after {graph.failed} failed')
+
+class Step():
+    """
+    A step of a workflow.
+
+    Attributes:
+        name (str): name of the step
+        func (callable): called without arguments to run the step
+        requires (list): names of the steps that must finish before this one starts
+        undo (callable): called without arguments to undo the step after a failure, if any
+        skip (bool): whether the step has already been done and must not run again
+    """
+
+    def __init__(self, name: str, func, requires: list=None, undo=None, skip: bool=False):
+        self.name = name
+        self.func = func
+        self.requires = list(requires or [])
+        self.undo = undo
+        self.skip = skip
+
+class StepGraph():
+    """
+    Runs steps as soon as the steps they depend on have finished.
+
+    Attributes:
+        steps (dict): maps the name of each step to the step
+        max_workers (int): maximum number of steps running at the same time
+        aborted (threading.Event): set once a step has failed
+        failed (str): name of the first step that failed, if any
+        finished (list): names of the steps that ran, in the order they finished
+
+    Methods:
+        add(name, func, requires, undo, skip):
+            Adds a step.
+        run(wrap):
+            Runs all the steps, undoing them if one fails.
+        compensate():
+            Undoes the steps that ran, latest first.
+    """
+
+    def __init__(self, max_workers: int=4):
+        self.steps = {}
+        self.max_workers = max_workers
+        self.aborted = threading.Event()
+        self.failed = None
+        self.finished = []
+
+    def add(self, name: str, func, requires: list=None, undo=None, skip: bool=False) -> Step:
+        """
+        Adds a step to the graph.
+
+            Parameters:
+                name (str): name of the step
+                func (callable): runs the step
+                requires (list): names of the steps it depends on, which must already be added
+                undo (callable): undoes the step, also called if the step itself failed
+                skip (bool): whether the step has already been done
+
+            Returns:
+                Step: the step
+        """
+
+        missing = [req for req in requires or [] if req not in self.steps]
+        if missing:
+            raise ValueError(f'Step {name} depends on unknown steps {missing}')
+        self.steps[name] = Step(name, func, requires, undo, skip)
+        return self.steps[name]
+
+    def _ready(self, done: set, started: set) -> list:
+        return [step for name, step in self.steps.items()
+                if name not in started and all(req in done for req in step.requires)]
+
+    def _run_step(self, step: Step, wrap):
+        token = _current_graph.set(self)
+        try:
+            if wrap is not None:
+                with wrap(step.name):
+                    step.func()
+            else:
+                step.func()
+        finally:
+            _current_graph.reset(token)
+
+    def run(self, wrap=None):
+        """
+        Runs the steps, each in a copy of the caller's context so that tracing spans and
+        operation phases nest under the caller's. If a step fails, waits for the steps
+        still running, undoes the steps that ran and raises the first error.
+
+            Parameters:
+                wrap (callable): called with the name of each step, returns a context manager
+                                 entered around it, e.g. an operation phase
+        """
+
+        done, started = set(), set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ctcontroller-step') as pool:
+            while True:
+                # skipped steps are done at once and may make further steps ready
+                ready = self._ready(done, started) if error is None else []
+                while ready:
+                    for step in ready:
+                        started.add(step.name)
+                        if step.skip:
+                            LOGGER.info(f'Skipping {step.name}, already done')
+                            done.add(step.name)
+                            self.finished.append(step.name)
+                            continue
+                        context = contextvars.copy_context()
+                        running[pool.submit(context.run, self._run_step, step, wrap)] = step
+                    ready = self._ready(done, started)
+                if not running:
+                    break
+                completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in completed:
+                    step = running.pop(future)
+                    self.finished.append(step.name)
+                    exc = future.exception()
+                    if exc is None:
+                        done.add(step.name)
+                    elif error is None:
+                        error = exc
+                        self.failed = step.name
+                        self.aborted.set()
+                        LOGGER.error(f'Step {step.name} failed, stopping the other steps')
+        if error is not None:
+            self.compensate()
+            raise error
+        if len(done) < len(self.steps):
+            raise ValueError(f'Steps {sorted(set(self.steps) - done)} have unmet dependencies')
+
+    def compensate(self):
+        """
+        Undoes the steps that ran, the latest to finish first. Undo failures are logged so
+        that the remaining steps are still undone.
+        """
+
+        for name in reversed(self.finished):
+            step = self.steps[name]
+            if step.undo is None:
+                continue
+            try:
+                LOGGER.info(f'Undoing {name}')
+                step.undo()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.error(f'Could not undo {name}: {getattr(e, "msg", e)}')
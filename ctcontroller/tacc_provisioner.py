@@ -1,13 +1,73 @@
 """Contains the TACCProvisioner for provisioning bare-metal hardware at TACC."""
 
+import os
 import time
 import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .util import ProvisionException, Status
 from .provisioner import Provisioner
-from .remote import AuthenticationException
+from .remote import AuthenticationException, SSHException
+from .node_lock import NodeLock
+from .scheduler import get_scheduler
+from .tracing import traced
 
 LOGGER = logging.getLogger("CT Controller")
 
+# Time in seconds a probe may take to connect to a node
+PROBE_TIMEOUT = float(os.environ.get('CT_CONTROLLER_PROBE_TIMEOUT', 10))
+# Time in seconds an unreachable node is skipped for, doubling with each further failure
+PROBE_COOLDOWN = float(os.environ.get('CT_CONTROLLER_PROBE_COOLDOWN', 300))
+
+class CircuitBreaker():
+    """
+    Tracks the nodes that could not be reached, so that they are skipped for a cooldown
+    instead of being probed again on every pass.
+
+    Attributes:
+        cooldown (float): time in seconds a node is skipped for after its first failure
+        max_cooldown (float): longest time in seconds a node is skipped for
+        failures (dict): maps a node to its number of consecutive failures and the time
+                         until which it is skipped
+
+    Methods:
+        available(node):
+            Returns True if the node may be probed.
+        failed(node):
+            Records a failure to reach the node.
+        succeeded(node):
+            Records that the node was reached.
+    """
+
+    def __init__(self, cooldown: float=PROBE_COOLDOWN, max_cooldown: float=None):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown if max_cooldown is not None else 8 * cooldown
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def available(self, node: str) -> bool:
+        """Returns True if the node has not failed recently."""
+        with self.lock:
+            _, until = self.failures.get(node, (0, 0))
+            return time.monotonic() >= until
+
+    def failed(self, node: str):
+        """Records a failure to reach the node and skips it for the cooldown."""
+        with self.lock:
+            count, _ = self.failures.get(node, (0, 0))
+            cooldown = min(self.cooldown * 2 ** count, self.max_cooldown)
+            self.failures[node] = (count + 1, time.monotonic() + cooldown)
+        LOGGER.warning(f'Skipping node {node} for {int(cooldown)}s')
+
+    def succeeded(self, node: str):
+        """Records that the node was reached, closing its circuit."""
+        with self.lock:
+            self.failures.pop(node, None)
+
+# shared by all the TACC provisioners of the process
+BREAKER = CircuitBreaker()
+
 class TACCProvisioner(Provisioner):
     """
     A subclass of the Provisioner class to handle the provisioning and deprovisioning
@@ -15,26 +75,51 @@ class TACCProvisioner(Provisioner):
 
     Attributes:
         lock_file (str): name of the lock file used to reserve a node
+        nodes (list): the reserved nodes, as described in the site configuration, with the
+                      device_id and lock_token of each; the first one is the primary node
+        locks (list): the locks held on the reserved nodes, renewed by heartbeats
+        runners (list): runners connected to the reserved nodes
+        priority (int): jobs with a higher priority are served first when waiting for a node
+        reserved_at (float): when the nodes were reserved, used to estimate the wait of others
         available_nodes (dict): a dictionary of nodes accessible at the TACC site
         remote_id (str): username to be used on the remote server
 
     Methods:
 
+        probe_node(node):
+            Connects to a node and checks whether it is free.
         reserve_node(node_type):
-            Checks if any of the nodes that match node_type are available.
+            Reserves num_nodes of the nodes that match node_type, or none of them.
+        get_remote_runners():
+            Returns runners connected to all the reserved nodes.
         provision_instance():
-            Periodically checks until a compatible resource has become available
+            Waits in the queue of the node type until compatible nodes have been reserved
+        reattach():
+            Reuses the nodes reserved before a restart if they are still locked
+        give_back(locks, runners):
+            Releases the locks and closes the runners of nodes that could not be reattached
+        lock_lost(lock):
+            Fails the job when another controller has taken over the lock on one of its nodes
         shutdown_instance():
-            Deprovisions the node
+            Deprovisions the nodes
     """
 
+    STATE_ATTRIBUTES = Provisioner.STATE_ATTRIBUTES + ['nodes']
+
     def __init__(self, cfg):
         cfg['key_name'] = 'default'
         cfg['user_name_required'] = True
         super().__init__(cfg)
 
         self.available_nodes = self.site_config['Hosts']
+        self.num_nodes = int(self.num_nodes)
+        self.job_id = cfg['job_id']
         self.lock_file = 'ctcontroller.lock'
+        self.nodes = []
+        self.locks = []
+        self.runners = []
+        self.priority = cfg.get('priority') or 0
+        self.reserved_at = None
 
         if self.use_service_acct:
             self.remote_id = None
@@ -44,69 +129,235 @@ class TACCProvisioner(Provisioner):
             self.status = Status.FAILED
             raise ProvisionException('User id on remote server was not specified.')
 
+    def node_runner(self, node: dict, **kwargs):
+        """Returns a runner connected to a node as described in the site configuration."""
+        remote_id = self.remote_id if self.remote_id is not None else node['Username']
+        return self.get_remote_runner(ip_address=node['IP'], remote_id=remote_id,
+                                      jump_ip=node.get('JumpHost'),
+                                      jump_id=node.get('JumpUser'),
+                                      jump_key=node.get('JumpKey'),
+                                      httpproxy=node.get('HttpProxy'),
+                                      device_id=node.get('device_id'), **kwargs)
+
+    def probe_node(self, node: dict):
+        """
+        Connects to a node with a short timeout and checks whether it is free.
+
+            Parameters:
+                node (dict): the node, as described in the site configuration
+
+            Returns:
+                RemoteRunner: a runner connected to the node if it is free, None if it is in use
+        """
+
+        try:
+            runner = self.node_runner(node, num_retries=1, connect_timeout=PROBE_TIMEOUT)
+        except AuthenticationException:
+            LOGGER.warning(f'Authentication failed while connecting to node {node["IP"]}')
+            BREAKER.failed(node['IP'])
+            return None
+        except (TimeoutError, OSError, SSHException):
+            LOGGER.warning(f'SSH connection timed out while connecting node {node["IP"]}')
+            BREAKER.failed(node['IP'])
+            return None
+        BREAKER.succeeded(node['IP'])
+        if not NodeLock(runner, self.lock_file, self.job_id).available():
+            LOGGER.info(f'node {node["IP"]} in use')
+            runner.close()
+            return None
+        return runner
+
+    @traced('reserve_node', lambda self, node_type: {'site': self.site, 'node_type': node_type})
     def reserve_node(self, node_type) -> bool:
         """
-        Loops over nodes at TACC that match the requested node type and reserves the
-        first node if available.
+        Probes the nodes at TACC that match the requested node type concurrently and locks
+        the first num_nodes found available. If fewer are available, the locks already taken
+        are released, so that nodes are reserved all together or not at all. Nodes that could
+        not be reached recently are skipped.
 
             Parameters: 
                 node_type (dict): a dictionary describing the requested node type
 
             Returns:
-                bool: True if an available node was reserved
-                      False if there were no available nodes to reserver
+                bool: True if the nodes were reserved
+                      False if there were not enough available nodes to reserve
         """
 
         available_nodes = self.available_nodes[node_type]
-        if available_nodes == []:
+        if len(available_nodes) < self.num_nodes:
             self.status = Status.FAILED
-            raise ProvisionException(f'No node of type {node_type} is available')
-        for node in self.available_nodes[node_type]:
-            try:
-                if self.remote_id is not None:
-                    remote_id = self.remote_id
-                else:
-                    remote_id = node['Username']
-                runner = self.get_remote_runner(ip_address=node['IP'], remote_id=remote_id,
-                                                jump_ip=node.get('JumpHost'),
-                                                jump_id=node.get('JumpUser'),
-                                                jump_key=node.get('JumpKey'),
-                                                httpproxy=node.get('HttpProxy'))
-            except AuthenticationException:
-                LOGGER.warning(f'Authentication failed while connecting to node {node}')
-                continue
-            except TimeoutError:
-                LOGGER.warning(f'SSH connection timed out while connecting node {node}')
-                continue
-            if not runner.file_exists(self.lock_file):
-                runner.create_file(self.lock_file)
-                self.runner = runner
-                self.ip_addresses = node['IP']
-                self.remote_id = node['Username']
-                self.device_id = runner.device_id
-                self.jump_ip = node.get('JumpHost')
-                self.jump_id = node.get('JumpUser')
-                self.jump_key = node.get('JumpKey')
-                self.httpproxy = node.get('HttpProxy')
+            raise ProvisionException(f'{self.num_nodes} nodes of type {node_type} requested, '
+                                     f'but only {len(available_nodes)} exist')
+        candidates = [node for node in available_nodes if BREAKER.available(node['IP'])]
+        if len(candidates) < self.num_nodes:
+            LOGGER.info(f'Not enough nodes of type {node_type} are reachable, waiting for their cooldown')
+            return False
+        claimed = []
+
+        def close_unclaimed(future):
+            # runners of the free nodes that were not claimed are closed as their probes end
+            runner = future.result() if future.exception() is None else None
+            if runner is not None and all(runner is not taken for _, taken, _ in claimed):
+                runner.close()
+
+        futures = {}
+        pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix='ctcontroller-probe')
+        try:
+            futures = {pool.submit(contextvars.copy_context().run, self.probe_node, node): node
+                       for node in candidates}
+            for future in as_completed(futures):
+                node = futures[future]
+                runner = future.result()
+                if runner is None:
+                    continue
+                lock = NodeLock(runner, self.lock_file, self.job_id)
+                if not lock.acquire():
+                    LOGGER.info(f'node {node["IP"]} was locked by another controller first')
+                    continue
+                claimed.append((node, runner, lock))
                 LOGGER.info(f'node {node["IP"]} available')
-                return True
-            LOGGER.info(f'node {node} in use, going to next node...')
-            del runner
-        return False
+                if len(claimed) == self.num_nodes:
+                    break
+        finally:
+            if len(claimed) < self.num_nodes:
+                # all or nothing: give back the nodes locked so far
+                for node, runner, lock in claimed:
+                    lock.release()
+                    runner.close()
+                claimed = []
+            for future in futures:
+                future.add_done_callback(close_unclaimed)
+            # the probes still connecting finish in the background
+            pool.shutdown(wait=False)
+        if not claimed:
+            return False
+
+        for _, _, lock in claimed:
+            lock.start_heartbeat(self.lock_lost)
+        self.locks = [lock for _, _, lock in claimed]
+        self.runners = [runner for _, runner, _ in claimed]
+        self.runner = self.runners[0]
+        node, runner, _ = claimed[0]
+        self.ip_addresses = node['IP']
+        self.remote_id = node['Username']
+        self.device_id = runner.device_id
+        self.jump_ip = node.get('JumpHost')
+        self.jump_id = node.get('JumpUser')
+        self.jump_key = node.get('JumpKey')
+        self.httpproxy = node.get('HttpProxy')
+        self.nodes = [dict(node, device_id=runner.device_id, lock_token=lock.token)
+                      for node, runner, lock in claimed]
+        return True
+
+    def get_remote_runners(self) -> list:
+        """Returns runners connected to all the reserved nodes, the primary node first."""
+        if len(self.runners) == len(self.nodes) and self.runners:
+            return self.runners
+        return [self.node_runner(node) for node in self.nodes] or [self.get_remote_runner()]
 
     def provision_instance(self) -> None:
-        """Periodically checks for an available node and exits once it has been reserved."""
+        """
+        Waits in the queue of the requested node type and, once at its head, probes the nodes
+        until enough have been reserved, probing again when a node is released.
+        """
 
         self.status = Status.SETTINGUP
-        LOGGER.info('Waiting for a node to be available')
-        while not self.reserve_node(self.node_type):
-            LOGGER.info('.')
-            time.sleep(3)
+        LOGGER.info(f'Waiting for {self.num_nodes} node(s) to be available')
+        slots = len(self.available_nodes.get(self.node_type) or [])
+        with get_scheduler().ticket(self.job_id, self.site, self.node_type, self.priority, slots) as ticket:
+            ticket.wait(self.check_cancelled, self.progress)
+            while not self.reserve_node(self.node_type):
+                ticket.wait(self.check_cancelled, self.progress, retry=True)
+        self.reserved_at = time.time()
         self.status = Status.READY
 
+    def reattach(self) -> None:
+        """
+        Reuses the nodes that were reserved before the controller restarted if they all still
+        hold their locks, even if the locks expired in the meantime, and otherwise waits for
+        nodes again.
+        """
+
+        if self.nodes:
+            locks, runners = [], []
+            node = None
+            try:
+                for node in self.nodes:
+                    runner = self.node_runner(node)
+                    lock = NodeLock(runner, self.lock_file, self.job_id, token=node.get('lock_token'))
+                    runners.append(runner)
+                    if not (lock.held() and lock.renew()):
+                        break
+                    locks.append(lock)
+            except (AuthenticationException, TimeoutError, OSError, SSHException):
+                LOGGER.warning(f'Could not reconnect to node {node["IP"]}')
+            except Exception:
+                self.give_back(locks, runners)
+                raise
+            if len(locks) == len(self.nodes):
+                LOGGER.info(f'Reattaching to nodes {[node["IP"] for node in self.nodes]}')
+                for lock in locks:
+                    lock.start_heartbeat(self.lock_lost)
+                self.locks, self.runners = locks, runners
+                self.runner = runners[0]
+                self.status = Status.READY
+                return
+            LOGGER.info('The nodes are no longer all reserved')
+            self.give_back(locks, runners)
+            self.nodes = []
+            self.ip_addresses = None
+        self.provision_instance()
+
+    def give_back(self, locks: list, runners: list):
+        """
+        Releases the locks and closes the runners of nodes that could not all be reattached.
+        Failures are logged, so that every node is given back.
+
+            Parameters:
+                locks (list): the NodeLocks renewed so far
+                runners (list): the runners connected so far
+        """
+
+        for lock in locks:
+            try:
+                lock.release()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.warning(f'Could not release the lock on node {lock.runner.ip_address}: {getattr(e, "msg", e)}')
+        for runner in runners:
+            try:
+                runner.close()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.warning(f'Could not close the connection to node {runner.ip_address}: {getattr(e, "msg", e)}')
+
+    def lock_lost(self, lock: NodeLock):
+        """
+        Fails the job once the heartbeat finds that another controller has taken over the lock
+        on one of its nodes, which the job can then no longer rely on.
+        """
+        LOGGER.error(f'Job {self.job_id} lost its lock on node {lock.runner.ip_address}')
+        self.status = Status.FAILED
+
     def shutdown_instance(self) -> None:
-        """Deprovisions the node by deleting the lock file."""
+        """Deprovisions the nodes by stopping the heartbeats and deleting the lock files."""
 
         self.status = Status.SHUTTINGDOWN
-        self.get_remote_runner().delete_file(self.lock_file)
+        locks, runners = self.locks, []
+        if len(locks) != len(self.nodes):
+            # after a restart, reconnect to each node to delete its lock; the lock of a node
+            # that cannot be reached expires on its own
+            locks = []
+            for node in self.nodes:
+                try:
+                    runner = self.node_runner(node)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    LOGGER.warning(f'Could not reconnect to node {node["IP"]} to release it: {getattr(e, "msg", e)}')
+                    continue
+                runners.append(runner)
+                locks.append(NodeLock(runner, self.lock_file, self.job_id, token=node.get('lock_token')))
+        self.give_back(locks, runners)
+        # the next job waiting for a node of this type can probe again
+        held = time.time() - self.reserved_at if self.reserved_at is not None else None
+        for _ in self.nodes or locks:
+            get_scheduler().released(self.site, self.node_type, held)
+        self.locks, self.runners, self.nodes = [], [], []
         self.status = Status.SHUTDOWN
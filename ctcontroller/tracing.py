@@ -0,0 +1,328 @@
+"""
+Contains the tracing helpers used to time the phases of the controller workflow.
+Each phase is recorded as a span with a name, attributes, a parent and a duration.
+Finished spans are exported over OTLP when a collector is configured and the
+OpenTelemetry SDK is installed, and otherwise, if CT_CONTROLLER_TRACE_FILE is set,
+appended to a local JSON-lines file rotated by size.
+A summary of the spans of each job is kept in memory for the `/timings` endpoint.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Number of finished spans kept in memory per job
+MAX_SPANS = 2000
+# Number of jobs whose spans are kept in memory, the least recently traced are forgotten first
+MAX_JOBS = 100
+# Longest attribute value recorded, e.g. for shell commands
+MAX_ATTRIBUTE = 200
+# Size in bytes after which the trace file is rotated, and number of rotated files kept
+TRACE_FILE_MAX_BYTES = int(os.environ.get('CT_CONTROLLER_TRACE_FILE_MAX_BYTES', 50000000))
+TRACE_FILE_BACKUP_COUNT = int(os.environ.get('CT_CONTROLLER_TRACE_FILE_BACKUP_COUNT', 5))
+
+_current_span = contextvars.ContextVar('ctcontroller_span', default=None)
+_job_id = contextvars.ContextVar('ctcontroller_job_id', default=None)
+
+def current_job_id() -> str:
+    """Returns the id of the job the current context is working on."""
+    return _job_id.get()
+
+def set_job_id(job_id: str):
+    """Sets the id of the job the current context is working on."""
+    return _job_id.set(job_id)
+
+def current_span() -> 'Span':
+    """Returns the innermost span running in the current context, if any."""
+    return _current_span.get()
+
+@contextmanager
+def job_context(job_id: str):
+    """Attributes the spans started in the block to job_id."""
+    token = _job_id.set(job_id)
+    try:
+        yield
+    finally:
+        _job_id.reset(token)
+
+def _attribute(value):
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    value = str(value)
+    return value if len(value) <= MAX_ATTRIBUTE else value[:MAX_ATTRIBUTE] + '...'
+
+class Span():
+    """
+    A timed phase of the workflow.
+
+    Attributes:
+        name (str): name of the phase, e.g. provisioner.reserve_lease
+        attributes (dict): details of the phase
+        trace_id (str): id shared by all spans of one trace
+        span_id (str): id of the span
+        parent_id (str): id of the enclosing span, if any
+        parent (Span): the enclosing span, if any
+        job_id (str): the job the span belongs to
+        start (float): start time in seconds since the epoch
+        duration (float): duration in seconds once the span has ended
+        status (str): OK or ERROR
+        error (str): the error that ended the span, if any
+    """
+
+    def __init__(self, name: str, attributes: dict, parent: 'Span'=None):
+        self.name = name
+        self.attributes = {key: _attribute(val) for key, val in attributes.items()}
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.parent = parent
+        self.job_id = current_job_id()
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.status = 'OK'
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        """Adds an attribute to the span."""
+        self.attributes[key] = _attribute(value)
+
+    def end(self, error: Exception=None):
+        """Ends the span, recording error if the phase failed."""
+        self.duration = time.perf_counter() - self.started
+        if error is not None:
+            self.status = 'ERROR'
+            self.error = _attribute(getattr(error, 'msg', None) or repr(error))
+
+    def to_dict(self) -> dict:
+        """Returns a JSON-serializable description of the span."""
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'job_id': self.job_id, 'start': self.start,
+                'duration': round(self.duration, 6) if self.duration is not None else None,
+                'status': self.status, 'error': self.error, 'attributes': self.attributes}
+
+class JsonLinesExporter():
+    """Appends finished spans to a file rotated by size, one JSON object per line."""
+
+    def __init__(self, path: str, max_bytes: int=TRACE_FILE_MAX_BYTES,
+                 backup_count: int=TRACE_FILE_BACKUP_COUNT):
+        from .logfiles import RotatingLogWriter  # pylint: disable=import-outside-toplevel
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.writer = RotatingLogWriter(path, max_bytes=max_bytes, backup_count=backup_count)
+
+    def export(self, span: Span):
+        self.writer.write(json.dumps(span.to_dict()) + '\n')
+
+class OTLPExporter():
+    """
+    Forwards spans to an OpenTelemetry collector over OTLP/HTTP.
+    Spans are created in the OpenTelemetry SDK as they start, so that they nest the same
+    way as the controller's own spans.
+    """
+
+    def __init__(self, endpoint: str):
+        # pylint: disable=import-outside-toplevel
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        provider = TracerProvider(resource=Resource.create({'service.name': 'ctcontroller'}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        self.trace = trace
+        self.provider = provider
+        self.tracer = provider.get_tracer('ctcontroller')
+
+    def start(self, span: Span, parent):
+        context = self.trace.set_span_in_context(parent) if parent is not None else None
+        return self.tracer.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+
+    def export(self, span: Span, otel_span):
+        for key, val in span.attributes.items():
+            if val is not None:
+                otel_span.set_attribute(key, val)
+        if span.job_id is not None:
+            otel_span.set_attribute('ctcontroller.job_id', span.job_id)
+        if span.status == 'ERROR':
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int((span.start + span.duration) * 1e9))
+
+class Tracer():
+    """
+    Records spans, exports them and keeps a per-job summary of their durations.
+
+    Methods:
+        span(name, **attributes):
+            Context manager timing a phase.
+        timings(job_id):
+            Returns the summary of the spans of a job.
+        forget(job_id):
+            Drops the spans and summary of a job.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configured = False
+        self.otlp = None
+        self.file = None
+        self.spans = {}
+        self.summaries = {}
+        self.otel_spans = {}
+
+    def configure(self):
+        """Sets up the exporters from the environment, once."""
+        with self.lock:
+            if self.configured:
+                return
+            endpoint = (os.environ.get('CT_CONTROLLER_OTLP_ENDPOINT')
+                        or os.environ.get('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT'))
+            if endpoint:
+                try:
+                    self.otlp = OTLPExporter(endpoint)
+                    LOGGER.info(f'Exporting traces to {endpoint}')
+                except ImportError:
+                    LOGGER.warning('OpenTelemetry is not installed, traces are not exported to the collector')
+            path = os.environ.get('CT_CONTROLLER_TRACE_FILE')
+            if self.otlp is None and path:
+                self.file = JsonLinesExporter(path)
+            self.configured = True
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Times the enclosed block as a span nested in the current span.
+
+            Parameters:
+                name (str): name of the span
+                attributes: details of the phase
+
+            Yields:
+                Span: the span, which can be given more attributes
+        """
+
+        if not self.configured:
+            self.configure()
+        parent = _current_span.get()
+        span = Span(name, attributes, parent)
+        otel_span = None
+        if self.otlp is not None:
+            otel_span = self.otlp.start(span, self.otel_spans.get(span.parent_id))
+            self.otel_spans[span.span_id] = otel_span
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(e)
+            raise
+        else:
+            span.end()
+        finally:
+            _current_span.reset(token)
+            self._finish(span, otel_span)
+
+    def _finish(self, span: Span, otel_span):
+        try:
+            if otel_span is not None:
+                self.otel_spans.pop(span.span_id, None)
+                self.otlp.export(span, otel_span)
+            elif self.file is not None:
+                self.file.export(span)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            LOGGER.debug(f'Could not export span {span.name}: {e}')
+        key = span.job_id
+        with self.lock:
+            if key not in self.summaries:
+                while len(self.summaries) >= MAX_JOBS:
+                    oldest = next(iter(self.summaries))
+                    self.summaries.pop(oldest)
+                    self.spans.pop(oldest, None)
+            else:
+                # keep the jobs in the order they were last traced
+                self.summaries[key] = self.summaries.pop(key)
+            self.spans.setdefault(key, deque(maxlen=MAX_SPANS)).append(span.to_dict())
+            summary = self.summaries.setdefault(key, {})
+            entry = summary.setdefault(span.name, {'name': span.name, 'count': 0, 'errors': 0,
+                                                   'total': 0.0, 'max': 0.0, 'last': None,
+                                                   'first_start': span.start})
+            entry['count'] += 1
+            entry['errors'] += span.status == 'ERROR'
+            entry['total'] += span.duration
+            entry['max'] = max(entry['max'], span.duration)
+            entry['last'] = span.duration
+
+    def timings(self, job_id: str, detail: bool=False) -> dict:
+        """
+        Returns the summary of the spans of a job: for each span name, how many times it ran,
+        how many failed and its total, maximum and latest duration in seconds.
+
+            Parameters:
+                job_id (str): id of the job
+                detail (bool): whether to include the most recent spans themselves
+
+            Returns:
+                dict: the summary
+        """
+
+        with self.lock:
+            entries = [dict(entry) for entry in self.summaries.get(job_id, {}).values()]
+            spans = list(self.spans.get(job_id, [])) if detail else None
+        entries.sort(key=lambda entry: entry['first_start'])
+        for entry in entries:
+            entry['mean'] = round(entry['total'] / entry['count'], 6)
+            for key in ['total', 'max', 'last']:
+                entry[key] = round(entry[key], 6)
+            del entry['first_start']
+        result = {'job_id': job_id, 'phases': entries}
+        if detail:
+            result['spans'] = spans
+        return result
+
+    def forget(self, job_id: str):
+        """Drops the spans and summary of a job, e.g. once it has been released."""
+        with self.lock:
+            self.spans.pop(job_id, None)
+            self.summaries.pop(job_id, None)
+
+TRACER = Tracer()
+
+def span(name: str, **attributes):
+    """Times the enclosed block as a span, see Tracer.span."""
+    return TRACER.span(name, **attributes)
+
+def traced(name: str, attributes=None):
+    """
+    Decorator timing every call of a function as a span.
+
+        Parameters:
+            name (str): name of the span
+            attributes (callable): called with the function's arguments, returns the span
+                                   attributes
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            attrs = attributes(*args, **kwargs) if attributes is not None else {}
+            with TRACER.span(name, **attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def command_attributes(runner, cmd, *args, **kwargs) -> dict:
+    """Span attributes of a command run by a runner."""
+    text = cmd if isinstance(cmd, str) else ' '.join(cmd)
+    return {'host': getattr(runner, 'ip_address', None), 'command': ' '.join(text.split())}
+
+def transfer_attributes(runner, src, target, *args, **kwargs) -> dict:
+    """Span attributes of a file transfer made by a runner."""
+    return {'host': getattr(runner, 'ip_address', None), 'src': src, 'target': target}
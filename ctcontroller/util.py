@@ -4,14 +4,17 @@ Contains common helper functions and classes.
 
 import logging
 from os import environ
-from subprocess import run
 from datetime import datetime
 from enum import Enum
+from .tracing import traced
 
 LOGGER = logging.getLogger("CT Controller")
 
 def setup_logger(log_dir: str, mode: str):
-    """Sets up a logger."""
+    """
+    Sets up the logger, writing to the console and to run.log in log_dir through the
+    queue of the logging pipeline.
+    """
 
     log_level = environ.get("CT_CONTROLLER_LOG_LEVEL", "INFO")
     if log_level == "DEBUG":
@@ -23,45 +26,46 @@ def setup_logger(log_dir: str, mode: str):
     elif log_level == "ERROR":
         LOGGER.setLevel(logging.ERROR)
     if not LOGGER.handlers:
-
-        formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s '
-                '[in %(pathname)s:%(lineno)d]')
+        # pylint: disable=import-outside-toplevel
+        from .log_pipeline import start_pipeline
         handler = logging.StreamHandler()
         if mode == 'demo':
             fileHandler = logging.handlers.RotatingFileHandler(f'{log_dir}/run.log', maxBytes=50000000, backupCount=10)
         else:
             fileHandler = logging.FileHandler(f"{log_dir}/run.log")
-        handler.setFormatter(formatter)
-        fileHandler.setFormatter(formatter)
-        LOGGER.addHandler(handler)
-        LOGGER.addHandler(fileHandler)
+        # the handlers write from a background thread, fed through a queue
+        start_pipeline(LOGGER, handler, fileHandler)
 
-def capture_shell(cmd):
+@traced('shell', lambda cmd, timeout=None: {'command': cmd if isinstance(cmd, str) else ' '.join(cmd)})
+def capture_shell(cmd, timeout: float=None):
     """
     Runs a shell command and returns the stdout and stderr.
     If the command prints anything to stderr then print it as a warning.
+    The command runs on the shared executor, so that independent commands run from
+    different threads run in parallel, and is killed along with its children if it runs
+    for longer than timeout, which raises ControllerException.
 
         Parameters:
-            cmd (str or list): command to run on the command-line
+            cmd (str or list): command to run on the command-line, a string is split as a shell would
+            timeout (float): time in seconds after which the command is killed,
+                             CT_CONTROLLER_SHELL_TIMEOUT by default
 
         Returns:
             stdout: standard output from the command
             stderr: standard error from the command    
     """
 
-    if isinstance(cmd, str):
-        cmd = cmd.split(' ')
-        cmdstr = cmd
-    elif isinstance(cmd, list):
-        cmdstr = ' '.join(cmd)
-    else:
+    # pylint: disable=import-outside-toplevel
+    from .executor import SHELL_TIMEOUT, get_executor
+    if not isinstance(cmd, (str, list)):
         raise ControllerException(f'Invalid shell command: {cmd}')
-    proc = run(cmd, capture_output=True, check=False)
-    out = proc.stdout.decode('utf-8').strip()
-    err = proc.stderr.decode('utf-8').strip()
-    if err != '':
-        LOGGER.warning(f'\n\033[93mWARNING: "{cmdstr}" gave error message: "{err}"\033[00m\n')
-    return out, err
+    result = get_executor().run(cmd, timeout if timeout is not None else SHELL_TIMEOUT)
+    if result.timed_out:
+        # the partial output of a killed command is not a result
+        raise ControllerException(f'"{result.command}" was killed after running for {result.duration:.0f}s')
+    if result.stderr != '':
+        LOGGER.warning(f'"{result.command}" gave error message: "{result.stderr}"')
+    return result.stdout, result.stderr
 
 class ApplicationException(Exception):
     """Exception raised during application setup, run, or cleanup."""
@@ -69,7 +73,7 @@ class ApplicationException(Exception):
     def __init__(self, msg: str):
         if type(msg) is tuple:
             msg = ''.join(msg)
-        self.msg = '\033[91m' + msg + '\033[00m'
+        self.msg = msg
         super().__init__(self.msg)
 
 class ControllerException(Exception):
@@ -78,7 +82,7 @@ class ControllerException(Exception):
     def __init__(self, msg: str):
         if type(msg) is tuple:
             msg = ''.join(msg)
-        self.msg = '\033[91m' + msg + '\033[00m'
+        self.msg = msg
         super().__init__(self.msg)
 
 class ProvisionException(Exception):
@@ -87,7 +91,25 @@ class ProvisionException(Exception):
     def __init__(self, msg: str):
         if type(msg) is tuple:
             msg = ''.join(msg)
-        self.msg = '\033[91m' + msg + '\033[00m'
+        self.msg = msg
+        super().__init__(self.msg)
+
+class CancelledException(Exception):
+    """Exception raised when an operation is cancelled while it is running."""
+
+    def __init__(self, msg: str):
+        if type(msg) is tuple:
+            msg = ''.join(msg)
+        self.msg = msg
+        super().__init__(self.msg)
+
+class StatusException(Exception):
+    """Exception raised when a status changes to one it may not follow."""
+
+    def __init__(self, msg: str):
+        if type(msg) is tuple:
+            msg = ''.join(msg)
+        self.msg = msg
         super().__init__(self.msg)
 
 class Status(Enum):
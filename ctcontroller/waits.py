@@ -0,0 +1,149 @@
+"""
+Contains the wait engine used to wait for cloud resources such as leases and servers to
+become ready.
+How often a resource is checked depends on its state and on how long it usually takes to
+become ready: a lease that is still PENDING is checked rarely, a booting server more often
+as its expected boot time approaches. Every wait has a deadline and reports its progress,
+and the StatusPoller lets all the waits on resources of the same kind share one list request.
+"""
+
+import time
+import logging
+import threading
+from .util import ProvisionException
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Longest sleep between two cancellation checks, in seconds
+SLICE = 1
+
+class WaitPolicy():
+    """
+    How often to check a resource while waiting for it, and for how long.
+
+    Attributes:
+        intervals (dict): fixed time in seconds between checks in some states, e.g. PENDING
+        default (float): longest time in seconds between checks in the other states
+        expected (float): typical time in seconds until the resource is ready, if known;
+                          checks become more frequent as it approaches
+        minimum (float): shortest time in seconds between checks
+        deadline (float): time in seconds after which waiting fails
+
+    Methods:
+        interval(state, elapsed):
+            Returns the time to wait before the next check.
+        extended(seconds):
+            Returns the same policy with a later deadline.
+    """
+
+    def __init__(self, default: float, deadline: float, intervals: dict=None,
+                 expected: float=None, minimum: float=None):
+        self.default = default
+        self.deadline = deadline
+        self.intervals = intervals or {}
+        self.expected = expected
+        self.minimum = minimum if minimum is not None else default
+
+    def extended(self, seconds: float) -> 'WaitPolicy':
+        """Returns a copy of the policy whose deadline is seconds later, e.g. for a delayed start."""
+        return WaitPolicy(self.default, self.deadline + max(seconds, 0), self.intervals,
+                          self.expected, self.minimum)
+
+    def interval(self, state: str, elapsed: float) -> float:
+        """
+        Returns the time in seconds to wait before the next check.
+
+            Parameters:
+                state (str): the last state of the resource
+                elapsed (float): time in seconds since the wait started
+
+            Returns:
+                float: the time to wait
+        """
+
+        if state in self.intervals:
+            return self.intervals[state]
+        if self.expected is None:
+            return self.default
+        # a quarter of the distance to the expected time, so checks are densest around it
+        return max(self.minimum, min(self.default, abs(self.expected - elapsed) / 4))
+
+def wait_until(check, policy: WaitPolicy, description: str, progress=None, check_cancelled=None,
+               clock=time.monotonic, sleep=time.sleep) -> str:
+    """
+    Calls check until the resource is ready, waiting between calls as the policy says.
+
+        Parameters:
+            check (callable): returns a tuple (ready, state) and raises if the resource failed
+            policy (WaitPolicy): how often to check and for how long
+            description (str): what is being waited for, used in progress and error messages
+            progress (callable): called with a progress message after every check
+            check_cancelled (callable): raises to stop waiting, called at least every SLICE seconds
+
+        Returns:
+            str: the state of the resource once ready
+    """
+
+    start = clock()
+    while True:
+        if check_cancelled is not None:
+            check_cancelled()
+        ready, state = check()
+        elapsed = clock() - start
+        if ready:
+            LOGGER.info(f'{description} is {state} after {int(elapsed)}s')
+            return state
+        if progress is not None:
+            progress(f'{description} is {state} after {int(elapsed)}s')
+        if elapsed >= policy.deadline:
+            raise ProvisionException(f'Timed out after {int(elapsed)}s waiting for {description}, '
+                                     f'which is {state}')
+        delay = min(policy.interval(state, elapsed), policy.deadline - elapsed)
+        while delay > 0:
+            sleep(min(SLICE, delay))
+            delay -= SLICE
+            if check_cancelled is not None:
+                check_cancelled()
+
+class StatusPoller():
+    """
+    Caches the resources of each kind listed by one API request, so that any number of
+    waits on leases or servers, from any job, cost one request per kind and refresh.
+
+    Attributes:
+        listers (dict): maps a kind of resource to a function listing all of them
+
+    Methods:
+        get(kind, resource_id, max_age):
+            Returns a resource, listing its kind again if the cache is older than max_age.
+    """
+
+    # Minimum age in seconds of the cache before a missing resource triggers a new request
+    MISSING_AGE = 1
+
+    def __init__(self, listers: dict):
+        self.listers = listers
+        self.locks = {kind: threading.Lock() for kind in listers}
+        self.cache = {}
+
+    def get(self, kind: str, resource_id: str, max_age: float):
+        """
+        Returns the resource of the given kind and id, or None if it does not exist.
+
+            Parameters:
+                kind (str): the kind of resource, e.g. lease or server
+                resource_id (str): the id of the resource
+                max_age (float): age in seconds after which the cached resources are listed again
+
+            Returns:
+                the resource, as returned by the lister
+        """
+
+        with self.locks[kind]:
+            fetched, resources = self.cache.get(kind, (None, {}))
+            age = time.monotonic() - fetched if fetched is not None else None
+            if age is None or age >= max_age or (resource_id not in resources
+                                                  and age >= self.MISSING_AGE):
+                resources = {resource.get('id'): resource for resource in self.listers[kind]()}
+                self.cache[kind] = (time.monotonic(), resources)
+            return resources.get(resource_id)
@@ -0,0 +1,223 @@
+"""
+Contains the WarmPool class, which keeps the nodes of finished jobs provisioned so that the
+next job on the same site, node type and GPU setting starts without waiting for a lease and
+a bare-metal boot.
+A job shutting down parks its node in the pool, recorded in the state store, if fewer than
+CT_CONTROLLER_WARM_POOL_SIZE nodes of its kind are parked; the application has already been
+removed, and the next job cleans up its environment as usual. Parked nodes whose lease is
+about to end are extended, and nodes idle for CT_CONTROLLER_WARM_IDLE_TIMEOUT seconds are
+released.
+"""
+
+import os
+import logging
+import threading
+from datetime import datetime, UTC
+from .util import ProvisionException, Status
+from .state_store import StateStore, get_store
+
+LOGGER = logging.getLogger("CT Controller")
+
+# Number of nodes kept per site, node type and GPU setting; 0 disables the pool
+POOL_SIZE = int(os.environ.get('CT_CONTROLLER_WARM_POOL_SIZE', 0))
+# Time in seconds after which an unused node is released
+IDLE_TIMEOUT = float(os.environ.get('CT_CONTROLLER_WARM_IDLE_TIMEOUT', 1800))
+# Leases ending within this many seconds are extended
+RENEW_MARGIN = float(os.environ.get('CT_CONTROLLER_LEASE_RENEW_MARGIN', 3600))
+# Time in seconds between two maintenance passes of the API server
+MAINTAIN_INTERVAL = 60
+
+def pool_key(site: str, node_type: str, gpu: bool) -> tuple:
+    """Returns the key of the nodes that are interchangeable for a job."""
+    return (site, node_type, bool(gpu))
+
+def _matches(node: dict, config: dict) -> bool:
+    # a job placed on any Chameleon site can use a node of any of them
+    # pylint: disable=import-outside-toplevel
+    from .placement import is_placement
+    site = config['target_site']
+    if is_placement(site):
+        site_matches = node['site'].startswith('CHI@')
+    else:
+        site_matches = node['site'] == site
+    return site_matches and (node['node_type'], node['gpu']) == (config['node_type'], bool(config['gpu']))
+
+class WarmPool():
+    """
+    The provisioned nodes kept for the next job, recorded in the state store.
+
+    Attributes:
+        store (StateStore): the store holding the pool
+        size (int): number of nodes kept per site, node type and GPU setting
+        idle_timeout (float): time in seconds after which an unused node is released
+        renew_margin (float): leases ending within this many seconds are extended
+
+    Methods:
+        park(provisioner):
+            Keeps the hardware of a finished job for the next job, if there is room.
+        acquire(config, operation):
+            Returns a provisioner on a parked node matching a job.
+        maintain():
+            Extends the leases that are about to end and releases idle nodes.
+        start(interval):
+            Runs maintain() periodically in a background thread.
+        stop():
+            Stops the background thread.
+    """
+
+    def __init__(self, store: StateStore, size: int=POOL_SIZE, idle_timeout: float=IDLE_TIMEOUT,
+                 renew_margin: float=RENEW_MARGIN):
+        self.store = store
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.renew_margin = renew_margin
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether nodes are kept at all."""
+        return self.size > 0
+
+    def park(self, provisioner) -> bool:
+        """
+        Keeps the hardware of a job whose application has been shut down for the next job,
+        if the pool has room for a node of its kind. The job's hardware is then SHUTDOWN.
+
+            Parameters:
+                provisioner (Provisioner): the provisioner of the job
+
+            Returns:
+                bool: True if the node was parked, False if it must be shut down
+        """
+
+        if not self.enabled or not provisioner.POOLABLE or provisioner.status != Status.READY:
+            return False
+        job_id = provisioner.__dict__.get('state_job_id')
+        if job_id is None:
+            return False
+        key = pool_key(provisioner.site, provisioner.node_type, provisioner.gpu)
+        with self.lock:
+            parked = [node for node in self.store.pooled()
+                      if pool_key(node['site'], node['node_type'], node['gpu']) == key]
+            if len(parked) >= self.size:
+                LOGGER.info(f'Warm pool already holds {len(parked)} nodes of {key}')
+                return False
+            self.store.park(job_id, provisioner.config, provisioner.to_state())
+        LOGGER.info(f'Parked the node of job {job_id} in the warm pool')
+        provisioner.status = Status.SHUTDOWN
+        return True
+
+    def acquire(self, config: dict, operation=None):
+        """
+        Claims a parked node matching the site, node type and GPU setting of a job. Nodes
+        whose lease or server is no longer active are released and the next one is tried.
+
+            Parameters:
+                config (dict): the provisioner configuration of the job
+                operation (Operation): the operation the provisioner reports to, if any
+
+            Returns:
+                Provisioner: a provisioner on the node, READY, or None if no node matches
+        """
+
+        if not self.enabled:
+            return None
+        for node in self.store.pooled():
+            if not _matches(node, config) or self.store.claim(node['job_id']) is None:
+                continue
+            try:
+                provisioner = self._provisioner(dict(config, target_site=node['site']), node)
+                provisioner.operation = operation
+                if provisioner.verify():
+                    self._renew(provisioner)
+                    LOGGER.info(f'Using the warm node of job {node["job_id"]} on {node["site"]}')
+                    return provisioner
+                LOGGER.warning(f'The warm node of job {node["job_id"]} is no longer usable')
+            except ProvisionException as e:
+                LOGGER.warning(f'Could not reuse the warm node of job {node["job_id"]}: {e.msg}')
+            self._release(node)
+        return None
+
+    def maintain(self):
+        """
+        Releases the nodes parked for longer than idle_timeout and extends the leases of the
+        others if they end within renew_margin. Errors are logged so that one node does not
+        keep the others from being maintained.
+        """
+
+        now = datetime.now(UTC).timestamp()
+        for node in self.store.pooled():
+            try:
+                if now - node['parked'] >= self.idle_timeout:
+                    if self.store.claim(node['job_id']) is not None:
+                        LOGGER.info(f'Releasing the warm node of job {node["job_id"]}, idle for '
+                                    f'{int(now - node["parked"])}s')
+                        self._release(node)
+                    continue
+                self._renew(self._provisioner(node['config'], node))
+            except ProvisionException as e:
+                LOGGER.error(f'Could not maintain the warm node of job {node["job_id"]}: {e.msg}')
+
+    def _provisioner(self, config: dict, node: dict):
+        # pylint: disable=import-outside-toplevel
+        from .ct_main import site_provisioner
+        provisioner = site_provisioner(node['site'])(config)
+        provisioner.restore_state(node['provisioner'])
+        return provisioner
+
+    def _renew(self, provisioner):
+        end = provisioner.reservation_end()
+        if end is not None and (end - datetime.now(UTC)).total_seconds() < self.renew_margin:
+            provisioner.extend_reservation()
+
+    def _release(self, node: dict):
+        try:
+            provisioner = self._provisioner(node['config'], node)
+        except ProvisionException as e:
+            # keep the node parked rather than losing track of it, the next pass retries
+            LOGGER.error(f'Could not release the warm node of job {node["job_id"]}: {e.msg}')
+            self.store.park(node['job_id'], node['config'], node['provisioner'], node['parked'])
+            return
+        # the release is recorded under the job that provisioned the node, so that a
+        # restarted controller finishes it if it is interrupted
+        provisioner.attach_store(self.store, node['job_id'])
+        try:
+            provisioner.shutdown_instance()
+        except ProvisionException as e:
+            LOGGER.error(f'Could not release the warm node of job {node["job_id"]}: {e.msg}')
+
+    def _loop(self, interval: float):
+        while not self.stopping.wait(interval):
+            try:
+                self.maintain()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                LOGGER.error(f'Warm pool maintenance failed: {getattr(e, "msg", e)}')
+
+    def start(self, interval: float=MAINTAIN_INTERVAL):
+        """Runs maintain() every interval seconds in a background thread until stop() is called."""
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._loop, args=(interval,), daemon=True,
+                                       name='ctcontroller-warm-pool')
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread. The parked nodes stay provisioned."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(store: StateStore=None) -> WarmPool:
+    """Returns the warm pool held in store, by default the default state store."""
+    store = store or get_store()
+    with _POOLS_LOCK:
+        if store.path not in _POOLS:
+            _POOLS[store.path] = WarmPool(store)
+        return _POOLS[store.path]